@@ -80,7 +80,8 @@ from backend.core import (
     # Auth/decorators
     login_required, role_required,
     # DB y utilidades
-    get_db_connection, allowed_file, normalize_text, query_to_regexp,
+    get_db_connection, init_request_db, apply_schema_migrations, allowed_file, normalize_text, query_to_regexp,
+    text_index_filter,
     # PPU helpers
     parse_ppu, parse_query_ppu, generar_variantes_ppu,
     # Expedientes
@@ -91,6 +92,11 @@ from backend.core import (
     validate_expediente_juzgado, get_fiscalia_departamento,
 )
 
+# Unidad de trabajo por request: commit/rollback único y devolución al pool
+init_request_db(app)
+# Cambios de esquema pendientes (columnas generadas, índices, tablas auxiliares)
+apply_schema_migrations()
+
 
 # ---------------------------
 # CONFIGURACIÓN DE ARCHIVOS
@@ -2365,6 +2371,11 @@ def buscar_rango():
             if regexp_conditions:
                 conditions.append('(' + ' OR '.join(regexp_conditions) + ')')
                 params.extend(regexp_params)
+            # Candidatos desde el índice invertido (datapenal_busqueda)
+            filtro_txt = text_index_filter(connection, query)
+            if filtro_txt:
+                conditions.append(filtro_txt[0])
+                params.extend(filtro_txt[1])
 
         where_clause = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
         sql_query = f"SELECT * FROM datapenal {where_clause}"
@@ -14,7 +14,6 @@ from datetime import date
 from dateutil import parser
 import shutil
 from flask import send_from_directory
-from io import BytesIO
 
 # ---------------------------
 # CONFIGURACIÓN DE LOGGING
@@ -75,16 +74,30 @@ CORS(
 
 # app.py (o donde creas la app)
 from backend.modules.ingresos.ingresos import ingresos_bp
-from backend.modules.scan_busqueda.scan import scan_bp
+from backend.modules.ingresos.numeracion import NumeracionError, asignar_numero
+from backend.modules.scan_busqueda.scan import scan_bp, iniciar_vigilancia
 from backend.modules.data_penal.data_penal import datapenal_bp
 from backend.modules.busqueda_rapida.busqueda_rapida import busqueda_rapida_bp
 from backend.modules.history.history import history_bp  # <-- nuevo
+from backend.modules.history.versioning import (
+    fijar_versiones_posteriores, insertar_version, reconstruir_versiones,
+)
+# Archivo frío de plazos atendidos y versiones antiguas
+from backend.modules.history.archivo import (
+    ARCHIVO_TABLAS, NOTIFICACIONES_DESDE, archivo_bp, iniciar_archivo_programado,
+    tabla_con_archivo, union_archivo,
+)
+# Caché en disco de los Excel exportados (exportar_excel_plazos y reportes de plazos)
+from backend.modules.data_penal.export_cache import (
+    cache_and_send, data_version, export_cache_key, send_cached_export,
+)
 
 app.register_blueprint(ingresos_bp,        url_prefix="/api")
 app.register_blueprint(scan_bp,            url_prefix="/api")
 app.register_blueprint(datapenal_bp,       url_prefix="/api")
 app.register_blueprint(busqueda_rapida_bp, url_prefix="/api")
 app.register_blueprint(history_bp,         url_prefix="/api")  # <-- nuevo
+app.register_blueprint(archivo_bp,         url_prefix="/api")
 
 
 
@@ -92,17 +105,32 @@ from backend.core import (
     # Auth/decorators
     login_required, role_required,
     # DB y utilidades
-    get_db_connection, allowed_file, normalize_text, query_to_regexp,
+    get_db_connection, get_request_db, init_request_db, apply_schema_migrations,
+    get_pool_stats, run_parallel_queries, allowed_file, normalize_text, query_to_regexp,
+    text_index_filter, iniciar_sincronizacion_texto,
     # PPU helpers
     parse_ppu, parse_query_ppu, generar_variantes_ppu,
+    note_ppu_year,
     # Expedientes
     normalizar_expediente,
     # PDF helpers y formato
-    extract_pdf_pages, format_legajo,
+    extract_pdf_pages, format_legajo, sha256_file,
     # Validación y lookups
     validate_expediente_juzgado, get_fiscalia_departamento,
 )
 
+# Unidad de trabajo por request: commit/rollback único y devolución al pool
+init_request_db(app)
+# Cambios de esquema pendientes (columnas generadas, índices, tablas auxiliares)
+apply_schema_migrations()
+# Mantiene datapenal_busqueda al día (incluida la carga inicial) fuera de las peticiones
+iniciar_sincronizacion_texto()
+# Mueve periódicamente al archivo frío lo que ya no se consulta a diario
+iniciar_archivo_programado()
+# Vigila la bandeja "A pasar" y deja resueltas las filas de busqueda_rapida_scan
+# (solo con PENAL_SCAN_WATCH=1)
+iniciar_vigilancia()
+
 
 # ---------------------------
 # CONFIGURACIÓN DE ARCHIVOS
@@ -140,6 +168,14 @@ def test_log():
     return "Log enviado", 200
 
 
+@app.route("/api/db_pool_stats", methods=["GET"])
+@login_required
+@role_required(['admin'])
+def db_pool_stats():
+    """Estadísticas de los pools MySQL por esquema."""
+    return jsonify(get_pool_stats()), 200
+
+
 
 
 
@@ -239,46 +275,21 @@ def get_registros():
     try:
         cursor = connection.cursor(dictionary=True)
         if tipo == 'LEGAJO':
-            regex_pattern = r'^(L\. ?|LEG-)(\d{1,4})-{}($|-[A-Z]+$)'.format(year)
-            prefix_condition = "registro_ppu LIKE 'L.%' OR registro_ppu LIKE 'LEG-%'"
+            tipos = ("LEG", "L")
         elif tipo == 'DENUNCIA':
-            regex_pattern = r'^D-(\d+)-{}($|-[A-Z]+$)'.format(year)
-            prefix_condition = "registro_ppu LIKE 'D-%'"
+            tipos = ("D",)
         else:
             return jsonify({"error": "Tipo inválido"}), 400
+        if not (year or '').isdigit():
+            return jsonify({"data": []})
 
+        # Rango sobre idx_ppu_tipo_anio; el orden sale de las columnas descompuestas
+        placeholders = ', '.join(['%s'] * len(tipos))
         cursor.execute(f"""
             SELECT registro_ppu FROM datapenal
-            WHERE ({prefix_condition}) AND registro_ppu REGEXP %s
-            ORDER BY
-              CAST(
-                CASE
-                  WHEN registro_ppu LIKE 'L.%' THEN
-                    SUBSTRING_INDEX(registro_ppu, '-', -1)
-                  WHEN registro_ppu REGEXP '-[A-Z]$' THEN
-                    SUBSTRING_INDEX(SUBSTRING_INDEX(registro_ppu, '-', -2), '-', 1)
-                  ELSE
-                    SUBSTRING_INDEX(registro_ppu, '-', -1)
-                END AS UNSIGNED
-              ) ASC,
-              CAST(
-                CASE
-                  WHEN registro_ppu LIKE 'L.%' THEN
-                    SUBSTRING(
-                      registro_ppu,
-                      LOCATE('.', registro_ppu) + 1,
-                      LOCATE('-', registro_ppu) - LOCATE('.', registro_ppu) - 1
-                    )
-                  ELSE
-                    SUBSTRING_INDEX(SUBSTRING_INDEX(registro_ppu, '-', 2), '-', -1)
-                END AS UNSIGNED
-              ) ASC,
-              CASE
-                WHEN registro_ppu REGEXP '-[A-Z]$' THEN 1
-                ELSE 0
-              END,
-              registro_ppu
-        """, (regex_pattern,))
+            WHERE ppu_tipo IN ({placeholders}) AND ppu_anio = %s
+            ORDER BY ppu_anio, ppu_numero, ppu_sufijo <> '', ppu_sufijo, registro_ppu
+        """, (*tipos, int(year)))
 
         registros = cursor.fetchall()
         registros_list = [reg['registro_ppu'] for reg in registros]
@@ -383,13 +394,18 @@ def obtener_historial():
                 e_situacional, 
                 DATE_FORMAT(fecha_version, '%d-%m-%Y') AS fecha_version, 
                 usuario_modificacion,
-                ruta
-            FROM datapenal_versioning
+                ruta,
+                delta
+            FROM {tabla}
             WHERE registro_ppu = %s
-            ORDER BY fecha_version DESC
         """
-        cursor.execute(query_historial, (registro_ppu,))
-        historial = cursor.fetchall()
+        # Historial completo: versiones calientes y archivadas
+        query_historial, params_historial = union_archivo(
+            query_historial, (registro_ppu,), "datapenal_versioning"
+        )
+        cursor.execute(query_historial + " ORDER BY fecha_version DESC", params_historial)
+        # Las versiones delta solo guardan lo que cambió: se completan con las anteriores
+        historial = reconstruir_versiones(cursor.fetchall())
 
         # -- AÑADE ESTE FILTRO --:
         # Filtra solo las filas que tengan ruta != null y != '' 
@@ -439,7 +455,6 @@ def obtener_por_ppus():
 import io
 import os
 import random
-import hashlib
 
 from flask import request, jsonify
 from PyPDF2 import PdfReader
@@ -619,12 +634,9 @@ def upload_file():
     cnx2 = None
     cursor2 = None
     try:
-        cnx2 = mysql.connector.connect(
-            host='localhost',
-            database='monitoreo_descargas_sinoe',
-            user='root',
-            password='Manuel22'
-        )
+        cnx2 = get_db_connection("monitoreo_descargas_sinoe")
+        if cnx2 is None:
+            raise mysql.connector.Error("Sin conexión a monitoreo_descargas_sinoe")
         # ✅ buffered=True te blinda ante “Unread result found” si en el futuro alguien mete otro SELECT sin LIMIT
         cursor2 = cnx2.cursor(buffered=True)
 
@@ -814,34 +826,26 @@ def bulk_update():
     logger.info(f"Carpeta destino preparada: {final_folder}")
 
     def sha256_of_file(filepath):
-        """Calcula el hash SHA-256 de un archivo."""
-        sha256 = hashlib.sha256()
+        """Calcula el hash SHA-256 de un archivo (caché compartida de backend.core)."""
         try:
-            with open(filepath, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    sha256.update(chunk)
-            return sha256.hexdigest()
+            return sha256_file(filepath)
         except Exception as e:
             logger.error(f"Error al calcular SHA-256 del archivo {filepath}: {e}")
             return None
 
-    connection_registro = None
-    connection_consulta = None
-    cursor_registro = None
-    cursor_consulta = None
+    cursor = None
     # Lista para almacenar los archivos PDF temporales que se eliminarán al final
     pdfs_to_delete = []
 
     try:
-        # Conectar a la BD (la misma base para ambos casos)
-        connection_registro = get_db_connection()
-        connection_consulta = get_db_connection()
-        if connection_registro is None or connection_consulta is None:
+        # Una sola conexión/transacción para todo el lote (datapenal y consulta_ppupenal
+        # viven en la misma base); el commit lo hace la unidad de trabajo de la request.
+        connection = get_request_db()
+        if connection is None:
             logger.error("Error al conectar con la base de datos.")
             return jsonify({"error": "Error al conectar con la base de datos"}), 500
 
-        cursor_registro = connection_registro.cursor(dictionary=True)
-        cursor_consulta = connection_consulta.cursor(dictionary=True)
+        cursor = connection.cursor(dictionary=True)
         logger.info("Conexión a la base de datos establecida correctamente.")
 
         for reg in registros:
@@ -875,11 +879,11 @@ def bulk_update():
             # Bifurcación: buscar en la tabla correcta
             if tipo == 'consulta_ppu':
                 main_table = "consulta_ppupenal"
-                cur = cursor_consulta
+                cur = cursor
                 cur.execute("SELECT * FROM consulta_ppupenal WHERE consulta_ppu = %s LIMIT 1", (registro_ppu,))
             else:
                 main_table = "datapenal"
-                cur = cursor_registro
+                cur = cursor
                 cur.execute("SELECT * FROM datapenal WHERE registro_ppu = %s LIMIT 1", (registro_ppu,))
             row_dp = cur.fetchone()
             if not row_dp:
@@ -901,13 +905,12 @@ def bulk_update():
             logger.info(f"Registro {registro_ppu}: situacion_cambio = {situacion_cambio}")
 
             # Consultar el último registro en datapenal_plazos para ver si la acción cambió
-            cur.execute("""
-                SELECT accion
-                FROM datapenal_plazos
-                WHERE registro_ppu = %s
-                ORDER BY last_modified DESC
-                LIMIT 1
-            """, (registro_ppu,))
+            # (también en el archivo: el último plazo puede estar ATENDIDO y archivado)
+            query_plazos, params_plazos = union_archivo(
+                "SELECT accion, last_modified FROM {tabla} WHERE registro_ppu = %s",
+                (registro_ppu,), "datapenal_plazos",
+            )
+            cur.execute(query_plazos + " ORDER BY last_modified DESC LIMIT 1", params_plazos)
             last_plazos = cur.fetchone()
             accion_actual = (last_plazos['accion'].strip() if last_plazos and last_plazos.get('accion') else '')
             accion_modificada = (accion_val != accion_actual) and (accion_val != '')
@@ -1016,9 +1019,13 @@ def bulk_update():
                 continue
 
             # Consultar si ya existe el hash en datapenal_plazos y versioning
-            cur.execute("SELECT ruta FROM datapenal_plazos WHERE hash_sha = %s LIMIT 1", (hash_sha,))
+            # (también en el archivo frío: un PDF ya procesado no se vuelve a mover)
+            sql_hash = "SELECT ruta FROM {tabla} WHERE hash_sha = %s"
+            sql, params = union_archivo(sql_hash, (hash_sha,), "datapenal_plazos")
+            cur.execute(sql + " LIMIT 1", params)
             plazos_row_con_hash = cur.fetchone()
-            cur.execute("SELECT ruta FROM datapenal_versioning WHERE hash_sha = %s LIMIT 1", (hash_sha,))
+            sql, params = union_archivo(sql_hash, (hash_sha,), "datapenal_versioning")
+            cur.execute(sql + " LIMIT 1", params)
             versioning_row_con_hash = cur.fetchone()
 
             if mover_pdf:
@@ -1064,11 +1071,13 @@ def bulk_update():
 
                 # Insertar en datapenal_plazos si la acción ha cambiado
                 if accion_modificada:
-                    cur.execute("""
-                        SELECT plazo_atencion
-                        FROM datapenal_plazos
-                        WHERE hash_sha = %s AND registro_ppu = %s AND tipoPlazo = %s
-                    """, (hash_sha, registro_ppu, reg.get('tipoPlazo', '')))
+                    # Plazos calientes y archivados con el mismo documento
+                    query_hash, params_hash = union_archivo(
+                        "SELECT plazo_atencion FROM {tabla}"
+                        " WHERE hash_sha = %s AND registro_ppu = %s AND tipoPlazo = %s",
+                        (hash_sha, registro_ppu, reg.get('tipoPlazo', '')), "datapenal_plazos",
+                    )
+                    cur.execute(query_hash, params_hash)
                     filas_mismo_hash = cur.fetchall()
                     if filas_mismo_hash:
                         plazos_existentes = [fila['plazo_atencion'] for fila in filas_mismo_hash]
@@ -1149,7 +1158,10 @@ def bulk_update():
 
                 # Inserción en versioning: se inserta si se detecta un cambio en e_situacional
                 # o si no existe registro previo para el hash
-                cur.execute("SELECT COUNT(*) AS c FROM datapenal_versioning WHERE hash_sha = %s", (hash_sha,))
+                sql, params = union_archivo(
+                    "SELECT version_id FROM {tabla} WHERE hash_sha = %s", (hash_sha,), "datapenal_versioning"
+                )
+                cur.execute(f"SELECT COUNT(*) AS c FROM ({sql}) t", params)
                 count_row = cur.fetchone()
                 if situacion_cambio or (count_row and count_row.get('c', 0) == 0):
                     insert_data_versioning = {
@@ -1168,12 +1180,9 @@ def bulk_update():
                     }
                     if tipo == 'consulta_ppu':
                         insert_data_versioning['consulta_ppu'] = reg.get('consulta_ppu', 'consulta_ppu')
-                    cols_ver = ', '.join(f"`{k}`" for k in insert_data_versioning.keys())
-                    place_ver = ', '.join(['%s'] * len(insert_data_versioning))
-                    vals_ver = tuple(insert_data_versioning.values())
-                    sql_insert_ver = f"INSERT INTO datapenal_versioning ({cols_ver}) VALUES ({place_ver})"
                     try:
-                        cur.execute(sql_insert_ver, vals_ver)
+                        # Solo las columnas que cambiaron respecto a la versión anterior
+                        insertar_version(connection, insert_data_versioning)
                         logger.info(f"Insertado en datapenal_versioning para {registro_ppu}")
                     except mysql.connector.Error as err:
                         logger.error(f"Error en INSERT datapenal_versioning para {registro_ppu}: {err}")
@@ -1192,31 +1201,19 @@ def bulk_update():
             except Exception as e:
                 logger.error(f"Error al eliminar {pdf}: {e}")
 
-        connection_registro.commit()
-        connection_consulta.commit()
         logger.info("Bulk update completado exitosamente.")
         return jsonify({"message": "Actualización masiva completada"}), 200
 
     except Exception as e:
         logger.error(f"Error en bulk_update: {e}", exc_info=True)
-        if connection_registro:
-            connection_registro.rollback()
-        if connection_consulta:
-            connection_consulta.rollback()
         return jsonify({"error": f"Error en bulk_update: {e}"}), 500
 
     finally:
         try:
-            if cursor_registro:
-                cursor_registro.close()
-            if connection_registro:
-                connection_registro.close()
-            if cursor_consulta:
-                cursor_consulta.close()
-            if connection_consulta:
-                connection_consulta.close()
+            if cursor:
+                cursor.close()
         except Exception as e:
-            logger.error(f"Error al cerrar conexión o cursor: {e}")
+            logger.error(f"Error al cerrar cursor: {e}")
 
 
 
@@ -1232,6 +1229,7 @@ def get_datapenal_plazos():
       - limit (cantidad de filas por página)
       - abogado (filtra solo las filas cuyo dp.abogado contenga el valor)
       - mostrar_archivados (booleano para excluir registros con etiqueta='ARCHIVO')
+      - incluir_historico (booleano; incluye los plazos atendidos del archivo frío)
       
     También fuerza el filtro de abogado si el role del usuario es 'user'.
     Incluye el campo observacion_abogado en la respuesta JSON.
@@ -1257,6 +1255,8 @@ def get_datapenal_plazos():
     # ===========================
 
     mostrar_archivados = request.args.get('mostrar_archivados', 'true').lower() == 'true'
+    incluir_historico = request.args.get('incluir_historico', 'false').lower() == 'true'
+    plazos_src = tabla_con_archivo("datapenal_plazos", incluir_historico)
 
     connection = get_db_connection()
     if connection is None:
@@ -1272,16 +1272,9 @@ def get_datapenal_plazos():
             params.append('ARCHIVO')
 
         if abogado_filter:
-            # Filtrar por abogado en dp.abogado (parte posterior al “;” si existe)
-            conditions.append("""
-                CASE
-                  WHEN LOCATE(';', dp.abogado) > 0
-                    THEN TRIM(SUBSTRING_INDEX(dp.abogado, ';', -1))
-                  ELSE
-                    TRIM(dp.abogado)
-                END = %s
-            """)
-            params.append(abogado_filter.lower())
+            # Filtrar por abogado (parte posterior al “;”, columna abogado_key indexada)
+            conditions.append("dp.abogado_key = %s")
+            params.append(abogado_filter)
 
         if query_param:
             # Columnas en las que buscar el texto de 'query'
@@ -1305,7 +1298,7 @@ def get_datapenal_plazos():
         # 1. Contar total de registros
         count_query = f"""
             SELECT COUNT(*) AS total
-            FROM datapenal_plazos dp_plazos
+            FROM {plazos_src} dp_plazos
             JOIN datapenal dp ON dp_plazos.registro_ppu = dp.registro_ppu
             {where_clause}
         """
@@ -1331,7 +1324,7 @@ def get_datapenal_plazos():
                 dp.juzgado,
                 dp.departamento,
                 dp_plazos.observacion_abogado
-            FROM datapenal_plazos dp_plazos
+            FROM {plazos_src} dp_plazos
             JOIN datapenal dp ON dp_plazos.registro_ppu = dp.registro_ppu
             {where_clause}
             ORDER BY
@@ -1435,18 +1428,8 @@ def buscar_global():
         if not query and not year_param:
             cursor.execute(
                 """
-                SELECT
-                  MAX(
-                    CAST(
-                      SUBSTRING_INDEX(
-                        SUBSTRING_INDEX(registro_ppu, '-', 3),
-                        '-',
-                        -1
-                      ) AS UNSIGNED
-                    )
-                  ) AS maxyear
+                SELECT MAX(ppu_anio) AS maxyear
                 FROM datapenal
-                WHERE registro_ppu IS NOT NULL AND registro_ppu != ''
                 """
             )
             result = cursor.fetchone()
@@ -1463,7 +1446,7 @@ def buscar_global():
             params.append("ARCHIVO")
 
         if abogado_filter:
-            conditions.append("UPPER(TRIM(SUBSTRING_INDEX(d.abogado, ';', -1))) = %s")
+            conditions.append("d.abogado_key = %s")
             params.append(abogado_filter)
 
         if query:
@@ -1476,23 +1459,22 @@ def buscar_global():
             sub_conds = [f"d.{c} REGEXP %s" for c in cols]
             conditions.insert(0, "(" + " OR ".join(sub_conds) + ")")
             params = [regexp] * len(cols) + params
+            filtro_txt = text_index_filter(connection, query, alias="d")
+            if filtro_txt:
+                conditions.append(filtro_txt[0])
+                params.extend(filtro_txt[1])
         else:
             if used_year and used_year.isdigit():
                 if tipo_param == "DENUNCIA":
-                    pattern = rf"^D-[0-9]+-{re.escape(used_year)}(?:-[A-Z])?$"
+                    tipos = ["D"]
                 elif tipo_param == "LEGAJO":
-                    pattern = (
-                        rf"^(?:LEG-[0-9]+-{re.escape(used_year)}(?:-[A-Z])?"
-                        rf"|L\. ?[0-9]+-{re.escape(used_year)}(?:-[A-Z])?)$"
-                    )
+                    tipos = ["LEG", "L"]
                 else:
-                    pattern = (
-                        rf"^(?:D-[0-9]+-{re.escape(used_year)}(?:-[A-Z])?"
-                        rf"|LEG-[0-9]+-{re.escape(used_year)}(?:-[A-Z])?"
-                        rf"|L\.?\s?[0-9]+-{re.escape(used_year)}(?:-[A-Z])?)$"
-                    )
-                conditions.append("d.registro_ppu REGEXP %s")
-                params.append(pattern)
+                    tipos = ["D", "LEG", "L"]
+                conditions.append(
+                    f"d.ppu_tipo IN ({', '.join(['%s'] * len(tipos))}) AND d.ppu_anio = %s"
+                )
+                params.extend(tipos + [int(used_year)])
 
         where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
 
@@ -1575,10 +1557,12 @@ def exportar_excel_plazos():
       - abogado (forzado si es user)
       - query
       - mostrar_archivados
+      - incluir_historico (plazos atendidos del archivo frío)
     y SIN excluir filas por 'seguimiento=ATENDIDA', NI lógica de 'vencido'.
     """
     query = request.args.get('query', '').strip()
     mostrar_archivados = request.args.get('mostrar_archivados', 'true').lower() == 'true'
+    incluir_historico = request.args.get('incluir_historico', 'false').lower() == 'true'
 
     # Forzar abogado si es "user"
     user_role = session.get('role')
@@ -1596,6 +1580,17 @@ def exportar_excel_plazos():
     try:
         cursor = connection.cursor(dictionary=True)
 
+        # 0) Caché de exportaciones: mismos filtros y misma versión de datos
+        cache_key = export_cache_key("exportar_excel_plazos", {
+            "query": query,
+            "mostrar_archivados": mostrar_archivados,
+            "abogado": abogado_filter,
+            "incluir_historico": incluir_historico,
+        }, data_version(connection, ["datapenal", "datapenal_plazos"]))
+        cached = send_cached_export(cache_key)
+        if cached is not None:
+            return cached
+
         # 1) Construir condiciones
         conditions = []
         params = []
@@ -1651,7 +1646,7 @@ def exportar_excel_plazos():
             dp.juzgado,
             dp_plazos.e_situacional,
             dp.etiqueta
-        FROM datapenal_plazos dp_plazos
+        FROM {tabla_con_archivo("datapenal_plazos", incluir_historico)} dp_plazos
         JOIN datapenal dp
           ON dp_plazos.registro_ppu = dp.registro_ppu
         {where_clause}
@@ -1669,22 +1664,20 @@ def exportar_excel_plazos():
         if not df.empty:
             df.drop(columns=['id'], inplace=True, errors='ignore')
 
-        # 5) Generar Excel en memoria
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Plazos')
-            writer.close()
-        output.seek(0)
+        # 5) Generar Excel en un archivo temporal (pasa a la caché al enviarlo)
+        fd, ruta = tempfile.mkstemp(prefix="penal_plazos_", suffix=".xlsx")
+        os.close(fd)
+        try:
+            with pd.ExcelWriter(ruta, engine='xlsxwriter') as writer:
+                df.to_excel(writer, index=False, sheet_name='Plazos')
+        except Exception:
+            os.remove(ruta)
+            raise
 
         # 6) Retornar el Excel
         fecha_actual = datetime.now().strftime("%Y%m%d_%H%M%S")
         nombre_archivo = f"plazos_exportados_{fecha_actual}.xlsx"
-        return send_file(
-            output,
-            download_name=nombre_archivo,
-            as_attachment=True,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+        return cache_and_send(cache_key, ruta, nombre_archivo)
 
     except Exception as e:
         logger.error(f"Error al exportar Excel plazos: {e}")
@@ -1917,11 +1910,7 @@ def actualizar_seguimiento():
 
             # Calcular el hash SHA-256 del archivo guardado
             try:
-                sha256 = hashlib.sha256()
-                with open(final_path, 'rb') as f:
-                    for chunk in iter(lambda: f.read(4096), b""):
-                        sha256.update(chunk)
-                hash_respuesta = sha256.hexdigest()
+                hash_respuesta = sha256_file(final_path)
                 logger.info(f"Hash SHA-256 calculado: {hash_respuesta}")
             except Exception as hash_err:
                 logger.error(f"Error al calcular hash: {hash_err}", exc_info=True)
@@ -1988,11 +1977,12 @@ def get_notifications():
             SUM(CASE WHEN leido = 0 THEN 1 ELSE 0 END) AS unread_count,
             MIN(fecha_version) AS fecha_version_min
         FROM datapenal_versioning
-        WHERE abogado = %s AND fecha_version >= '2025-02-02'
+        WHERE abogado = %s AND fecha_version >= %s
         GROUP BY registro_ppu
         ORDER BY fecha_version_min ASC
         """
-        cursor.execute(query, (abogado,))
+        # Las no leídas desde esta fecha nunca pasan al archivo frío
+        cursor.execute(query, (abogado, NOTIFICACIONES_DESDE))
         notifications = cursor.fetchall()
 
         if not notifications:
@@ -2091,16 +2081,21 @@ def notification_details():
         current_username = session.get('username', '')
         abogado = username_to_abogado.get(current_username, '').upper()
 
+        # Todas las versiones del PPU (las delta se completan con las anteriores);
+        # el filtro por abogado se aplica después de reconstruir
         cursor.execute("""
             SELECT 
                 id, version_id, abogado, registro_ppu, denunciado, origen, juzgado, fiscalia, departamento,
                 e_situacional, DATE_FORMAT(fecha_version, '%d-%m-%Y') AS fecha_version, 
-                usuario_modificacion, ruta, leido
+                usuario_modificacion, ruta, leido, delta
             FROM datapenal_versioning
-            WHERE registro_ppu = %s AND abogado = %s
+            WHERE registro_ppu = %s
             ORDER BY fecha_version DESC
-        """, (registro_ppu, abogado))
-        details = cursor.fetchall()
+        """, (registro_ppu,))
+        details = [
+            row for row in reconstruir_versiones(cursor.fetchall())
+            if (row.get("abogado") or "").upper() == abogado
+        ]
         return jsonify({"details": details}), 200
     except Exception as e:
         return jsonify({"error": f"Error al obtener detalles: {e}"}), 500
@@ -2162,20 +2157,23 @@ def check_duplicate_situacion():
         return jsonify({"error": "Error al conectar con la base de datos"}), 500
 
     try:
-        # Construir búsqueda: se fuerza que se busque para ese registro_ppu
-        text_search = f"%{e_situacional.lower()}%"
+        # Todas las versiones del PPU (calientes y archivadas): una versión delta con
+        # documento que repite la situación anterior la guarda como NULL, así que se
+        # reconstruye antes de comparar
+        text_search = e_situacional.lower()
         cursor = connection.cursor(dictionary=True)
-        query = """
-            SELECT COUNT(*) AS conteo
-            FROM datapenal_versioning
-            WHERE registro_ppu = %s
-              AND ruta IS NOT NULL
-              AND hash_sha IS NOT NULL
-              AND LOWER(e_situacional) LIKE %s
-        """
-        cursor.execute(query, (registro_ppu, text_search))
-        row = cursor.fetchone()
-        duplicate_count = row['conteo']
+        query, params = union_archivo(
+            "SELECT version_id, registro_ppu, e_situacional, ruta, hash_sha, delta"
+            " FROM {tabla} WHERE registro_ppu = %s",
+            (registro_ppu,), "datapenal_versioning",
+        )
+        cursor.execute(query, params)
+        versiones = reconstruir_versiones(cursor.fetchall(), columns=["e_situacional"])
+        duplicate_count = sum(
+            1 for v in versiones
+            if v.get('ruta') is not None and v.get('hash_sha') is not None
+            and text_search in (v.get('e_situacional') or '').lower()
+        )
         if duplicate_count > 0:
             return jsonify({
                 "is_duplicate": True,
@@ -2330,46 +2328,15 @@ def generar_consulta():
             logger.info("Registro generado (especial): %s", registro_ppu)
             return jsonify({"registro_ppu": registro_ppu, "success": True})
 
-        # Caso general
-        connection = get_db_connection()
-        if connection is None:
-            logger.error("Error: Conexión a la base de datos fallida")
-            return jsonify({"error": "Error al conectar con la base de datos"}), 500
-
+        # Caso general: máximo + 1 de la serie CONS, reservado para este usuario
         try:
-            cursor = connection.cursor(dictionary=True)
-            like_pattern = f"CONS-%-{year}"
-            logger.info("Ejecutando consulta con patrón LIKE: %s", like_pattern)
-
-            cursor.execute(
-                "SELECT TRIM(consulta_ppu) AS consulta_ppu FROM consulta_ppupenal WHERE consulta_ppu LIKE %s",
-                (like_pattern,)
-            )
-
-            registros = cursor.fetchall()
-            logger.info("Registros obtenidos: %s", registros)
-
-            numeros = []
-            for reg in registros:
-                consulta_ppu_val = reg['consulta_ppu'].strip()
-                match = re.match(rf'^CONS-(\d+)-{year}$', consulta_ppu_val)
-                if match:
-                    numeros.append(int(match.group(1)))
-            logger.info("Números extraídos: %s", numeros)
-
-            next_num = max(numeros) + 1 if numeros else 1
-            registro_ppu = f"CONS-{next_num:03d}-{year}"
-            logger.info("Registro generado: %s", registro_ppu)
-
-            return jsonify({"registro_ppu": registro_ppu, "success": True})
-
-        except Exception as e:
-            logger.error("Error al generar registro en bloque try: %s", e)
+            next_num = asignar_numero('CONS', int(year), session.get('username'))
+        except NumeracionError as e:
+            logger.error("Error al generar registro: %s", e)
             return jsonify({"error": f"Error al generar registro: {e}"}), 500
-
-        finally:
-            cursor.close()
-            connection.close()
+        registro_ppu = f"CONS-{next_num:03d}-{year}"
+        logger.info("Registro generado: %s", registro_ppu)
+        return jsonify({"registro_ppu": registro_ppu, "success": True})
 
     except Exception as e:
         logger.error("Error inesperado en endpoint: %s", e)
@@ -2381,6 +2348,8 @@ def generar_consulta():
 @login_required
 @role_required(['admin'])
 def agregar_caso_consulta():
+    # Todo el alta (consulta_ppupenal + versioning) usa la conexión de la request:
+    # se confirma una sola vez al final y cualquier respuesta de error la revierte.
     data = request.json
     logger.info("Datos recibidos en agregar_consulta: %s", data)
 
@@ -2389,19 +2358,17 @@ def agregar_caso_consulta():
     logger.debug("Número de expediente transformado: %s", nr_de_exp)
 
     if nr_de_exp:
-        connection = get_db_connection()
-        if connection is None:
-            logger.error("Error al conectar con la base de datos (duplicados)")
-            return jsonify({"error": "Error al conectar con la base de datos"}), 500
+        # Los dos conteos son independientes: se lanzan a la vez
         try:
-            cursor = connection.cursor()
             query_check = "SELECT COUNT(*) FROM datapenal WHERE `nr de exp completo` = %s"
-            cursor.execute(query_check, (nr_de_exp,))
-            result_datapenal = cursor.fetchone()[0]
-            logger.debug("Duplicados en datapenal: %s", result_datapenal)
             query_check_consulta = "SELECT COUNT(*) FROM consulta_ppupenal WHERE `nr de exp completo` = %s"
-            cursor.execute(query_check_consulta, (nr_de_exp,))
-            result_consulta = cursor.fetchone()[0]
+            rows_datapenal, rows_consulta = run_parallel_queries([
+                (query_check, (nr_de_exp,)),
+                (query_check_consulta, (nr_de_exp,)),
+            ], dictionary=False)
+            result_datapenal = rows_datapenal[0][0]
+            logger.debug("Duplicados en datapenal: %s", result_datapenal)
+            result_consulta = rows_consulta[0][0]
             logger.debug("Duplicados en consulta_ppupenal: %s", result_consulta)
             if result_datapenal > 0 or result_consulta > 0:
                 logger.error("Número de expediente ya registrado: %s", nr_de_exp)
@@ -2409,9 +2376,6 @@ def agregar_caso_consulta():
         except Exception as e:
             logger.error("Error al verificar duplicados: %s", e, exc_info=True)
             return jsonify({"error": "Error al verificar duplicados"}), 500
-        finally:
-            cursor.close()
-            connection.close()
 
     if expediente_juzgado:
         if not isinstance(expediente_juzgado, dict):
@@ -2439,7 +2403,7 @@ def agregar_caso_consulta():
 
     data['fecha_ingreso'] = datetime.now().date()
     logger.debug("Datos a insertar en consulta_ppupenal: %s", data)
-    connection = get_db_connection()
+    connection = get_request_db()
     if connection is None:
         logger.error("Error al conectar con la base de datos (INSERT)")
         return jsonify({"error": "Error al conectar con la base de datos"}), 500
@@ -2451,14 +2415,12 @@ def agregar_caso_consulta():
         query = f'INSERT INTO consulta_ppupenal ({columns}) VALUES ({placeholders})'
         logger.info("Ejecutando query: %s con valores %s", query, values)
         cursor.execute(query, values)
-        connection.commit()
         logger.info("Caso agregado exitosamente a consulta_ppupenal")
     except Exception as e:
         logger.error("Error al agregar caso: %s", e, exc_info=True)
         return jsonify({"error": "Error al agregar caso"}), 500
     finally:
         cursor.close()
-        connection.close()
 
     # Lógica de versioning para consulta
     original_file_name = (data.get('fileName') or data.get('ruta') or '').strip()
@@ -2496,12 +2458,8 @@ def agregar_caso_consulta():
         return jsonify({"error": f"Error al copiar el archivo: {e}"}), 500
 
     def sha256_of_file(filepath):
-        sha256 = hashlib.sha256()
         try:
-            with open(filepath, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    sha256.update(chunk)
-            return sha256.hexdigest()
+            return sha256_file(filepath)
         except Exception as e:
             logger.error("Error al calcular SHA-256 del archivo %s: %s", filepath, e)
             return None
@@ -2525,25 +2483,17 @@ def agregar_caso_consulta():
         'ruta': os.path.normpath(dest_path),
         'hash_sha': hash_sha
     }
-    connection = get_db_connection()
+    connection = get_request_db()
     if connection is None:
         logger.error("Error al conectar con la base de datos para versioning")
         return jsonify({"error": "Error al conectar con la base de datos para versioning"}), 500
     try:
-        cursor = connection.cursor()
-        cols_ver = ', '.join(f"`{k}`" for k in versioning_data.keys())
-        placeholders_ver = ', '.join('%s' for _ in versioning_data.values())
-        values_ver = tuple(versioning_data.values())
-        query_ver = f"INSERT INTO datapenal_versioning ({cols_ver}) VALUES ({placeholders_ver})"
-        cursor.execute(query_ver, values_ver)
-        connection.commit()
+        # Sin registro_ppu la versión se guarda completa
+        insertar_version(connection, versioning_data)
         logger.info("Registro agregado en datapenal_versioning para consulta")
     except Exception as e:
         logger.error("Error al insertar en datapenal_versioning: %s", e, exc_info=True)
         return jsonify({"error": "Error al insertar en datapenal_versioning"}), 500
-    finally:
-        cursor.close()
-        connection.close()
 
     return jsonify({"message": "Caso agregado y versioning registrado"}), 200
 
@@ -2560,10 +2510,12 @@ def get_registros_consulta():
         return jsonify({"error": "Error al conectar con la base de datos"}), 500
     try:
         cursor = connection.cursor(dictionary=True)
-        regex_pattern = r'^CONS-0*\d+-{}(?:-[A-Z]+)?$'.format(year)
+        if not year.isdigit():
+            return jsonify({"data": []})
         cursor.execute(
-            "SELECT consulta_ppu FROM consulta_ppupenal WHERE consulta_ppu REGEXP %s ORDER BY consulta_ppu ASC",
-            (regex_pattern,)
+            "SELECT consulta_ppu FROM consulta_ppupenal"
+            " WHERE ppu_tipo = 'CONS' AND ppu_anio = %s ORDER BY consulta_ppu ASC",
+            (int(year),)
         )
         registros = cursor.fetchall()
         registros_list = [reg['consulta_ppu'] for reg in registros]
@@ -2648,6 +2600,9 @@ def decision_coordinador():
             if not acumulacion_value:
                 return jsonify({"success": False, "message": "El valor para Acumulación es requerido."}), 400
 
+            # Las versiones de la consulta caen entre las del PPU: sus delta posteriores
+            # pasan a filas completas para no completarse con los valores de la consulta
+            fijar_versiones_posteriores(connection, acumulacion_value, consulta_ppu)
             update_queries = [
                 ("UPDATE datapenal SET registro_ppu = %s WHERE registro_ppu LIKE %s", 
                  (acumulacion_value, f"%{consulta_ppu}%")),
@@ -2657,6 +2612,9 @@ def decision_coordinador():
                  (acumulacion_value, consulta_ppu)),
                 ("UPDATE datapenal_plazos SET registro_ppu = %s WHERE consulta_ppu = %s", 
                  (acumulacion_value, consulta_ppu))
+            ] + [
+                (f"UPDATE {frio} SET registro_ppu = %s WHERE consulta_ppu = %s", (acumulacion_value, consulta_ppu))
+                for frio in ARCHIVO_TABLAS.values()
             ]
             for q, params in update_queries:
                 cursor.execute(q, params)
@@ -2687,56 +2645,35 @@ def decision_coordinador():
                 return jsonify({"success": False, "message": "Se requieren 'ingresoNuevoOption' y 'anio' para Ingreso Nuevo."}), 400
 
             anio = int(anio_str)
-            # Se define el prefijo y la expresión regular según la opción y el año.
+            # Se define el prefijo (y su ppu_tipo) según la opción y el año.
             if ingreso_option == "DENUNCIA":
-                prefix = "D-"
-                regex_pattern = r'^D-0*\d+-{}(?:-[A-Z]+)?$'.format(anio)
+                prefix, ppu_tipo = "D-", "D"
             elif ingreso_option == "LEGAJO":
                 if anio >= 2023:
-                    prefix = "L. "
-                    regex_pattern = r'^{}0*\d+-{}(?:-[A-Z]+)?$'.format(re.escape(prefix), anio)
+                    prefix, ppu_tipo = "L. ", "L"
                 else:
-                    prefix = "LEG-"
-                    regex_pattern = r'^{}0*\d+-{}(?:-[A-Z]+)?$'.format(re.escape(prefix), anio)
+                    prefix, ppu_tipo = "LEG-", "LEG"
             else:
                 return jsonify({"success": False, "message": "Opción de Ingreso Nuevo no válida."}), 400
 
-            # Se consulta la tabla datapenal para obtener los registros existentes que coincidan con el patrón.
-            cursor.execute("SELECT registro_ppu FROM datapenal WHERE registro_ppu REGEXP %s", (regex_pattern,))
-            registros = cursor.fetchall()
-            numeros = []
-            for reg in registros:
-                reg_val = reg['registro_ppu']
-                if ingreso_option == "LEGAJO":
-                    patron_num = r'^{}0*(\d+)-{}'.format(re.escape(prefix), anio)
-                else:
-                    patron_num = r'^D-0*(\d+)-{}'.format(anio)
-                match = re.match(patron_num, reg_val)
-                if match:
-                    numeros.append(int(match.group(1)))
-
-            if ingreso_option == "LEGAJO" and anio >= 2023:
-                if numeros:
-                    numeros.sort()
-                    for i in range(1, len(numeros)):
-                        if numeros[i] > numeros[i - 1] + 1:
-                            next_num = numeros[i - 1] + 1
-                            break
-                    else:
-                        next_num = max(numeros) + 1
-                else:
-                    next_num = 1
-            else:
-                next_num = max(numeros) + 1 if numeros else 1
+            # L: primer hueco libre; LEG y D: máximo + 1 (ver numeracion.SERIES)
+            try:
+                next_num = asignar_numero(ppu_tipo, anio, session.get('username'))
+            except NumeracionError as e:
+                return jsonify({"success": False, "message": str(e)}), 500
 
             max_length = len(str(next_num))
             new_registro = '{}{num:0{width}d}-{anio}'.format(prefix, num=next_num, width=max_length, anio=anio)
 
+            fijar_versiones_posteriores(connection, new_registro, consulta_ppu)
             # Se actualiza el registro_ppu en las tablas correspondientes, incluida consulta_ppupenal.
             update_queries = [
                 ("UPDATE consulta_ppupenal SET registro_ppu = %s WHERE consulta_ppu = %s", (new_registro, consulta_ppu)),
                 ("UPDATE datapenal_versioning SET registro_ppu = %s WHERE consulta_ppu = %s", (new_registro, consulta_ppu)),
                 ("UPDATE datapenal_plazos SET registro_ppu = %s WHERE consulta_ppu = %s", (new_registro, consulta_ppu))
+            ] + [
+                (f"UPDATE {frio} SET registro_ppu = %s WHERE consulta_ppu = %s", (new_registro, consulta_ppu))
+                for frio in ARCHIVO_TABLAS.values()
             ]
             for q, params in update_queries:
                 cursor.execute(q, params)
@@ -2760,6 +2697,7 @@ def decision_coordinador():
             cursor.execute(insert_query, values)
 
             connection.commit()
+            note_ppu_year(new_registro)
             return jsonify({"success": True, "message": f"Ingreso Nuevo ({ingreso_option}) completado.", "registro_ppu": new_registro}), 200
 
         else:
@@ -2795,98 +2733,7 @@ from flask import jsonify, request
 # Se asume que ya están definidos: get_db_connection, login_required, logger,
 # parse_query_ppu, generar_variantes_ppu, normalizar_expediente, etc.
 
-def build_legajo_regexp(query):
-    """
-    Construye un patrón REGEXP para buscar en el campo legajo según las siguientes reglas:
-    
-    - Se detecta si el query incluye un prefijo explícito ("D‑", "LEG‑", "L. " o "L.").
-      Si es "D‑", la búsqueda se restringe a los legajos D‑;  
-      si es "LEG‑" o "L." se permiten ambos formatos de forma intercambiable.
-      
-    - Se extrae el primer fragmento numérico (después del prefijo, hasta el primer guion).
-      Se convierte a entero para ignorar ceros a la izquierda.
-      
-    - Si el query termina en guion (por ejemplo, "20-") se genera un patrón que exige
-      que la parte numérica del legajo (después del prefijo) sea EXACTAMENTE la misma,
-      es decir, "20-" forzará un match sólo si el legajo presenta como número 20 (aceptando
-      variaciones como "20" o "020" siempre que al convertirlos a entero den 20), pero no "201".
-      
-    - Si el query no termina en guion (por ejemplo, "6" o "D-6"), se permite una comparación
-      flexible (que busque coincidencias cuyo número inicie con el dígito(s) indicado).
-      
-    - Se incorpora opcionalmente el fragmento del año: si se especifica con 4 dígitos se fuerza
-      la coincidencia exacta; si es menor a 4 dígitos se toma de forma "starts with".
-      
-    - Si el query es solamente el prefijo sin dígitos, se devuelve None para evitar búsquedas
-      demasiado amplias.
-    """
-    q = query.strip().upper()
-    # Detectar prefijo explícito (no se elimina si el usuario lo incluye, para restringir el grupo)
-    prefix_match = re.match(r'^(D-|LEG-|L\. ?)', q)
-    if prefix_match:
-        raw_prefix = prefix_match.group(1).strip()
-        if raw_prefix in ("LEG-", "L.", "L-"):
-            explicit_prefix = "LEG"  # Tratar LEG y L. como equivalentes
-        else:
-            explicit_prefix = "D"
-        remainder = q[len(prefix_match.group(1)):].strip()
-    else:
-        explicit_prefix = None
-        remainder = q
-
-    # Se exige que después (o en ausencia de prefijo) exista al menos un dígito;
-    # de lo contrario se rechaza la búsqueda.
-    if not re.match(r'^\d', remainder):
-        return None
-
-    # Si no aparece el guion, se asume que se quiere búsqueda flexible (se añade guion al final)
-    if '-' not in remainder:
-        remainder = remainder + "-"
-
-    parts = remainder.split("-", 1)
-    num_str = parts[0].strip()
-    if not num_str.isdigit():
-        return None
-    num_val = int(num_str)
-    # Flag exact: si el query termina en guion (sin contenido posterior al guion)
-    exact = remainder.endswith("-")
-    
-    # Construir patrón para la parte numérica:
-    if exact:
-        # Se fuerza que no haya dígitos adicionales (lookahead negativo)
-        num_pattern = rf'0*{num_val}(?!\d)'
-    else:
-        # Búsqueda flexible: el valor numérico debe empezar con el dígito(s)
-        num_pattern = rf'0*{num_val}'
-    
-    # Procesar el fragmento de año, si lo hubiera
-    year_pattern = ""
-    if "-" in remainder:
-        # Si hay contenido posterior al primer guion y no es vacío, se toma como año
-        second_part = parts[1].strip()
-        if second_part != "":
-            if len(second_part) == 4 and second_part.isdigit():
-                year_pattern = rf'-{second_part}\b'
-            else:
-                # Si la parte del año es menor a 4 dígitos, se usa de forma flexible (starts with)
-                year_pattern = rf'-{second_part}'
-        else:
-            # Si es exactamente "num-" (sin datos del año), exigimos el guion solamente para marcar final del número
-            year_pattern = "-"
-    else:
-        year_pattern = "-"
-    
-    # Construir el patrón para el prefijo:
-    if explicit_prefix == "D":
-        prefix_pattern = r'^D-'
-    elif explicit_prefix == "LEG":
-        prefix_pattern = r'^(?:LEG-|L\. ?)'
-    else:
-        prefix_pattern = r'^(?:D-|LEG-|L\. ?)'
-        
-    # Combinar todo
-    pattern = prefix_pattern + num_pattern + year_pattern
-    return pattern
+# build_legajo_regexp vive ahora en backend.core (junto a build_legajo_filter)
 
 
 
@@ -2978,12 +2825,7 @@ def impulso_upload():
         f.save(final_path)
 
     # ---------- Hash ----------
-    import hashlib
-    sha256 = hashlib.sha256()
-    with open(final_path, "rb") as pdf:
-        for chunk in iter(lambda: pdf.read(4096), b""):
-            sha256.update(chunk)
-    file_hash = sha256.hexdigest()
+    file_hash = sha256_file(final_path)
 
     # ---------- e_situacional automático ----------
     e_situacional_impulso = f"IMPULSO ({fecha_hoy}): {accion_valor}"
@@ -2995,23 +2837,18 @@ def impulso_upload():
     try:
         cur = conn.cursor()
 
-        # ---- datapenal_versioning ----
-        sql_versioning = """
-            INSERT INTO datapenal_versioning
-              (abogado, registro_ppu, denunciado, origen, `nr de exp completo`, delito,
-               informe_juridico, item, juzgado, fiscalia, departamento, e_situacional,
-               fecha_version, usuario_modificacion, fecha_e_situacional,
-               ruta, hash_sha, clasificacion, consulta_ppu)
-            VALUES
-              (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,
-               NOW(),%s,CURDATE(),%s,%s,'','')
-        """
-        cur.execute(
-            sql_versioning,
-            (abogado, registro_ppu, denunciado, origen, nr_de_exp_completo, delito,
-             informe_juridico, item, juzgado, fiscalia, departamento, e_situacional_impulso,
-             session.get("username",""), final_path, file_hash)
-        )
+        # ---- datapenal_versioning (solo las columnas que cambiaron) ----
+        ahora = datetime.now()
+        insertar_version(conn, {
+            "abogado": abogado, "registro_ppu": registro_ppu, "denunciado": denunciado,
+            "origen": origen, "nr de exp completo": nr_de_exp_completo, "delito": delito,
+            "informe_juridico": informe_juridico, "item": item, "juzgado": juzgado,
+            "fiscalia": fiscalia, "departamento": departamento,
+            "e_situacional": e_situacional_impulso,
+            "fecha_version": ahora, "usuario_modificacion": session.get("username", ""),
+            "fecha_e_situacional": ahora.date(),
+            "ruta": final_path, "hash_sha": file_hash, "clasificacion": "", "consulta_ppu": "",
+        })
 
         # ---- datapenal_plazos ----
         accion_impulso = f"IMPULSO - {accion_valor}"
@@ -3198,10 +3035,8 @@ import subprocess
 import tempfile
 from datetime import datetime, timedelta
 
-# 👉 Añade estos tres imports *antes* de cualquier función que use Alignment, Font, etc.
-import openpyxl
-from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
-from openpyxl.utils import get_column_letter
+# Reportes de plazos: xlsxwriter en modo constant_memory (ver escribir_datos_en_hoja)
+import xlsxwriter
 
 from flask import make_response  # asegúrate de tenerlo en tu bloque de imports
 import tempfile                 # idem
@@ -3267,73 +3102,81 @@ def _safe_value(v):
         return clean_string(v)
     return v
 
-def escribir_datos_en_hoja(ws, titulo, headers, filas,
+def _estilos_reporte(wb):
+    """Formatos compartidos por todas las celdas del reporte (uno por estilo, no por celda)."""
+    base = {"align": "center", "valign": "vcenter", "text_wrap": True, "border": 1}
+    return {
+        "titulo": wb.add_format({"align": "center", "valign": "vcenter", "bold": True}),
+        "encabezado": wb.add_format(dict(base, bold=True, bg_color="#4F81BD")),
+        "celda": wb.add_format(base),
+        "fecha": wb.add_format(dict(base, num_format="dd-mm-yyyy hh:mm")),
+    }
+
+def escribir_datos_en_hoja(ws, estilos, titulo, headers, filas,
                            start_row: int = 4, start_col: int = 2):
     """
-    Escribe título, encabezados y datos en la hoja `ws`, filtrando
-    **todas** las cadenas con `_safe_value` para evitar IllegalCharacterError.
+    Escribe título, encabezados y datos en la hoja `ws` (xlsxwriter, fila a fila),
+    filtrando **todas** las cadenas con `_safe_value`. Los anchos se calculan
+    mientras se escribe; filas/columnas son 1-based como en la versión openpyxl.
     """
     ncols = len(headers)
+    r0, c0 = start_row - 1, start_col - 1
+    anchos = [0] * ncols
+
+    def _medir(j, v):
+        if v:
+            anchos[j] = max(anchos[j], len(str(v)))
 
     # Título centrado
-    ws.merge_cells(start_row=3, start_column=start_col,
-                   end_row=3, end_column=start_col + ncols - 1)
-    c = ws.cell(row=3, column=start_col, value=_safe_value(titulo))
-    c.alignment = Alignment(horizontal="center", vertical="center")
-    c.font = Font(bold=True)
-
-    thin = Border(
-        left=Side(style='thin'), right=Side(style='thin'),
-        top=Side(style='thin'),  bottom=Side(style='thin')
-    )
+    titulo = _safe_value(titulo)
+    if ncols > 1:
+        ws.merge_range(2, c0, 2, c0 + ncols - 1, titulo, estilos["titulo"])
+    else:
+        ws.write(2, c0, titulo, estilos["titulo"])
+    _medir(0, titulo)
 
     # Encabezados
     for i, h in enumerate(headers):
-        ch = ws.cell(row=start_row, column=start_col + i, value=_safe_value(h))
-        ch.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        ch.font = Font(bold=True)
-        ch.fill = PatternFill("solid", fgColor="4F81BD")
-        ch.border = thin
-
+        h = _safe_value(h)
+        ws.write(r0, c0 + i, h, estilos["encabezado"])
+        _medir(i, h)
 
     # Datos
-    row_xl = start_row + 1
+    row_xl = r0 + 1
     for fila in filas:
         for j, v in enumerate(fila):
             # Detectar valores con formato "dd-mm-YYYY HH:MM"
             if isinstance(v, str) and re.match(r'^\d{2}-\d{2}-\d{4}\s+\d{2}:\d{2}$', v):
                 try:
-                    dt = datetime.strptime(v, "%d-%m-%Y %H:%M")
-                    cell = ws.cell(row=row_xl, column=start_col + j, value=dt)
-                    cell.number_format = "dd-mm-yyyy hh:mm"  # ← formato Excel real
+                    v = datetime.strptime(v, "%d-%m-%Y %H:%M")
                 except Exception:
-                    cell = ws.cell(row=row_xl, column=start_col + j, value=_safe_value(v))
+                    pass
+            v = _safe_value(v)
+            if v is None or v == "":
+                ws.write_blank(row_xl, c0 + j, None, estilos["celda"])
+            elif isinstance(v, datetime):
+                ws.write_datetime(row_xl, c0 + j, v, estilos["fecha"])  # ← formato Excel real
+            elif isinstance(v, str):
+                ws.write_string(row_xl, c0 + j, v, estilos["celda"])
             else:
-                cell = ws.cell(row=row_xl, column=start_col + j, value=_safe_value(v))
-
-            cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-            cell.border = thin
+                ws.write(row_xl, c0 + j, v, estilos["celda"])
+            _medir(j, v)
         row_xl += 1
 
-
     # Ajuste de anchos
     for i in range(ncols):
-        col_letter = get_column_letter(start_col + i)
-        max_len = max(
-            (len(str(cell.value)) for cell in ws[col_letter] if cell.value), default=0
-        )
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 30)
+        ws.set_column(c0 + i, c0 + i, min(anchos[i] + 2, 30))
 
 
 def generar_excel_global_modificado(registros, ruta_out):
     acciones, audiencias = partition_plazos(registros)
-    wb = openpyxl.Workbook()
-    wb.remove(wb.active)
+    wb = xlsxwriter.Workbook(ruta_out, {"constant_memory": True})
+    estilos = _estilos_reporte(wb)
 
     if acciones:
-        ws = wb.create_sheet("Acciones a tomar")
+        ws = wb.add_worksheet("Acciones a tomar")
         escribir_datos_en_hoja(
-            ws,
+            ws, estilos,
             "RENDICIÓN DE CUENTAS - ABOGADOS PENALES - GENERAL - ACCIONES A TOMAR",
             [
                 "Notificación", "ID", "Registro PPU", "Fecha de Recepción por Mesa de Partes",
@@ -3366,9 +3209,9 @@ def generar_excel_global_modificado(registros, ruta_out):
 
         audiencias.sort(key=parse_fecha_audiencia, reverse=True)
 
-        ws = wb.create_sheet("Audiencias")
+        ws = wb.add_worksheet("Audiencias")
         escribir_datos_en_hoja(
-            ws,
+            ws, estilos,
             "RENDICIÓN DE CUENTAS - ABOGADOS PENALES - GENERAL - AUDIENCIAS",
             [
                 "Notificación", "ID", "Registro PPU", "Fecha de Recepción por Mesa de Partes",
@@ -3384,7 +3227,36 @@ def generar_excel_global_modificado(registros, ruta_out):
                 ] for f in audiencias
             ]
         )
-    wb.save(ruta_out)
+    wb.close()
+
+
+def _enviar_reporte_plazos(registros, nombre, cache_key=None):
+    """
+    Envía el reporte desde la caché de exportaciones o lo genera en un archivo
+    temporal que pasa a la caché (sin clave, se borra al terminar el envío).
+    """
+    cached = send_cached_export(cache_key)
+    if cached is not None:
+        return cached
+    fd, ruta = tempfile.mkstemp(prefix="penal_plazos_", suffix=".xlsx")
+    os.close(fd)
+    try:
+        generar_excel_global_modificado(registros, ruta)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return cache_and_send(cache_key, ruta, nombre)
+
+
+def _clave_reporte_plazos(reporte, abogado, version, registros):
+    """
+    Los registros incluidos dependen de la hora (qué plazos ya vencieron): la clave
+    lleva sus ids además de la versión de datos, que fija el resto del contenido.
+    """
+    return export_cache_key(reporte, {
+        "abogado": abogado,
+        "ids": sorted(f["id"] for f in registros),
+    }, version)
 from flask import send_file, after_this_request
 
 
@@ -3402,6 +3274,7 @@ def descargar_excel_no_vencidos():
     if conn is None:
         return jsonify(error="Error BD"), 500
     try:
+        version = data_version(conn, ["datapenal", "datapenal_plazos"])
         cur = conn.cursor(dictionary=True)
         sql = """
             SELECT dp.*, d.abogado, d.fiscalia, d.origen
@@ -3411,7 +3284,7 @@ def descargar_excel_no_vencidos():
         """
         params = []
         if abogado:
-            sql += " AND UPPER(TRIM(SUBSTRING_INDEX(d.abogado,';',-1))) = %s"
+            sql += " AND d.abogado_key = %s"
             params.append(abogado)
         cur.execute(sql, params)
         filas = cur.fetchall()
@@ -3446,17 +3319,10 @@ def descargar_excel_no_vencidos():
     if not vivos:
         return jsonify(error="Sin registros no vencidos"), 404
 
-    # -------- 3. generar Excel en memoria ----------
-    buf = BytesIO()
-    generar_excel_global_modificado(vivos, buf)   # tu helper debe aceptar file-like
-    buf.seek(0)                                   # <- muy importante
-
-    # NO cierres buf: déjalo vivo
-    return send_file(
-        buf,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        as_attachment=True,
-        download_name="Plazos_NO_Vencidos.xlsx"
+    # -------- 3. generar Excel en disco y enviarlo por trozos ----------
+    return _enviar_reporte_plazos(
+        vivos, "Plazos_NO_Vencidos.xlsx",
+        _clave_reporte_plazos("plazos_no_vencidos", abogado, version, vivos),
     )
 
 
@@ -3479,6 +3345,7 @@ def descargar_excel_vencidos():
         return jsonify(error="Error BD"), 500
 
     try:
+        version = data_version(conn, ["datapenal", "datapenal_plazos"])
         cur = conn.cursor(dictionary=True)
         sql = (
             "SELECT dp.*, d.abogado, d.fiscalia, d.origen "
@@ -3488,7 +3355,7 @@ def descargar_excel_vencidos():
         )
         params = []
         if abogado:
-            sql += " AND UPPER(TRIM(SUBSTRING_INDEX(d.abogado,';',-1))) = %s"
+            sql += " AND d.abogado_key = %s"
             params.append(abogado)
         cur.execute(sql, params)
         filas = cur.fetchall()
@@ -3533,17 +3400,10 @@ def descargar_excel_vencidos():
     if not vencidos:
         return jsonify(error="Sin registros vencidos"), 404
 
-    # ─ 3. GENERAR EXCEL EN MEMORIA ──────────────────────────────
-    buf = BytesIO()
-    generar_excel_global_modificado(vencidos, buf)   # tu helper acepta file-like
-    buf.seek(0)
-
-    # ─ 4. RESPUESTA ─────────────────────────────────────────────
-    return send_file(
-        buf,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        as_attachment=True,
-        download_name="Plazos_VENCIDOS.xlsx",
+    # ─ 3. GENERAR EXCEL EN DISCO Y RESPONDER ────────────────────
+    return _enviar_reporte_plazos(
+        vencidos, "Plazos_VENCIDOS.xlsx",
+        _clave_reporte_plazos("plazos_vencidos", abogado, version, vencidos),
     )
 
 # -------------------------------------------------------------------- #
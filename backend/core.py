@@ -3,14 +3,23 @@ from __future__ import annotations
 
 import os
 import re
+import time
+import difflib
+import sqlite3
+import hashlib
 import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from typing import List, Set, Tuple, Optional
+from typing import Dict, List, Sequence, Set, Tuple, Optional
 
 import mysql.connector
+from mysql.connector import pooling
 import unidecode
 import pdfplumber
-from flask import jsonify, session
+from flask import g, has_request_context, jsonify, session
 
 logger = logging.getLogger(__name__)
 
@@ -20,20 +29,458 @@ ALLOWED_EXTENSIONS = {"pdf"}
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# ---- Conexiones MySQL (un pool por esquema) ----
+DEFAULT_DATABASE = "datappupenal"
+
+_DB_PARAMS = {
+    "host": "localhost",
+    "user": "root",
+    "password": "Manuel22",
+    "charset": "utf8mb4",
+}
+
+# Tamaño de cada pool (mysql.connector admite hasta 32 por pool)
+DB_POOL_SIZES = {
+    "datappupenal": int(os.environ.get("PENAL_DB_POOL_SIZE", "8")),
+    "monitoreo_descargas_sinoe": int(os.environ.get("PENAL_DB_POOL_SIZE_SINOE", "3")),
+}
+DB_POOL_DEFAULT_SIZE = 4
+# Segundos que se espera una conexión libre antes de abrir una conexión extra (sin pool)
+DB_POOL_TIMEOUT = float(os.environ.get("PENAL_DB_POOL_TIMEOUT", "5"))
+
+_pools: Dict[str, pooling.MySQLConnectionPool] = {}
+_pools_lock = threading.Lock()
+_pool_stats: Dict[str, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+_session_init: Dict[str, List[str]] = {}
+
+
+def register_session_init(database: str, statement: str) -> None:
+    """
+    Registra una sentencia que se ejecuta en cada checkout de conexión del
+    esquema indicado (el pool resetea la sesión al devolverla).
+    """
+    hooks = _session_init.setdefault(database, [])
+    if statement not in hooks:
+        hooks.append(statement)
+
+
+# Alinea el NOW() de los triggers con la hora de Lima (UTC-5)
+register_session_init("datappupenal", "SET time_zone = '-05:00'")
+
+
+def _count(database: str, key: str, amount: float = 1) -> None:
+    with _stats_lock:
+        st = _pool_stats.setdefault(database, {
+            "checkouts": 0, "overflow": 0, "waits": 0, "wait_ms": 0.0,
+            "health_failures": 0, "errors": 0,
+        })
+        st[key] += amount
+
+
+def _pool_key(database: str, paralelo: bool) -> str:
+    return f"{database}/paralelo" if paralelo else database
+
+
+def _get_pool(database: str, paralelo: bool = False) -> pooling.MySQLConnectionPool:
+    key = _pool_key(database, paralelo)
+    pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if paralelo:
+                size = PARALLEL_QUERY_WORKERS
+            else:
+                size = DB_POOL_SIZES.get(database, DB_POOL_DEFAULT_SIZE)
+            pool = pooling.MySQLConnectionPool(
+                pool_name=f"penal_{database}" + ("_paralelo" if paralelo else ""),
+                pool_size=max(1, min(size, pooling.CNX_POOL_MAXSIZE)),
+                pool_reset_session=True,
+                database=database,
+                **_DB_PARAMS,
+            )
+            _pools[key] = pool
+            logger.info("Pool MySQL '%s' creado (size=%d)", key, pool.pool_size)
+    return pool
+
+
+def _checkout(database: str, paralelo: bool = False):
+    """
+    Toma una conexión del pool. El pool hace ping (y reconecta) en cada checkout;
+    si está agotado se espera hasta DB_POOL_TIMEOUT y luego se abre una conexión
+    directa para no bloquear la petición.
+    """
+    key = _pool_key(database, paralelo)
+    pool = _get_pool(database, paralelo)
+    start = time.monotonic()
+    waited = False
+    while True:
+        try:
+            cnx = pool.get_connection()
+            if waited:
+                _count(key, "wait_ms", (time.monotonic() - start) * 1000)
+            return cnx
+        except pooling.PoolError:
+            if not waited:
+                waited = True
+                _count(key, "waits")
+            if time.monotonic() - start >= DB_POOL_TIMEOUT:
+                _count(key, "wait_ms", (time.monotonic() - start) * 1000)
+                break
+            time.sleep(0.02)
+        except mysql.connector.InterfaceError:
+            _count(key, "health_failures")
+            break
+    _count(key, "overflow")
+    logger.warning("Pool '%s' sin conexiones disponibles; se abre conexión directa", key)
+    return mysql.connector.connect(database=database, **_DB_PARAMS)
+
+
 def get_db_connection(database: Optional[str] = None):
+    """
+    Devuelve una conexión del pool del esquema (`close()` la devuelve al pool)
+    o None si no se pudo conectar.
+    """
+    if database is None:
+        database = DEFAULT_DATABASE
+    return _connect(database, paralelo=False)
+
+
+def _connect(database: str, paralelo: bool):
+    key = _pool_key(database, paralelo)
     try:
-        if database is None:
-            database = "datappupenal"
-        return mysql.connector.connect(
-            host="localhost",
-            database=database,
-            user="root",
-            password="Manuel22",
-            charset="utf8mb4",
-        )
+        cnx = _checkout(database, paralelo)
     except mysql.connector.Error as err:
+        _count(key, "errors")
         logger.error("Error al conectar a MySQL: %s", err)
         return None
+    _count(key, "checkouts")
+
+    hooks = _session_init.get(database)
+    if hooks:
+        cur = cnx.cursor()
+        try:
+            for stmt in hooks:
+                try:
+                    cur.execute(stmt)
+                except mysql.connector.Error as err:
+                    logger.warning("No se pudo aplicar '%s' en la sesión: %s", stmt, err)
+        finally:
+            cur.close()
+    return cnx
+
+
+def get_pool_stats() -> Dict[str, dict]:
+    """Estado de cada pool: tamaño, conexiones libres/en uso y contadores."""
+    out = {}
+    with _stats_lock:
+        snapshot = {db: dict(st) for db, st in _pool_stats.items()}
+    for database in set(snapshot) | set(_pools):
+        st = snapshot.get(database, {})
+        pool = _pools.get(database)
+        size = pool.pool_size if pool is not None else 0
+        try:
+            idle = pool._cnx_queue.qsize() if pool is not None else 0
+        except Exception:
+            idle = 0
+        st.update({"size": size, "idle": idle, "in_use": max(size - idle, 0)})
+        st["wait_ms"] = round(st.get("wait_ms", 0.0), 1)
+        out[database] = st
+    return out
+
+# ---- Unidad de trabajo por request (flask.g) ----
+def get_request_db(database: Optional[str] = None):
+    """
+    Conexión compartida por todo el código de la request actual. Se obtiene del
+    pool en el primer uso y se confirma (o revierte) una sola vez al final de la
+    request: no llamar commit()/close() sobre ella. Requiere init_request_db(app).
+    """
+    if database is None:
+        database = DEFAULT_DATABASE
+    conns = g.setdefault("_penal_db", {})
+    cnx = conns.get(database)
+    if cnx is None:
+        cnx = get_db_connection(database)
+        if cnx is not None:
+            conns[database] = cnx
+    return cnx
+
+
+def rollback_request_db() -> None:
+    """Fuerza que la transacción de la request se revierta aunque la respuesta sea 2xx."""
+    g._penal_db_rollback = True
+
+
+def after_request_commit(callback) -> None:
+    """
+    Ejecuta `callback()` cuando la request termine con la transacción confirmada
+    (no se llama si se revierte). Fuera de una request se ejecuta en el acto.
+    """
+    if has_request_context():
+        g.setdefault("_penal_db_after_commit", []).append(callback)
+    else:
+        callback()
+
+
+def _run_after_commit() -> None:
+    for callback in g.pop("_penal_db_after_commit", []):
+        try:
+            callback()
+        except Exception:
+            logger.exception("Error en callback posterior al commit")
+
+
+def _commit_request_db(response):
+    conns = g.get("_penal_db")
+    ok = response.status_code < 400 and not g.get("_penal_db_rollback", False)
+    if not conns:
+        if ok:
+            _run_after_commit()
+        return response
+    try:
+        for database, cnx in conns.items():
+            if not getattr(cnx, "in_transaction", True):
+                continue
+            if ok:
+                cnx.commit()
+            else:
+                cnx.rollback()
+    except mysql.connector.Error as err:
+        logger.error("Error al confirmar la transacción de la request (%s): %s", database, err)
+        for cnx in conns.values():
+            try:
+                cnx.rollback()
+            except Exception:
+                pass
+        response = jsonify({"error": "Error al confirmar la transacción"})
+        response.status_code = 500
+        ok = False
+    g._penal_db_done = True
+    if ok:
+        _run_after_commit()
+    return response
+
+
+def _release_request_db(exc=None) -> None:
+    conns = g.pop("_penal_db", None)
+    if not conns:
+        return
+    pending = exc is not None or not g.get("_penal_db_done", False)
+    for cnx in conns.values():
+        try:
+            if pending:
+                cnx.rollback()
+        except Exception:
+            pass
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+
+def init_request_db(app) -> None:
+    """
+    Registra los hooks de la unidad de trabajo: el commit/rollback va en
+    after_request (un fallo del COMMIT todavía llega al cliente como 500) y la
+    devolución al pool en teardown_request, que también revierte si la request
+    terminó con una excepción.
+    """
+    app.after_request(_commit_request_db)
+    app.teardown_request(_release_request_db)
+
+# ---- Consultas de lectura en paralelo ----
+# Hilos compartidos por todas las requests. Cada consulta toma su conexión de un
+# pool propio ("<base>/paralelo") del mismo tamaño que los hilos, así el reparto no
+# agota el pool de las requests ni espera conexiones que él mismo retiene.
+PARALLEL_QUERY_WORKERS = int(os.environ.get("PENAL_PARALLEL_QUERY_WORKERS", "6"))
+
+_parallel_executor: Optional[ThreadPoolExecutor] = None
+_parallel_lock = threading.Lock()
+
+
+def _get_parallel_executor() -> ThreadPoolExecutor:
+    global _parallel_executor
+    if _parallel_executor is None:
+        with _parallel_lock:
+            if _parallel_executor is None:
+                _parallel_executor = ThreadPoolExecutor(
+                    max_workers=PARALLEL_QUERY_WORKERS, thread_name_prefix="penal_query"
+                )
+    return _parallel_executor
+
+
+def _run_read_query(database: str, sql: str, params, dictionary: bool) -> list:
+    cnx = _connect(database, paralelo=True)
+    if cnx is None:
+        raise mysql.connector.InterfaceError(msg=f"Sin conexión a '{database}'")
+    cur = cnx.cursor(dictionary=dictionary)
+    try:
+        cur.execute(sql, params or ())
+        return cur.fetchall()
+    finally:
+        cur.close()
+        cnx.close()
+
+
+def run_parallel_queries(
+    queries: Sequence[Tuple[str, Sequence]],
+    database: Optional[str] = None,
+    dictionary: bool = True,
+) -> List[list]:
+    """
+    Ejecuta consultas de lectura independientes [(sql, params), ...] a la vez, cada
+    una en su conexión del pool paralelo, y devuelve sus filas (fetchall) en el mismo orden.
+    Si alguna falla se propaga su excepción.
+
+    Las conexiones no son las de get_request_db(): no ven escrituras de la request
+    aún sin confirmar, así que solo sirve para lecturas que no dependen de ellas.
+    """
+    database = database or DEFAULT_DATABASE
+    if len(queries) <= 1:
+        return [_run_read_query(database, sql, params, dictionary) for sql, params in queries]
+    executor = _get_parallel_executor()
+    futures = [
+        executor.submit(_run_read_query, database, sql, params, dictionary)
+        for sql, params in queries
+    ]
+    return [f.result() for f in futures]
+
+# ---- Esquema: migraciones idempotentes ----
+# Cada módulo registra sus cambios de esquema al importarse; apply_schema_migrations()
+# los aplica una sola vez por base y deja constancia en penal_schema_migrations.
+_schema_migrations: List[Tuple[str, str, List[str]]] = []
+
+# Errores "ya existe"/"no existe" que se ignoran al reintentar una migración a medias
+_DDL_IGNORABLE = {1050, 1060, 1061, 1091, 1359, 1826}
+
+
+def register_schema_migration(migration_id: str, statements: List[str],
+                              database: Optional[str] = None) -> None:
+    """Registra una migración (lista de sentencias DDL) identificada por `migration_id`."""
+    database = database or DEFAULT_DATABASE
+    if any(m[1] == migration_id and m[0] == database for m in _schema_migrations):
+        return
+    _schema_migrations.append((database, migration_id, list(statements)))
+
+
+def apply_schema_migrations(database: Optional[str] = None) -> List[str]:
+    """
+    Aplica las migraciones registradas que aún no constan como aplicadas.
+    Devuelve los ids aplicados en esta llamada.
+    """
+    database = database or DEFAULT_DATABASE
+    pending = [m for m in _schema_migrations if m[0] == database]
+    if not pending:
+        return []
+    cnx = get_db_connection(database)
+    if cnx is None:
+        logger.error("No se pudieron aplicar migraciones de '%s': sin conexión", database)
+        return []
+    applied = []
+    cur = cnx.cursor()
+    try:
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS penal_schema_migrations ("
+            " id VARCHAR(100) PRIMARY KEY,"
+            " applied_at DATETIME NOT NULL"
+            ")"
+        )
+        cur.execute("SELECT id FROM penal_schema_migrations")
+        done = {r[0] for r in cur.fetchall()}
+        for _db, migration_id, statements in pending:
+            if migration_id in done:
+                continue
+            logger.info("Aplicando migración %s en %s", migration_id, database)
+            for stmt in statements:
+                try:
+                    cur.execute(stmt)
+                except mysql.connector.Error as err:
+                    if err.errno in _DDL_IGNORABLE:
+                        logger.debug("Migración %s: se ignora (%s)", migration_id, err)
+                        continue
+                    raise
+            cur.execute(
+                "INSERT INTO penal_schema_migrations (id, applied_at) VALUES (%s, NOW())",
+                (migration_id,),
+            )
+            cnx.commit()
+            applied.append(migration_id)
+    except mysql.connector.Error as err:
+        logger.error("Error al aplicar migraciones de '%s': %s", database, err)
+    finally:
+        cur.close()
+        cnx.close()
+    return applied
+
+# ---- Caché de años de registro_ppu (/api/years) ----
+# La lista solo cambia cuando entra el primer PPU de un año nuevo: las altas llaman a
+# note_ppu_year() y la caché se invalida tras su commit. El TTL cubre las escrituras
+# hechas por otros procesos.
+PPU_YEARS_TTL = float(os.environ.get("PENAL_PPU_YEARS_TTL", "600"))
+
+_ppu_years: Optional[Tuple[List[str], str, float]] = None  # (años, etag, cargado)
+_ppu_years_gen = 0  # sube en cada invalidación: una carga ya iniciada no se guarda
+_ppu_years_lock = threading.Lock()
+
+
+def _load_ppu_years() -> Optional[List[str]]:
+    cnx = get_db_connection()
+    if cnx is None:
+        return None
+    cur = cnx.cursor()
+    try:
+        # Recorrido del índice idx_ppu_anio (sin evaluar registro_ppu fila a fila)
+        cur.execute(
+            "SELECT DISTINCT ppu_anio FROM datapenal"
+            " WHERE ppu_anio IS NOT NULL ORDER BY ppu_anio DESC"
+        )
+        return [str(r[0]) for r in cur.fetchall()]
+    finally:
+        cur.close()
+        cnx.close()
+
+
+def get_ppu_years() -> Optional[Tuple[List[str], str]]:
+    """
+    (años de mayor a menor, ETag) desde la caché, recargándola si caducó o se
+    invalidó. None si no hay conexión.
+    """
+    global _ppu_years
+    cached = _ppu_years
+    if cached is not None and time.monotonic() - cached[2] < PPU_YEARS_TTL:
+        return cached[0], cached[1]
+    with _ppu_years_lock:
+        cached = _ppu_years
+        if cached is not None and time.monotonic() - cached[2] < PPU_YEARS_TTL:
+            return cached[0], cached[1]
+        gen = _ppu_years_gen
+        years = _load_ppu_years()
+        if years is None:
+            return None
+        etag = hashlib.sha1(",".join(years).encode("ascii")).hexdigest()[:16]
+        if gen == _ppu_years_gen:
+            _ppu_years = (years, etag, time.monotonic())
+        return years, etag
+
+
+def invalidate_ppu_years() -> None:
+    global _ppu_years, _ppu_years_gen
+    _ppu_years_gen += 1
+    _ppu_years = None
+
+
+def note_ppu_year(registro_ppu: str) -> None:
+    """
+    Avisa de un alta en datapenal con `registro_ppu`: si su año no está en la caché,
+    ésta se invalida cuando la request confirme la transacción.
+    """
+    year = parse_ppu(registro_ppu)[1]
+    cached = _ppu_years
+    if cached is not None and year and str(year) in cached[0]:
+        return
+    after_request_commit(invalidate_ppu_years)
 
 # ---- Normalización/búsqueda ----
 def normalize_text(text: str) -> str:
@@ -48,6 +495,204 @@ def query_to_regexp(query: str) -> str:
     def repl(m): return f"0*{m.group(0)}"
     return re.sub(r"\d+", repl, escaped)
 
+# ---- Índice invertido para la búsqueda global (FULLTEXT ngram) ----
+# datapenal_busqueda guarda, por id, el texto normalizado de las columnas del buscador
+# global. Los triggers encolan los ids modificados en datapenal_busqueda_pendiente y
+# un hilo en segundo plano (iniciar_sincronizacion_texto) vacía la cola, incluida la
+# carga inicial; las búsquedas no sincronizan. El índice solo reduce candidatos: los
+# endpoints conservan su LIKE/REGEXP original sobre esas filas, y los ids aún en cola
+# siempre son candidatos.
+TEXT_SEARCH_COLUMNS = [
+    "abogado", "denunciado", "origen", "delito", "departamento", "fiscalia",
+    "informe_juridico", "item", "e_situacional", "registro_ppu", "juzgado", "etiqueta",
+]
+TEXT_INDEX_SYNC_BATCH = 2000
+# Segundos entre comprobaciones de la cola cuando está vacía
+TEXT_INDEX_SYNC_INTERVAL = float(os.environ.get("PENAL_TEXT_INDEX_INTERVAL", "5"))
+_text_index_sync_lock = threading.Lock()
+_text_index_programado = threading.Event()
+
+
+def _text_index_trigger(event: str, ref: str) -> str:
+    return (
+        f"CREATE TRIGGER trg_datapenal_busqueda_{event[0].lower()} AFTER {event} ON datapenal"
+        f" FOR EACH ROW INSERT INTO datapenal_busqueda_pendiente (id, ver) VALUES ({ref}.id, 1)"
+        " ON DUPLICATE KEY UPDATE ver = ver + 1"
+    )
+
+
+register_schema_migration("0002_datapenal_busqueda", [
+    "CREATE TABLE IF NOT EXISTS datapenal_busqueda ("
+    " id BIGINT PRIMARY KEY,"
+    " texto MEDIUMTEXT NOT NULL"
+    ") DEFAULT CHARSET=utf8mb4",
+    # Sin stopwords: con bigramas "de", "la", "en"... no deben descartarse
+    "SET SESSION innodb_ft_enable_stopword = OFF",
+    "ALTER TABLE datapenal_busqueda ADD FULLTEXT INDEX ft_texto (texto) WITH PARSER ngram",
+    "CREATE TABLE IF NOT EXISTS datapenal_busqueda_pendiente ("
+    " id BIGINT PRIMARY KEY,"
+    " ver INT UNSIGNED NOT NULL DEFAULT 1"
+    ")",
+    _text_index_trigger("INSERT", "NEW"),
+    _text_index_trigger("UPDATE", "NEW"),
+    _text_index_trigger("DELETE", "OLD"),
+    # Carga inicial: todo entra por la cola
+    "INSERT IGNORE INTO datapenal_busqueda_pendiente (id) SELECT id FROM datapenal",
+])
+
+
+def _text_index_runs(text: str) -> List[str]:
+    """Secuencias de letras y de dígitos de normalize_text; los dígitos sin ceros a la izquierda."""
+    out = []
+    for run in re.findall(r"[a-z]+|[0-9]+", normalize_text(text)):
+        if run.isdigit():
+            run = run.lstrip("0") or "0"
+        out.append(run)
+    return out
+
+
+def text_index_document(row: dict) -> str:
+    """Texto indexado de una fila de datapenal (columnas de TEXT_SEARCH_COLUMNS)."""
+    parts = []
+    for col in TEXT_SEARCH_COLUMNS:
+        val = row.get(col)
+        if val not in (None, ""):
+            parts.extend(_text_index_runs(str(val)))
+    return " ".join(parts)
+
+
+def text_index_query(query: str) -> Optional[str]:
+    """
+    Expresión BOOLEAN MODE para `query`: cada secuencia de 2+ caracteres es obligatoria.
+    Con el mismo tratamiento de ceros que query_to_regexp ("0*12" -> "12") el resultado
+    es un superconjunto de las filas que casan con el LIKE/REGEXP original.
+    None si no queda ningún término útil (o hay comodines de LIKE).
+    """
+    if not query or "%" in query or "_" in query:
+        return None
+    terms = [t for t in _text_index_runs(query) if len(t) >= 2]
+    if not terms:
+        return None
+    return " ".join(f"+{t}" for t in dict.fromkeys(terms))
+
+
+def sync_text_index(max_rows: int = TEXT_INDEX_SYNC_BATCH) -> bool:
+    """
+    Procesa hasta `max_rows` ids pendientes. Devuelve True si la cola quedó vacía
+    (el índice refleja datapenal). Si otro hilo o proceso ya está sincronizando
+    devuelve False.
+    """
+    if not _text_index_sync_lock.acquire(blocking=False):
+        return False
+    cnx = None
+    cur = None
+    bloqueado = False
+    try:
+        cnx = get_db_connection()
+        if cnx is None:
+            return False
+        cur = cnx.cursor(dictionary=True)
+        # Un único sincronizador entre procesos (varios workers comparten la base)
+        cur.execute("SELECT GET_LOCK('penal_text_index', 0) AS ok")
+        bloqueado = (cur.fetchone() or {}).get("ok") == 1
+        if not bloqueado:
+            return False
+        cur.execute("SELECT id, ver FROM datapenal_busqueda_pendiente LIMIT %s", (max_rows + 1,))
+        pending = cur.fetchall()
+        if not pending:
+            return True
+        batch = pending[:max_rows]
+        ids = [p["id"] for p in batch]
+        cols = ", ".join(f"`{c}`" for c in TEXT_SEARCH_COLUMNS)
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur.execute(f"SELECT id, {cols} FROM datapenal WHERE id IN ({placeholders})", ids)
+        found = {r["id"]: r for r in cur.fetchall()}
+
+        docs = [(i, text_index_document(found[i])) for i in ids if i in found]
+        gone = [(i,) for i in ids if i not in found]
+        if docs:
+            cur.executemany("REPLACE INTO datapenal_busqueda (id, texto) VALUES (%s, %s)", docs)
+        if gone:
+            cur.executemany("DELETE FROM datapenal_busqueda WHERE id = %s", gone)
+        # Solo se desencola la versión procesada: un cambio concurrente la incrementa
+        cur.executemany(
+            "DELETE FROM datapenal_busqueda_pendiente WHERE id = %s AND ver = %s",
+            [(p["id"], p["ver"]) for p in batch],
+        )
+        cnx.commit()
+        if len(pending) > max_rows:
+            return False
+        cur.execute("SELECT 1 FROM datapenal_busqueda_pendiente LIMIT 1")
+        return cur.fetchone() is None
+    except mysql.connector.Error as err:
+        logger.warning("No se pudo sincronizar datapenal_busqueda: %s", err)
+        try:
+            cnx.rollback()
+        except Exception:
+            pass
+        return False
+    finally:
+        if cur is not None:
+            if bloqueado:
+                try:
+                    cur.execute("SELECT RELEASE_LOCK('penal_text_index')")
+                    cur.fetchall()
+                except mysql.connector.Error:
+                    pass
+            cur.close()
+        if cnx is not None:
+            cnx.close()
+        _text_index_sync_lock.release()
+
+
+def iniciar_sincronizacion_texto() -> None:
+    """Hilo en segundo plano que mantiene datapenal_busqueda al día (y hace la carga inicial)."""
+    if _text_index_programado.is_set():
+        return
+    _text_index_programado.set()
+
+    def _bucle():
+        while True:
+            try:
+                vacia = sync_text_index()
+            except Exception:
+                logger.exception("Error al sincronizar datapenal_busqueda")
+                vacia = True
+            if vacia:
+                time.sleep(TEXT_INDEX_SYNC_INTERVAL)
+
+    threading.Thread(target=_bucle, name="penal-text-index", daemon=True).start()
+
+
+def text_index_filter(connection, query: str, alias: str = "") -> Optional[Tuple[str, list]]:
+    """
+    Condición para añadir al WHERE existente que limita las filas a los candidatos
+    de `query` en datapenal_busqueda (subconsulta sobre el FULLTEXT, sin listas de
+    ids), más los ids aún en cola de sincronización. None si la consulta no da
+    términos útiles o el índice no existe: se sigue con el recorrido completo.
+    """
+    expr = text_index_query(query)
+    if expr is None:
+        return None
+    col = f"{alias}.id" if alias else "id"
+    cur = connection.cursor()
+    try:
+        cur.execute("SELECT 1 FROM datapenal_busqueda_pendiente LIMIT 1")
+        dirty = cur.fetchone() is not None
+    except mysql.connector.Error as err:
+        logger.warning("Índice de búsqueda no disponible (%s); se recorre la tabla", err)
+        return None
+    finally:
+        cur.close()
+    cond = (
+        f"{col} IN (SELECT b.id FROM datapenal_busqueda b"
+        " WHERE MATCH(b.texto) AGAINST (%s IN BOOLEAN MODE))"
+    )
+    if dirty:
+        # Filas cambiadas aún sin indexar: candidatas hasta que el hilo las procese
+        cond = f"({cond} OR {col} IN (SELECT p.id FROM datapenal_busqueda_pendiente p))"
+    return cond, [expr]
+
 # ---- PPU helpers ----
 def parse_ppu(ppu_str: str) -> Tuple[int, int, int, str]:
     p = (ppu_str or "").upper().strip()
@@ -85,6 +730,241 @@ def generar_variantes_ppu(parsed: dict) -> List[str]:
             out.append(f"{prefix}{num}-{parsed['year']}{parsed['suffix']}")
     return out
 
+# ---- Columnas PPU descompuestas (generadas e indexadas) ----
+# ppu_tipo:   D | LEG | L | CONS | X   (prefijo del registro)
+# ppu_numero: primer bloque numérico  (sin ceros a la izquierda)
+# ppu_anio:   segundo bloque numérico
+# ppu_sufijo: letras finales tras el último guion ('' si no hay)
+# Son INVISIBLE: no aparecen en SELECT * (respuestas JSON y exportaciones no cambian).
+PPU_TIPOS_LEGAJO = ("LEG", "L")
+PPU_TIPOS_BUSQUEDA = ("D", "LEG", "L")
+
+
+def _ppu_generated_columns(table: str, column: str) -> List[str]:
+    return [
+        f"ALTER TABLE {table} ADD COLUMN ppu_tipo VARCHAR(4) AS (CASE"
+        f" WHEN {column} REGEXP '^D-' THEN 'D'"
+        f" WHEN {column} REGEXP '^LEG-' THEN 'LEG'"
+        f" WHEN {column} REGEXP '^L[.]' THEN 'L'"
+        f" WHEN {column} REGEXP '^CONS-' THEN 'CONS'"
+        f" ELSE 'X' END) STORED INVISIBLE",
+        f"ALTER TABLE {table} ADD COLUMN ppu_numero INT UNSIGNED AS"
+        f" (CAST(LEFT(REGEXP_SUBSTR({column}, '[0-9]+'), 9) AS UNSIGNED)) STORED INVISIBLE",
+        f"ALTER TABLE {table} ADD COLUMN ppu_anio INT UNSIGNED AS"
+        f" (CAST(LEFT(REGEXP_SUBSTR({column}, '[0-9]+', 1, 2), 9) AS UNSIGNED)) STORED INVISIBLE",
+        f"ALTER TABLE {table} ADD COLUMN ppu_sufijo VARCHAR(8) AS"
+        f" (UPPER(COALESCE(SUBSTRING(REGEXP_SUBSTR({column}, '-[A-Z]+$'), 2, 8), ''))) STORED INVISIBLE",
+        f"ALTER TABLE {table} ADD INDEX idx_ppu_tipo_anio (ppu_tipo, ppu_anio, ppu_numero, ppu_sufijo)",
+        f"ALTER TABLE {table} ADD INDEX idx_ppu_anio (ppu_anio, ppu_tipo, ppu_numero)",
+        f"ALTER TABLE {table} ADD INDEX idx_ppu_numero (ppu_numero, ppu_tipo, ppu_anio)",
+    ]
+
+
+register_schema_migration(
+    "0001_ppu_columnas",
+    _ppu_generated_columns("datapenal", "registro_ppu")
+    + _ppu_generated_columns("consulta_ppupenal", "consulta_ppu"),
+)
+
+
+def build_legajo_regexp(query):
+    """
+    Construye un patrón REGEXP para buscar en el campo legajo según las siguientes reglas:
+
+    - Se detecta si el query incluye un prefijo explícito ("D‑", "LEG‑", "L. " o "L.").
+      Si es "D‑", la búsqueda se restringe a los legajos D‑;
+      si es "LEG‑" o "L." se permiten ambos formatos de forma intercambiable.
+
+    - Se extrae el primer fragmento numérico (después del prefijo, hasta el primer guion).
+      Se convierte a entero para ignorar ceros a la izquierda.
+
+    - Si el query termina en guion (por ejemplo, "20-") se genera un patrón que exige
+      que la parte numérica del legajo (después del prefijo) sea EXACTAMENTE la misma,
+      es decir, "20-" forzará un match sólo si el legajo presenta como número 20 (aceptando
+      variaciones como "20" o "020" siempre que al convertirlos a entero den 20), pero no "201".
+
+    - Si el query no termina en guion (por ejemplo, "6" o "D-6"), se permite una comparación
+      flexible (que busque coincidencias cuyo número inicie con el dígito(s) indicado).
+
+    - Se incorpora opcionalmente el fragmento del año: si se especifica con 4 dígitos se fuerza
+      la coincidencia exacta; si es menor a 4 dígitos se toma de forma "starts with".
+
+    - Si el query es solamente el prefijo sin dígitos, se devuelve None para evitar búsquedas
+      demasiado amplias.
+    """
+    parsed = _parse_legajo_query(query)
+    if parsed is None:
+        return None
+    explicit_prefix, num_val, exact, second_part = parsed
+
+    # Construir patrón para la parte numérica:
+    if exact:
+        # Se fuerza que no haya dígitos adicionales (lookahead negativo)
+        num_pattern = rf'0*{num_val}(?!\d)'
+    else:
+        # Búsqueda flexible: el valor numérico debe empezar con el dígito(s)
+        num_pattern = rf'0*{num_val}'
+
+    # Procesar el fragmento de año, si lo hubiera
+    if second_part:
+        if len(second_part) == 4 and second_part.isdigit():
+            year_pattern = rf'-{second_part}\b'
+        else:
+            # Si la parte del año es menor a 4 dígitos, se usa de forma flexible (starts with)
+            year_pattern = rf'-{second_part}'
+    else:
+        # Si es exactamente "num-" (sin datos del año), exigimos el guion solamente para marcar final del número
+        year_pattern = "-"
+
+    # Construir el patrón para el prefijo:
+    if explicit_prefix == "D":
+        prefix_pattern = r'^D-'
+    elif explicit_prefix == "LEG":
+        prefix_pattern = r'^(?:LEG-|L\. ?)'
+    else:
+        prefix_pattern = r'^(?:D-|LEG-|L\. ?)'
+
+    return prefix_pattern + num_pattern + year_pattern
+
+
+def _parse_legajo_query(query):
+    """(prefijo 'D'|'LEG'|None, número, exacto, fragmento de año) o None si no es válido."""
+    q = (query or "").strip().upper()
+    # Detectar prefijo explícito (no se elimina si el usuario lo incluye, para restringir el grupo)
+    prefix_match = re.match(r'^(D-|LEG-|L\. ?)', q)
+    if prefix_match:
+        raw_prefix = prefix_match.group(1).strip()
+        explicit_prefix = "LEG" if raw_prefix in ("LEG-", "L.", "L-") else "D"
+        remainder = q[len(prefix_match.group(1)):].strip()
+    else:
+        explicit_prefix = None
+        remainder = q
+
+    # Se exige que después (o en ausencia de prefijo) exista al menos un dígito
+    if not re.match(r'^\d', remainder):
+        return None
+    # Sin guion se asume "num-"
+    if '-' not in remainder:
+        remainder = remainder + "-"
+    num_str, second_part = remainder.split("-", 1)
+    num_str = num_str.strip()
+    if not num_str.isdigit():
+        return None
+    return explicit_prefix, int(num_str), remainder.endswith("-"), second_part.strip()
+
+
+def build_legajo_filter(query, ppu_column: str = "registro_ppu",
+                        alias: str = "") -> Optional[Tuple[str, list]]:
+    """
+    Equivalente de build_legajo_regexp sobre las columnas ppu_* indexadas.
+    Devuelve (condición SQL, params) o None si el query no es válido. Cuando el
+    fragmento de año no se puede expresar como rango (p. ej. "6-2A") se recurre
+    al REGEXP sobre `ppu_column`.
+    """
+    parsed = _parse_legajo_query(query)
+    if parsed is None:
+        return None
+    explicit_prefix, num_val, exact, second_part = parsed
+    col = (alias + ".") if alias else ""
+
+    if explicit_prefix == "D":
+        tipos = ["D"]
+    elif explicit_prefix == "LEG":
+        tipos = list(PPU_TIPOS_LEGAJO)
+    else:
+        tipos = list(PPU_TIPOS_BUSQUEDA)
+
+    year_cond, year_params = "", []
+    if second_part:
+        if not second_part.isdigit() or len(second_part) > 4 or second_part.startswith("0"):
+            return f"{col}{ppu_column} REGEXP %s", [build_legajo_regexp(query)]
+        if len(second_part) == 4:
+            year_cond, year_params = f" AND {col}ppu_anio = %s", [int(second_part)]
+        else:
+            # "starts with" sobre el texto del año = unión de rangos numéricos
+            ranges, base = [], int(second_part)
+            for width in range(len(second_part), 5):
+                scale = 10 ** (width - len(second_part))
+                ranges.append(f"{col}ppu_anio BETWEEN %s AND %s")
+                year_params += [base * scale, (base + 1) * scale - 1]
+            year_cond = " AND (" + " OR ".join(ranges) + ")"
+
+    placeholders = ", ".join(["%s"] * len(tipos))
+    cond = f"{col}ppu_tipo IN ({placeholders}) AND {col}ppu_numero = %s" + year_cond
+    return cond, tipos + [num_val] + year_params
+
+
+# ---- Clave normalizada de abogado ----
+# abogado_key: parte final tras ';' en mayúsculas ("ASISTENTE; PEREZ" -> "PEREZ"),
+# la misma expresión que usaban los filtros por abogado. Generada, INVISIBLE e
+# indexada junto con fecha_ingreso. abogado_alias guarda, por lista de abogados
+# canónicos, a cuál se parece cada clave (difflib una sola vez por clave).
+ABOGADO_ALIAS_CUTOFF = 0.8
+
+register_schema_migration(
+    "0007_abogado_key",
+    [
+        "ALTER TABLE datapenal ADD COLUMN abogado_key VARCHAR(255) AS"
+        " (LEFT(UPPER(TRIM(SUBSTRING_INDEX(abogado, ';', -1))), 255)) STORED INVISIBLE",
+        "ALTER TABLE datapenal ADD INDEX idx_abogado_key_fecha (abogado_key, fecha_ingreso)",
+        "CREATE TABLE IF NOT EXISTS abogado_alias ("
+        " lista CHAR(16) NOT NULL,"
+        " alias VARCHAR(255) NOT NULL,"
+        " abogado VARCHAR(64) NOT NULL,"
+        " PRIMARY KEY (lista, alias)"
+        ")",
+    ],
+)
+
+_abogado_alias: Dict[str, Dict[str, str]] = {}  # lista -> {abogado_key: canónico}
+_abogado_alias_lock = threading.Lock()
+
+
+def abogado_key(abogado: Optional[str]) -> str:
+    """Misma normalización que la columna abogado_key."""
+    return (abogado or "").split(";")[-1].strip().upper()
+
+
+def resolve_abogado_aliases(canonical: Sequence[str], default: str = "OTROS") -> Dict[str, str]:
+    """
+    {abogado_key: abogado de `canonical` al que se parece (o `default`)} para todas
+    las claves de datapenal. Solo las claves que aún no están en abogado_alias pasan
+    por difflib; el resultado queda en la tabla y en memoria.
+    """
+    lista = hashlib.sha1("|".join(canonical).encode("utf-8")).hexdigest()[:16]
+    with _abogado_alias_lock:
+        aliases = _abogado_alias.setdefault(lista, {})
+        cnx = get_db_connection()
+        if cnx is None:
+            return dict(aliases)
+        cur = cnx.cursor()
+        try:
+            if not aliases:
+                cur.execute("SELECT alias, abogado FROM abogado_alias WHERE lista = %s", (lista,))
+                aliases.update(cur.fetchall())
+            # Recorrido de idx_abogado_key_fecha: una fila por abogado distinto
+            cur.execute("SELECT DISTINCT abogado_key FROM datapenal WHERE abogado_key IS NOT NULL")
+            nuevas = []
+            for (key,) in cur.fetchall():
+                if key in aliases:
+                    continue
+                match = difflib.get_close_matches(key, canonical, n=1, cutoff=ABOGADO_ALIAS_CUTOFF)
+                aliases[key] = match[0] if match else default
+                nuevas.append((lista, key, aliases[key]))
+            if nuevas:
+                cur.executemany(
+                    "INSERT IGNORE INTO abogado_alias (lista, alias, abogado) VALUES (%s, %s, %s)",
+                    nuevas,
+                )
+                cnx.commit()
+        except mysql.connector.Error as err:
+            logger.warning("No se pudieron resolver los alias de abogado: %s", err)
+        finally:
+            cur.close()
+            cnx.close()
+        return dict(aliases)
+
+
 # ---- Expedientes ----
 exp_pattern_1 = r"(\d{5}-\d{4}-\d{1,2}-\d{4}[A-Z]?-([A-Z]{2})-[A-Z]{2}-\d{1,2})"
 exp_pattern_2 = r"(\d{5}-\d{4}-\d{1,2}-[A-Z\d]+-[A-Z]{2}-[A-Z]{2}-\d{1,2})"
@@ -111,6 +991,132 @@ def extract_pdf_pages(pdf_path: str) -> Optional[List[Tuple[int, str]]]:
         logger.error("No se pudo procesar %s: %s", pdf_path, e)
         return None
 
+# ---- SHA-256 de archivos con caché persistente ----
+# Todas las entradas de PDF (bulk_update, consultas, impulsos, seguimiento, ingresos,
+# escaneo de "A pasar") calculan el hash con sha256_file(). El resultado se guarda por
+# (st_dev, st_ino, tamaño, mtime_ns): mientras el archivo no cambie no se vuelve a
+# leer. Una caché en memoria va delante de una base SQLite compartida por procesos.
+FILE_HASH_CACHE_PATH = os.environ.get("PENAL_HASH_CACHE") or os.path.join(
+    tempfile.gettempdir(), "penal_file_hashes.sqlite3"
+)
+FILE_HASH_CACHE_MAX = int(os.environ.get("PENAL_HASH_CACHE_MAX", "200000"))
+FILE_HASH_MEMORY_MAX = 4096
+FILE_HASH_BUFFER = 1024 * 1024
+
+_file_hashes: "OrderedDict[tuple, str]" = OrderedDict()
+_file_hashes_lock = threading.Lock()
+_file_hash_db = threading.local()
+_file_hash_writes = 0
+
+
+def _file_hash_key(st: os.stat_result, path: str) -> tuple:
+    # Sin número de inodo (algunos shares SMB devuelven 0) la ruta identifica al archivo
+    ident = st.st_ino if st.st_ino else os.path.normcase(os.path.abspath(path))
+    return (st.st_dev, ident, st.st_size, st.st_mtime_ns)
+
+
+def _file_hash_conn() -> Optional[sqlite3.Connection]:
+    conn = getattr(_file_hash_db, "conn", None)
+    if conn is None and FILE_HASH_CACHE_MAX > 0:
+        try:
+            conn = sqlite3.connect(FILE_HASH_CACHE_PATH, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS file_hash ("
+                " clave TEXT PRIMARY KEY, sha256 TEXT NOT NULL, usado REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_file_hash_usado ON file_hash (usado)")
+        except sqlite3.Error as err:
+            logger.warning("Caché de hashes no disponible (%s): %s", FILE_HASH_CACHE_PATH, err)
+            return None
+        _file_hash_db.conn = conn
+    return conn
+
+
+def _file_hash_lookup(key: tuple) -> Optional[str]:
+    with _file_hashes_lock:
+        digest = _file_hashes.get(key)
+        if digest is not None:
+            _file_hashes.move_to_end(key)
+            return digest
+    conn = _file_hash_conn()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT sha256 FROM file_hash WHERE clave = ?", (repr(key),)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE file_hash SET usado = ? WHERE clave = ?", (time.time(), repr(key)))
+    except sqlite3.Error as err:
+        logger.warning("Error leyendo la caché de hashes: %s", err)
+        return None
+    _file_hash_remember(key, row[0])
+    return row[0]
+
+
+def _file_hash_remember(key: tuple, digest: str) -> None:
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+        _file_hashes.move_to_end(key)
+        while len(_file_hashes) > FILE_HASH_MEMORY_MAX:
+            _file_hashes.popitem(last=False)
+
+
+def _file_hash_store(key: tuple, digest: str) -> None:
+    global _file_hash_writes
+    _file_hash_remember(key, digest)
+    conn = _file_hash_conn()
+    if conn is None:
+        return
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO file_hash (clave, sha256, usado) VALUES (?, ?, ?)",
+            (repr(key), digest, time.time()),
+        )
+        _file_hash_writes += 1
+        # Desalojo de las menos usadas (se comprueba cada 1000 altas)
+        if _file_hash_writes % 1000 == 0:
+            (total,) = conn.execute("SELECT COUNT(*) FROM file_hash").fetchone()
+            if total > FILE_HASH_CACHE_MAX:
+                conn.execute(
+                    "DELETE FROM file_hash WHERE clave IN ("
+                    " SELECT clave FROM file_hash ORDER BY usado LIMIT ?)",
+                    (total - FILE_HASH_CACHE_MAX,),
+                )
+    except sqlite3.Error as err:
+        logger.warning("Error guardando en la caché de hashes: %s", err)
+
+
+def sha256_file(path: str) -> str:
+    """
+    SHA-256 (hex) del contenido de `path`. Se lee (con búfer de 1 MiB) solo si el
+    archivo cambió desde la última vez; si no, sale de la caché. Lanza OSError si no
+    se puede leer.
+    """
+    st = os.stat(path)
+    key = _file_hash_key(st, path)
+    digest = _file_hash_lookup(key)
+    if digest is not None:
+        return digest
+    with open(path, "rb") as fh:
+        if hasattr(hashlib, "file_digest"):
+            digest = hashlib.file_digest(fh, "sha256").hexdigest()
+        else:
+            h = hashlib.sha256()
+            buf = bytearray(FILE_HASH_BUFFER)
+            view = memoryview(buf)
+            while True:
+                n = fh.readinto(buf)
+                if not n:
+                    break
+                h.update(view[:n])
+            digest = h.hexdigest()
+    # Si cambió mientras se leía, el hash vale pero no se guarda
+    if _file_hash_key(os.stat(path), path) == key:
+        _file_hash_store(key, digest)
+    return digest
+
+
 def format_legajo(legajo_str: str) -> str:
     try:
         return f"{int(legajo_str):03d}"
@@ -188,10 +1194,13 @@ def validate_expediente_juzgado(expediente: dict) -> dict:
 
 # ---- Lookup auxiliar ----
 def get_fiscalia_departamento(fiscalia: str) -> str:
+    # Dentro de una request reutiliza la conexión de la request
+    in_request = has_request_context()
+    cnx = get_request_db() if in_request else get_db_connection()
+    if cnx is None:
+        return "Departamento Desconocido"
+    cur = None
     try:
-        cnx = mysql.connector.connect(
-            host="localhost", user="root", password="Manuel22", database="datappupenal"
-        )
         cur = cnx.cursor(dictionary=True)
         cur.execute(
             "SELECT departamento FROM dependencias_fiscales_mpfn WHERE fiscalia = %s LIMIT 1",
@@ -204,26 +1213,53 @@ def get_fiscalia_departamento(fiscalia: str) -> str:
         return "Departamento Desconocido"
     finally:
         try:
-            cur.close()
-        except Exception:
-            pass
-        try:
-            cnx.close()
+            if cur is not None:
+                cur.close()
         except Exception:
             pass
+        if not in_request:
+            try:
+                cnx.close()
+            except Exception:
+                pass
 
 # ---- Export explícito (ayuda a Pylance) ----
 __all__ = [
     "ALLOWED_EXTENSIONS",
     "allowed_file",
     "get_db_connection",
+    "get_pool_stats",
+    "register_session_init",
+    "register_schema_migration",
+    "apply_schema_migrations",
+    "get_request_db",
+    "rollback_request_db",
+    "init_request_db",
+    "after_request_commit",
+    "run_parallel_queries",
     "normalize_text",
+    "TEXT_SEARCH_COLUMNS",
+    "text_index_document",
+    "text_index_query",
+    "sync_text_index",
+    "iniciar_sincronizacion_texto",
+    "text_index_filter",
     "query_to_regexp",
     "parse_ppu",
+    "get_ppu_years",
+    "invalidate_ppu_years",
+    "note_ppu_year",
+    "abogado_key",
+    "resolve_abogado_aliases",
     "parse_query_ppu",
     "generar_variantes_ppu",
+    "build_legajo_regexp",
+    "build_legajo_filter",
+    "PPU_TIPOS_LEGAJO",
+    "PPU_TIPOS_BUSQUEDA",
     "normalizar_expediente",
     "extract_pdf_pages",
+    "sha256_file",
     "format_legajo",
     "parse_predicted_label_and_number",
     "find_occurrence_in_situacional",
@@ -8,15 +8,95 @@ from flask import Blueprint, jsonify, request, session, current_app, send_file
 from backend.core import (
     login_required,
     get_db_connection,
+    register_schema_migration,
 )
 
 busqueda_rapida_bp = Blueprint("busqueda_rapida_bp", __name__)
 
+# Token de versión por fila para /busqueda_rapida_patch: cualquier UPDATE de datapenal
+# (venga de donde venga) lo incrementa. INVISIBLE: no cambia SELECT * ni los INSERT
+# sin lista de columnas.
+register_schema_migration(
+    "0011_datapenal_row_version",
+    [
+        "ALTER TABLE datapenal ADD COLUMN row_version INT UNSIGNED NOT NULL DEFAULT 0 INVISIBLE",
+        "CREATE TRIGGER trg_row_version_dp BEFORE UPDATE ON datapenal FOR EACH ROW"
+        " SET NEW.row_version = OLD.row_version + 1",
+    ],
+)
+
 
 # -------------------------------------------------------------------- #
 # ---------------------------------MODO BUSQUEDA ----------------------- #
 # -------------------------------------------------------------------- #
 
+# Columnas de datapenal con las claves (camelCase) que espera la grilla
+_GRILLA_COLUMNAS = """            abogado                                   AS abogado,
+            registro_ppu                              AS `registro_ppu`,
+            registro_ppu                              AS registroPpu,
+            denunciado                                AS denunciado,
+            origen                                    AS origen,
+            `nr de exp completo`                      AS nr_de_exp_completo,
+            fiscalia                                  AS fiscaliaOrigen,
+            departamento                              AS departamento,
+            juzgado                                   AS juzgado,
+            delito                                    AS delito,
+            e_situacional                             AS e_situacional,
+            informe_juridico                          AS informeJuridico,
+            item                                      AS item,
+            fecha_ingreso                             AS fechaIngreso,
+            etiqueta                                  AS etiqueta,
+            fecha_de_archivo                          AS fechaDeArchivo,
+            razon_archivo                             AS razonArchivo,
+            row_version                               AS rowVersion"""
+
+# PPU por consulta IN (...) en buscar_por_ppus
+LOTE_PPU = 1000
+
+
+def _fechas_iso(rows):
+    """Normaliza fechas a ISO para el frontend (keys camelCase que la grilla espera)."""
+    for r in rows:
+        if r.get("fechaIngreso") and isinstance(r["fechaIngreso"], (date, datetime)):
+            r["fechaIngreso"] = r["fechaIngreso"].strftime("%Y-%m-%d")
+        if r.get("fechaDeArchivo") and isinstance(r["fechaDeArchivo"], (date, datetime)):
+            r["fechaDeArchivo"] = r["fechaDeArchivo"].strftime("%Y-%m-%d")
+    return rows
+
+
+def buscar_por_ppus(connection, ppus):
+    """
+    Filas de la grilla para cada PPU de `ppus` (coincidencia exacta de registro_ppu,
+    sin distinguir mayúsculas ni espacios en los extremos), con una consulta
+    IN (...) por cada LOTE_PPU. Devuelve {ppu tal como vino: [filas]}; los PPU sin
+    registro no aparecen.
+    """
+    claves = {}
+    for ppu in ppus:
+        if ppu and str(ppu).strip():
+            claves.setdefault(str(ppu).strip().upper(), []).append(ppu)
+    resultado = {}
+    if not claves:
+        return resultado
+    buscados = list(claves)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        for i in range(0, len(buscados), LOTE_PPU):
+            lote = buscados[i:i + LOTE_PPU]
+            cursor.execute(
+                f"SELECT {_GRILLA_COLUMNAS} FROM datapenal"
+                f" WHERE registro_ppu IN ({', '.join(['%s'] * len(lote))})"
+                " ORDER BY registro_ppu",
+                lote,
+            )
+            for row in _fechas_iso(cursor.fetchall()):
+                for ppu in claves.get(str(row["registro_ppu"]).strip().upper(), []):
+                    resultado.setdefault(ppu, []).append(dict(row))
+    finally:
+        cursor.close()
+    return resultado
+
+
 @busqueda_rapida_bp.route("/busqueda_rapida", methods=["GET"])
 @login_required
 def busqueda_rapida():
@@ -35,25 +115,9 @@ def busqueda_rapida():
     cursor = None
     try:
         cursor = conn.cursor(dictionary=True)
-        sql = """
+        sql = f"""
          SELECT
-            abogado                                   AS abogado,
-            registro_ppu                              AS `registro_ppu`,
-            registro_ppu                              AS registroPpu,
-            denunciado                                AS denunciado,
-            origen                                    AS origen,
-            `nr de exp completo`                      AS nr_de_exp_completo,
-            fiscalia                                  AS fiscaliaOrigen,
-            departamento                              AS departamento,
-            juzgado                                   AS juzgado,
-            delito                                    AS delito,
-            e_situacional                             AS e_situacional,
-            informe_juridico                          AS informeJuridico,
-            item                                      AS item,
-            fecha_ingreso                             AS fechaIngreso,
-            etiqueta                                  AS etiqueta,
-            fecha_de_archivo                          AS fechaDeArchivo,
-            razon_archivo                             AS razonArchivo
+{_GRILLA_COLUMNAS}
          FROM datapenal
          WHERE
             (registro_ppu         LIKE %s OR
@@ -82,14 +146,7 @@ def busqueda_rapida():
         cursor.execute(sql, params)
         rows = cursor.fetchall()
 
-        # Normaliza fechas a ISO para el frontend (keys camelCase que la grilla espera)
-        for r in rows:
-            if r.get("fechaIngreso") and isinstance(r["fechaIngreso"], (date, datetime)):
-                r["fechaIngreso"] = r["fechaIngreso"].strftime("%Y-%m-%d")
-            if r.get("fechaDeArchivo") and isinstance(r["fechaDeArchivo"], (date, datetime)):
-                r["fechaDeArchivo"] = r["fechaDeArchivo"].strftime("%Y-%m-%d")
-
-        return jsonify(rows)
+        return jsonify(_fechas_iso(rows))
 
     except Exception:
         return jsonify([]), 500
@@ -102,6 +159,37 @@ def busqueda_rapida():
             conn.close()
 
 
+@busqueda_rapida_bp.route("/busqueda_rapida_lote", methods=["POST"])
+@login_required
+def busqueda_rapida_lote():
+    """
+    Búsqueda por lote de PPU exactos: {"ppus": [...]} -> {"rows": [...],
+    "no_encontrados": [...]}, filas en el orden de los PPU pedidos.
+    """
+    body = request.get_json(silent=True) or {}
+    ppus = body.get("ppus")
+    if not isinstance(ppus, list):
+        return jsonify(error="Se esperaba {'ppus': [...]}"), 400
+
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify(error="Error al conectar con la base de datos"), 500
+
+    try:
+        por_ppu = buscar_por_ppus(conn, ppus)
+        pedidos = list(dict.fromkeys(p for p in ppus if p))
+        rows = [fila for ppu in pedidos for fila in por_ppu.get(ppu, [])]
+        no_encontrados = [ppu for ppu in pedidos if ppu not in por_ppu]
+        return jsonify(rows=rows, no_encontrados=no_encontrados), 200
+
+    except Exception:
+        current_app.logger.error("busqueda_rapida_lote error:", exc_info=True)
+        return jsonify(error="Error al buscar los PPU"), 500
+
+    finally:
+        conn.close()
+
+
 @busqueda_rapida_bp.route("/juzgado_incompleto", methods=["GET"])
 @login_required
 def juzgado_incompleto():
@@ -249,6 +337,116 @@ def api_me():
     }), 200
 
 
+# Filas por SELECT ... IN / UPDATE en busqueda_rapida_sync
+SYNC_LOTE = 500
+
+# Valores actuales de los PPU a sincronizar (todas las columnas que se comparan)
+_SYNC_SELECT = """
+    SELECT
+        registro_ppu,
+        abogado,
+        denunciado,
+        origen,
+        `nr de exp completo`  AS nr_de_exp_completo,
+        fiscalia              AS fiscalia_origen,
+        departamento,
+        juzgado,
+        delito,
+        e_situacional,
+        informe_juridico,
+        item,
+        fecha_ingreso,
+        fecha_e_situacional,
+        etiqueta,
+        last_modified,
+        fecha_de_archivo,
+        razon_archivo         AS razon_archivo
+    FROM datapenal
+    WHERE registro_ppu IN ({placeholders})
+"""
+
+# ⚠️ Sin 'fechaDeArchivo' en el comparador. La maneja el TRIGGER en BD.
+_SYNC_COMPARADORES = [
+    ("abogado",            "abogado"),
+    ("denunciado",         "denunciado"),
+    ("origen",             "origen"),
+    ("nrDeExpCompleto",    "nr_de_exp_completo"),
+    ("fiscaliaOrigen",     "fiscalia_origen"),
+    ("departamento",       "departamento"),
+    ("juzgado",            "juzgado"),
+    ("delito",             "delito"),
+    ("informeJuridico",    "informe_juridico"),
+    ("item",               "item"),
+    ("eSituacional",       "e_situacional"),
+    ("fechaIngreso",       "fecha_ingreso"),
+    ("fechaESituacional",  "fecha_e_situacional"),
+    ("etiqueta",           "etiqueta"),
+    ("razonArchivo",       "razon_archivo"),
+]
+
+# Solo fechas que el front puede modificar (NO incluir fecha_de_archivo ni last_modified)
+_SYNC_DATE_FIELDS = {"fecha_ingreso", "fecha_e_situacional"}
+
+# Clave del comparador -> columna real de datapenal
+_SYNC_COLUMNAS = {
+    "nr_de_exp_completo": "`nr de exp completo`",
+    "fiscalia_origen":    "fiscalia",
+}
+
+
+# Normaliza cualquier tipo a string “segura” para comparar (no para escribir fechas)
+def _s(v):
+    if v is None:
+        return ""
+    try:
+        return str(v).strip()
+    except Exception:
+        return ""
+
+
+# Normaliza fechas a formato aceptado por MySQL o None (NULL)
+# Acepta: '', None, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM:SS', 'DD/MM/YYYY', 'DD-MM-YYYY'
+def _date_norm(v):
+    if v is None:
+        return None
+    if isinstance(v, (datetime,)):
+        return v.strftime("%Y-%m-%d")
+    if isinstance(v, (date,)):
+        return v.strftime("%Y-%m-%d")
+    sv = str(v).strip()
+    if not sv:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            dt = datetime.strptime(sv, fmt)
+            return dt.strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    # Si no parsea, mejor enviar NULL que cadena vacía
+    return None
+
+
+def _sync_update(columnas, filas):
+    """
+    Un UPDATE para varias filas con las mismas columnas cambiadas:
+    SET col = CASE registro_ppu WHEN ... THEN ... END WHERE registro_ppu IN (...).
+    """
+    ppus = [ppu for ppu, _ in filas]
+    sets, params = [], []
+    for col in columnas:
+        sets.append(
+            f"{_SYNC_COLUMNAS.get(col, col)} = CASE registro_ppu "
+            + " ".join(["WHEN %s THEN %s"] * len(filas)) + " END"
+        )
+        for ppu, diffs in filas:
+            params.extend((ppu, diffs[col]))
+    sql = (
+        f"UPDATE datapenal SET {', '.join(sets)}"
+        f" WHERE registro_ppu IN ({', '.join(['%s'] * len(ppus))})"
+    )
+    return sql, params + ppus
+
+
 @busqueda_rapida_bp.route("/busqueda_rapida_sync", methods=["POST"])
 @login_required
 def busqueda_rapida_sync():
@@ -272,117 +470,53 @@ def busqueda_rapida_sync():
         current_app.logger.error("busqueda_rapida_sync: error al conectar a la base de datos")
         return jsonify(updated=[]), 500
 
+    # El time_zone de Lima (UTC-5) lo fija el hook de sesión del pool (backend.core)
     cursor = conn.cursor(dictionary=True)
 
-    # Alinea el NOW() del trigger con hora de Lima (UTC-5)
-    try:
-        cursor.execute("SET time_zone = '-05:00'")
-    except Exception:
-        current_app.logger.warning("No se pudo fijar time_zone de sesión; se continúa con la del servidor.")
-
     updated_ppus = []
 
-    # Normaliza cualquier tipo a string “segura” para comparar (no para escribir fechas)
-    def _s(v):
-        if v is None:
-            return ""
-        try:
-            return str(v).strip()
-        except Exception:
-            return ""
-
-    # Normaliza fechas a formato aceptado por MySQL o None (NULL)
-    # Acepta: '', None, 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM:SS', 'DD/MM/YYYY', 'DD-MM-YYYY'
-    def _date_norm(v):
-        if v is None:
-            return None
-        if isinstance(v, (datetime,)):
-            return v.strftime("%Y-%m-%d")
-        if isinstance(v, (date,)):
-            return v.strftime("%Y-%m-%d")
-        sv = str(v).strip()
-        if not sv:
-            return None
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
-            try:
-                dt = datetime.strptime(sv, fmt)
-                return dt.strftime("%Y-%m-%d")
-            except ValueError:
-                continue
-        # Si no parsea, mejor enviar NULL que cadena vacía
-        return None
-
     try:
+        # 1) Filas válidas del payload
+        pendientes = []
         for idx, new_row in enumerate(rows, start=1):
-            ppu = new_row.get("registroPpu")
+            ppu = new_row.get("registroPpu") if isinstance(new_row, dict) else None
             if not ppu:
                 current_app.logger.warning(f"[Fila {idx}] Sin 'registroPpu', se omite")
                 continue
 
             # 🔒 Defensa: ignorar cualquier intento de setear fechaDeArchivo desde el front
-            if "fechaDeArchivo" in new_row:
-                new_row.pop("fechaDeArchivo", None)
-
-            current_app.logger.info(f"[Fila {idx}] ({username}) Datos recibidos (PPU: {ppu}): {new_row}")
-
-            # 1) Traer valores actuales desde la base (todas las columnas que se comparan)
-            cursor.execute("""
-                SELECT
-                    abogado,
-                    denunciado,
-                    origen,
-                    `nr de exp completo`  AS nr_de_exp_completo,
-                    fiscalia              AS fiscalia_origen,
-                    departamento,
-                    juzgado,
-                    delito,
-                    e_situacional,
-                    informe_juridico,
-                    item,
-                    fecha_ingreso,
-                    fecha_e_situacional,
-                    etiqueta,
-                    last_modified,
-                    fecha_de_archivo,
-                    razon_archivo         AS razon_archivo
-                FROM datapenal
-                WHERE registro_ppu = %s
-            """, (ppu,))
-            db_row = cursor.fetchone()
+            new_row.pop("fechaDeArchivo", None)
+            pendientes.append((idx, ppu, new_row))
+
+        current_app.logger.info(
+            f"busqueda_rapida_sync: {len(pendientes)} filas recibidas de {username}"
+        )
+
+        # 2) Traer de una vez los valores actuales de todos los PPU (por lotes de SYNC_LOTE)
+        db_rows = {}
+        ppus = list(dict.fromkeys(ppu for _, ppu, _ in pendientes))
+        for i in range(0, len(ppus), SYNC_LOTE):
+            lote = ppus[i:i + SYNC_LOTE]
+            cursor.execute(
+                _SYNC_SELECT.format(placeholders=", ".join(["%s"] * len(lote))), lote
+            )
+            for db_row in cursor.fetchall():
+                db_rows[db_row["registro_ppu"]] = db_row
+
+        # 3) Comparar campo a campo (solo los permitidos)
+        cambios = {}  # ppu -> {columna: valor}, en el orden del payload
+        for idx, ppu, new_row in pendientes:
+            db_row = db_rows.get(ppu)
             if not db_row:
                 current_app.logger.warning(f"[Fila {idx}] No se encontró registro en BD para PPU: {ppu}")
                 continue
 
-            # 2) Comparar campo a campo (solo los permitidos)
             diffs = {}
-
-            # ⚠️ Quitamos 'fechaDeArchivo' del comparador. La maneja el TRIGGER en BD.
-            comparadores = [
-                ("abogado",            "abogado"),
-                ("denunciado",         "denunciado"),
-                ("origen",             "origen"),
-                ("nrDeExpCompleto",    "nr_de_exp_completo"),
-                ("fiscaliaOrigen",     "fiscalia_origen"),
-                ("departamento",       "departamento"),
-                ("juzgado",            "juzgado"),
-                ("delito",             "delito"),
-                ("informeJuridico",    "informe_juridico"),
-                ("item",               "item"),
-                ("eSituacional",       "e_situacional"),
-                ("fechaIngreso",       "fecha_ingreso"),
-                ("fechaESituacional",  "fecha_e_situacional"),
-                ("etiqueta",           "etiqueta"),
-                ("razonArchivo",       "razon_archivo"),
-            ]
-
-            # Solo fechas que el front puede modificar (NO incluir fecha_de_archivo ni last_modified)
-            date_fields = {"fecha_ingreso", "fecha_e_situacional"}
-
-            for front_key, db_key in comparadores:
+            for front_key, db_key in _SYNC_COMPARADORES:
                 if front_key not in allowed_fields:
                     continue
 
-                if db_key in date_fields:
+                if db_key in _SYNC_DATE_FIELDS:
                     new_val_norm = _date_norm(new_row.get(front_key))
                     old_raw = db_row.get(db_key)
 
@@ -399,27 +533,30 @@ def busqueda_rapida_sync():
                     old_val = _s(db_row.get(db_key))
 
                     if new_val != old_val:
-                        if db_key == "nr_de_exp_completo":
-                            diffs["`nr de exp completo`"] = new_val
-                        elif db_key == "fiscalia_origen":
-                            diffs["fiscalia"] = new_val
-                        else:
-                            diffs[db_key] = new_val
-
-            # 3) Si hay diferencias permitidas, actualizar
-            if diffs:
-                # 🔒 Defensa extra: por si apareció por error
-                diffs.pop("fecha_de_archivo", None)
-
-                set_parts = [f"{col} = %s" for col in diffs.keys()]
-                params = list(diffs.values()) + [ppu]
-                sql = f"UPDATE datapenal SET {', '.join(set_parts)} WHERE registro_ppu = %s"
-                cursor.execute(sql, params)
+                        diffs[db_key] = new_val
 
+            if diffs:
+                # Un PPU repetido en el payload se compara con lo que dejó la fila anterior
+                db_row.update(diffs)
+                cambios.setdefault(ppu, {}).update(diffs)
                 updated_ppus.append(ppu)
-                current_app.logger.info(f"[Fila {idx}] ({username}) Cambios aplicados PPU {ppu}: {list(diffs.keys())}")
+                current_app.logger.debug(f"[Fila {idx}] ({username}) Cambios PPU {ppu}: {list(diffs)}")
             else:
-                current_app.logger.info(f"[Fila {idx}] ({username}) Sin cambios (o sin permisos) para PPU: {ppu}")
+                current_app.logger.debug(f"[Fila {idx}] ({username}) Sin cambios (o sin permisos) para PPU: {ppu}")
+
+        # 4) Agrupar por conjunto de columnas cambiadas: un UPDATE por grupo y lote
+        grupos = {}
+        for ppu, diffs in cambios.items():
+            grupos.setdefault(tuple(sorted(diffs)), []).append((ppu, diffs))
+
+        for columnas, filas in grupos.items():
+            for i in range(0, len(filas), SYNC_LOTE):
+                lote = filas[i:i + SYNC_LOTE]
+                sql, params = _sync_update(columnas, lote)
+                cursor.execute(sql, params)
+            current_app.logger.info(
+                f"busqueda_rapida_sync: ({username}) {len(filas)} PPU actualizados en {list(columnas)}"
+            )
 
         conn.commit()
         current_app.logger.info(f"busqueda_rapida_sync: total registros actualizados → {len(updated_ppus)} por {username}")
@@ -441,6 +578,126 @@ def busqueda_rapida_sync():
             pass
 
 
+@busqueda_rapida_bp.route("/busqueda_rapida_patch", methods=["POST"])
+@login_required
+def busqueda_rapida_patch():
+    """
+    Guardado por parches con control de concurrencia optimista.
+
+    Payload: lista de {"registroPpu", "rowVersion", "cambios": {campo: valor}}, con
+    los campos en las mismas claves que la grilla (eSituacional, fechaIngreso...) y
+    `rowVersion` el que devolvió /busqueda_rapida para esa fila.
+
+    Cada fila es un único UPDATE ... WHERE registro_ppu = %s AND row_version = %s (sin
+    leer antes la fila). Respuesta: `updated` (PPU actualizados) y `results`, una
+    entrada por fila con `status`:
+      - "ok": aplicado; `rowVersion` es el nuevo token.
+      - "conflict": otro usuario la cambió; `rowVersion` es el token actual.
+      - "not_found", "forbidden" (campos sin permiso, en `campos`) o "invalid".
+    """
+    username = session.get("username")
+    if not username:
+        return jsonify(error="No autenticado"), 401
+
+    users = _get_users_dict()
+    allowed_fields = get_allowed_fields_for_user(username, users)
+    if not allowed_fields:
+        current_app.logger.warning(f"busqueda_rapida_patch: Acceso denegado para {username}")
+        return jsonify(error="Acceso denegado"), 403
+
+    rows = request.get_json() or []
+    if not isinstance(rows, list):
+        return jsonify(error="Payload inválido, se esperaba lista de parches"), 400
+
+    conn = get_db_connection()
+    if conn is None:
+        current_app.logger.error("busqueda_rapida_patch: error al conectar a la base de datos")
+        return jsonify(error="Error al conectar con la base de datos"), 500
+
+    columnas_front = dict(_SYNC_COMPARADORES)
+    cursor = conn.cursor()
+    results = []
+    updated_ppus = []
+    sin_aplicar = set()  # PPU no actualizados: conflicto o inexistentes
+
+    try:
+        for patch in rows:
+            ppu = patch.get("registroPpu") if isinstance(patch, dict) else None
+            cambios = patch.get("cambios") if ppu else None
+            try:
+                version = int(patch.get("rowVersion")) if ppu else None
+            except (TypeError, ValueError):
+                version = None
+            if not ppu or version is None or not isinstance(cambios, dict) or not cambios:
+                results.append({"registroPpu": ppu, "status": "invalid"})
+                continue
+
+            # 🔒 Defensa: fechaDeArchivo la maneja el TRIGGER en BD
+            cambios = {k: v for k, v in cambios.items() if k != "fechaDeArchivo"}
+            prohibidos = sorted(k for k in cambios if k not in allowed_fields or k not in columnas_front)
+            if prohibidos:
+                results.append({"registroPpu": ppu, "status": "forbidden", "campos": prohibidos})
+                continue
+            if not cambios:
+                results.append({"registroPpu": ppu, "status": "ok", "rowVersion": version})
+                continue
+
+            set_parts, params = [], []
+            for front_key, valor in cambios.items():
+                db_key = columnas_front[front_key]
+                set_parts.append(f"{_SYNC_COLUMNAS.get(db_key, db_key)} = %s")
+                params.append(_date_norm(valor) if db_key in _SYNC_DATE_FIELDS else _s(valor))
+
+            cursor.execute(
+                f"UPDATE datapenal SET {', '.join(set_parts)}"
+                " WHERE registro_ppu = %s AND row_version = %s",
+                params + [ppu, version],
+            )
+            if cursor.rowcount:
+                # El trigger suma 1 a row_version en cada UPDATE
+                results.append({"registroPpu": ppu, "status": "ok", "rowVersion": version + 1})
+                updated_ppus.append(ppu)
+            else:
+                sin_aplicar.add(ppu)
+                results.append({"registroPpu": ppu, "status": "not_found"})
+
+        # Token actual de las filas no aplicadas: conflicto si existen
+        if sin_aplicar:
+            ppus = list(sin_aplicar)
+            cursor.execute(
+                "SELECT registro_ppu, row_version FROM datapenal"
+                f" WHERE registro_ppu IN ({', '.join(['%s'] * len(ppus))})",
+                ppus,
+            )
+            actuales = dict(cursor.fetchall())
+            for idx, result in enumerate(results):
+                ppu = result["registroPpu"]
+                if result["status"] == "not_found" and ppu in actuales:
+                    results[idx] = {"registroPpu": ppu, "status": "conflict", "rowVersion": actuales[ppu]}
+
+        conn.commit()
+        conflictos = sum(1 for r in results if r["status"] == "conflict")
+        current_app.logger.info(
+            f"busqueda_rapida_patch: {len(updated_ppus)} actualizados, {conflictos} en conflicto por {username}"
+        )
+        return jsonify(updated=updated_ppus, results=results), 200
+
+    except Exception:
+        conn.rollback()
+        current_app.logger.exception("busqueda_rapida_patch error", exc_info=True)
+        return jsonify(error="Error al guardar los cambios"), 500
+
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
 # -------------------------------------------------------------------- #
 # ---------------------------------MODO BUSQUEDA ----------------------- #
 # -------------------------------------------------------------------- #
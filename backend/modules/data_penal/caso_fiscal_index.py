@@ -0,0 +1,286 @@
+# backend/modules/data_penal/caso_fiscal_index.py
+# -*- coding: utf-8 -*-
+"""
+Índice de pares (número, año) de caso fiscal para la búsqueda
+`casoFiscalCompleto` de /api/new_search.
+
+De cada fila de datapenal / consulta_ppupenal se extraen los mismos pares que
+comparaba new_search:
+  - `origen`: segmentos "CASO 123-2023"                   -> ("123", "2023")
+  - `nr de exp completo`: "2006014501-2023-123-0"        -> ("2023", "123")
+Se guardan como texto (prefijos, sin tocar ceros a la izquierda) y como enteros
+en `caso_fiscal_indice`. La cola `caso_fiscal_pendiente` (llenada por triggers)
+se procesa antes de cada búsqueda, igual que datapenal_busqueda.
+"""
+
+import logging
+import re
+import threading
+from typing import List, Optional, Tuple
+
+import mysql.connector
+
+from backend.core import get_db_connection, register_schema_migration
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH = 2000
+
+SOURCES = {"datapenal": "datapenal", "consulta": "consulta_ppupenal"}
+
+RowKey = Tuple[str, int]  # (source, id)
+
+PATRON_EXP_FLEXIBLE = r'\b\d{6,10}\s*-\s*\d{4}\s*-\s*\d{1,4}(?:\s*-\s*\d+)?\b'
+_PAR = re.compile(r'\s*(\d+)\s*-\s*(\d+)\s*')
+
+_sync_lock = threading.Lock()
+
+
+def _triggers(table: str, tag: str) -> List[str]:
+    enqueue = (
+        "INSERT INTO caso_fiscal_pendiente (tabla, ref_id, ver) VALUES ('{t}', {ref}.id, 1)"
+        " ON DUPLICATE KEY UPDATE ver = ver + 1"
+    )
+    return [
+        f"CREATE TRIGGER trg_caso_fiscal_{tag}_i AFTER INSERT ON {table} FOR EACH ROW "
+        + enqueue.format(t=table, ref="NEW"),
+        f"CREATE TRIGGER trg_caso_fiscal_{tag}_u AFTER UPDATE ON {table} FOR EACH ROW "
+        "BEGIN IF NOT (OLD.origen <=> NEW.origen)"
+        " OR NOT (OLD.`nr de exp completo` <=> NEW.`nr de exp completo`) THEN "
+        + enqueue.format(t=table, ref="NEW") + "; END IF; END",
+        f"CREATE TRIGGER trg_caso_fiscal_{tag}_d AFTER DELETE ON {table} FOR EACH ROW "
+        + enqueue.format(t=table, ref="OLD"),
+    ]
+
+
+register_schema_migration(
+    "0005_caso_fiscal_indice",
+    [
+        "CREATE TABLE IF NOT EXISTS caso_fiscal_indice ("
+        " tabla VARCHAR(32) NOT NULL,"
+        " ref_id BIGINT NOT NULL,"
+        " pos SMALLINT UNSIGNED NOT NULL,"
+        " columna ENUM('origen', 'exp') NOT NULL,"
+        " primero VARCHAR(12) NOT NULL,"
+        " segundo VARCHAR(12) NOT NULL,"
+        " primero_num BIGINT UNSIGNED AS (CAST(primero AS UNSIGNED)) STORED,"
+        " segundo_num BIGINT UNSIGNED AS (CAST(segundo AS UNSIGNED)) STORED,"
+        " PRIMARY KEY (tabla, ref_id, pos),"
+        " INDEX idx_primero (primero, segundo),"
+        " INDEX idx_segundo (segundo, primero),"
+        " INDEX idx_num (primero_num, segundo_num)"
+        ")",
+        "CREATE TABLE IF NOT EXISTS caso_fiscal_pendiente ("
+        " tabla VARCHAR(32) NOT NULL,"
+        " ref_id BIGINT NOT NULL,"
+        " ver INT UNSIGNED NOT NULL DEFAULT 1,"
+        " PRIMARY KEY (tabla, ref_id)"
+        ")",
+    ]
+    + _triggers("datapenal", "dp")
+    + _triggers("consulta_ppupenal", "cons")
+    + [
+        # Carga inicial: todo entra por la cola
+        f"INSERT IGNORE INTO caso_fiscal_pendiente (tabla, ref_id) SELECT '{t}', id FROM {t}"
+        for t in SOURCES.values()
+    ],
+)
+
+
+# ---------------------------------------------------------------------
+#  Extracción (las mismas reglas que coincide_caso de new_search)
+# ---------------------------------------------------------------------
+
+def pares_origen(origen: str) -> List[Tuple[str, str]]:
+    """Pares (número, año) de los segmentos "CASO n-a" de `origen`."""
+    out = []
+    for seg in (origen or "").split(","):
+        seg = seg.strip()
+        if "CASO" not in seg.upper():
+            continue
+        m = re.search(r"(?i)CASO\s*([\d-]+)", seg)
+        if not m:
+            continue
+        par = _PAR.fullmatch(m.group(1).strip())
+        if par:
+            out.append(par.groups())
+    return out
+
+
+def pares_exp(nr_exp: str) -> List[Tuple[str, str]]:
+    """Pares relevantes de cada expediente fiscal de `nr de exp completo`."""
+    out = []
+    for seg in (nr_exp or "").split(","):
+        seg = seg.strip()
+        if not re.fullmatch(PATRON_EXP_FLEXIBLE, seg):
+            continue
+        partes = [p.strip() for p in seg.split("-")]
+        if len(partes) >= 4:
+            out.append((partes[-3], partes[-2]))
+        elif len(partes) == 3:
+            out.append((partes[-2], partes[-1]))
+    return out
+
+
+def _filas_indice(table: str, row: dict) -> List[tuple]:
+    filas = []
+    pares = [("origen", p) for p in pares_origen(row.get("origen"))]
+    pares += [("exp", p) for p in pares_exp(row.get("nr de exp completo"))]
+    for pos, (columna, (primero, segundo)) in enumerate(pares, start=1):
+        filas.append((table, row["id"], pos, columna, primero, segundo))
+    return filas
+
+
+def sync_caso_fiscal_index(max_rows: int = SYNC_BATCH) -> bool:
+    """
+    Procesa hasta `max_rows` filas pendientes. Devuelve True si la cola quedó vacía.
+    Si otro hilo ya está sincronizando devuelve False.
+    """
+    if not _sync_lock.acquire(blocking=False):
+        return False
+    cnx = None
+    cur = None
+    try:
+        cnx = get_db_connection()
+        if cnx is None:
+            return False
+        cur = cnx.cursor(dictionary=True)
+        cur.execute(
+            "SELECT tabla, ref_id, ver FROM caso_fiscal_pendiente LIMIT %s", (max_rows + 1,)
+        )
+        pending = cur.fetchall()
+        if not pending:
+            return True
+        batch = pending[:max_rows]
+        nuevas = []
+        for table in SOURCES.values():
+            ids = [p["ref_id"] for p in batch if p["tabla"] == table]
+            if not ids:
+                continue
+            placeholders = ", ".join(["%s"] * len(ids))
+            cur.execute(
+                f"SELECT id, origen, `nr de exp completo` FROM {table} WHERE id IN ({placeholders})",
+                ids,
+            )
+            for row in cur.fetchall():
+                nuevas.extend(_filas_indice(table, row))
+            cur.execute(
+                f"DELETE FROM caso_fiscal_indice WHERE tabla = %s AND ref_id IN ({placeholders})",
+                [table] + ids,
+            )
+        if nuevas:
+            cur.executemany(
+                "INSERT INTO caso_fiscal_indice (tabla, ref_id, pos, columna, primero, segundo)"
+                " VALUES (%s, %s, %s, %s, %s, %s)",
+                nuevas,
+            )
+        # Solo se desencola la versión procesada: un cambio concurrente la incrementa
+        cur.executemany(
+            "DELETE FROM caso_fiscal_pendiente WHERE tabla = %s AND ref_id = %s AND ver = %s",
+            [(p["tabla"], p["ref_id"], p["ver"]) for p in batch],
+        )
+        cnx.commit()
+        if len(pending) > max_rows:
+            return False
+        cur.execute("SELECT 1 FROM caso_fiscal_pendiente LIMIT 1")
+        return cur.fetchone() is None
+    except mysql.connector.Error as err:
+        logger.warning("No se pudo sincronizar caso_fiscal_indice: %s", err)
+        try:
+            cnx.rollback()
+        except Exception:
+            pass
+        return False
+    finally:
+        if cur is not None:
+            cur.close()
+        if cnx is not None:
+            cnx.close()
+        _sync_lock.release()
+
+
+# ---------------------------------------------------------------------
+#  Consulta
+# ---------------------------------------------------------------------
+
+def _like_prefix(text: str) -> str:
+    return re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+
+def _predicados(query: str) -> List[Tuple[str, list]]:
+    """
+    Predicados indexados equivalentes a partial_numeric_match_normal /
+    partial_numeric_match_inverted de new_search para `query`.
+    """
+    q = query.upper().replace("CASO", "").strip()
+    partes = q.split("-")
+    if len(partes) >= 3 and partes[1].isdigit() and partes[2].isdigit():
+        q_inv = f"{partes[2]}-{partes[1]}"
+    elif len(partes) == 2 and partes[0].isdigit() and partes[1].isdigit():
+        q_inv = f"{partes[1]}-{partes[0]}"
+    else:
+        q_inv = q
+
+    preds = []
+    for valor, invertido in ((q, False), (q_inv, True)):
+        if "-" not in valor:
+            # Prefijo de cualquiera de los dos números
+            try:
+                norm = str(int(valor))
+            except ValueError:
+                continue
+            preds.append(("primero LIKE %s", [_like_prefix(norm)]))
+            preds.append(("segundo LIKE %s", [_like_prefix(norm)]))
+            continue
+        q_parts = valor.split("-")
+        if len(q_parts) != 2:
+            continue
+        try:
+            if invertido:
+                # primero empieza por la 1.ª parte y segundo es exactamente la 2.ª
+                preds.append((
+                    "segundo = %s AND primero LIKE %s",
+                    [str(int(q_parts[1])), _like_prefix(q_parts[0].strip())],
+                ))
+            else:
+                # primero es exactamente la 1.ª parte y segundo empieza por la 2.ª
+                preds.append((
+                    "primero = %s AND segundo LIKE %s",
+                    [str(int(q_parts[0])), _like_prefix(q_parts[1].strip())],
+                ))
+        except ValueError:
+            continue
+    return preds
+
+
+def buscar_casos_fiscales(connection, query: str, limit: int = 10) -> Optional[List[RowKey]]:
+    """
+    (fuente, id) de hasta `limit` filas (datapenal antes que consulta, por id) con
+    algún par que coincide con `query`, o None si el índice no está al día o no
+    existe y hay que seguir con el recorrido anterior.
+    """
+    preds = _predicados(query)
+    if not preds:
+        return []
+    fuentes = {table: source for source, table in SOURCES.items()}
+    union = " UNION ".join(
+        f"SELECT tabla, ref_id FROM caso_fiscal_indice WHERE {cond}" for cond, _ in preds
+    )
+    params = [p for _, ps in preds for p in ps]
+    cur = connection.cursor()
+    try:
+        cur.execute("SELECT 1 FROM caso_fiscal_pendiente LIMIT 1")
+        dirty = cur.fetchone() is not None
+        if dirty and not sync_caso_fiscal_index():
+            return None
+        cur.execute(
+            f"SELECT tabla, ref_id FROM ({union}) c"
+            " ORDER BY tabla = 'consulta_ppupenal', ref_id LIMIT %s",
+            params + [limit],
+        )
+        return [(fuentes[t], ref_id) for t, ref_id in cur.fetchall()]
+    except mysql.connector.Error as err:
+        logger.warning("Índice de casos fiscales no disponible (%s); se recorre la tabla", err)
+        return None
+    finally:
+        cur.close()
@@ -1,37 +1,56 @@
 # backend/modules/data_penal/data_penal.py
 # -*- coding: utf-8 -*-
 
+import base64
+import json
 import re
 import difflib
-from io import BytesIO
 from datetime import date, datetime, timedelta
 from flask_cors import cross_origin  # si aún no lo tienes
 
 from collections import defaultdict
 
-import pandas as pd
+import mysql.connector
 from flask import (
     Blueprint,
     current_app,
     request,
     jsonify,
     session,
-    make_response,
 )
 
 from backend.core import (
     # Auth/decorators
     login_required, role_required,
     # DB y utilidades
-    get_db_connection, normalize_text, query_to_regexp,
+    get_db_connection, run_parallel_queries, normalize_text, query_to_regexp,
+    text_index_filter, register_schema_migration,
     # PPU helpers
-    parse_ppu, parse_query_ppu, generar_variantes_ppu,
+    parse_ppu, parse_query_ppu, generar_variantes_ppu, build_legajo_filter,
     # Expedientes
     normalizar_expediente,
     # PDF helpers y formato
     extract_pdf_pages, format_legajo,
     # Validación y lookups
     validate_expediente_juzgado, get_fiscalia_departamento,
+    # Caché de años
+    get_ppu_years,
+    # Abogados
+    abogado_key, resolve_abogado_aliases,
+)
+
+from backend.modules.data_penal.denunciado_index import (
+    MAX_DISTANCE, match_distance, normalize_name, search_denunciado, split_names,
+)
+from backend.modules.data_penal.caso_fiscal_index import buscar_casos_fiscales
+from backend.modules.data_penal.expediente_index import buscar_expedientes
+from backend.modules.data_penal.excel_stream import (
+    ColumnPlan, DataSheet, StreamingWorkbook, iter_rows, load_column_types,
+)
+from backend.modules.history.versioning import reconstruir_versiones
+from backend.modules.history.archivo import union_archivo
+from backend.modules.data_penal.export_cache import (
+    cache_and_send, data_version, export_cache_key, send_cached_export,
 )
 
 # Si este mapping ya existe en otro módulo y lo importas desde ahí, puedes borrar esto
@@ -52,6 +71,27 @@ datapenal_bp = Blueprint("datapenal", __name__)
 #  /api/new_search
 # ---------------------------------------------------------------------
 
+def _filas_por_clave(keys, match_column):
+    """Filas completas de `keys` ((fuente, id)) en el mismo orden, con match_length y source."""
+    queries = []
+    for source in ("datapenal", "consulta"):
+        ids = [row_id for src, row_id in keys if src == source]
+        if not ids:
+            continue
+        table = "datapenal" if source == "datapenal" else "consulta_ppupenal"
+        placeholders = ", ".join(["%s"] * len(ids))
+        queries.append((
+            f"SELECT *, LENGTH({match_column}) AS match_length, %s AS source"
+            f" FROM {table} WHERE id IN ({placeholders})",
+            [source] + ids,
+        ))
+    filas = {}
+    for rows in run_parallel_queries(queries):
+        for row in rows:
+            filas[(row["source"], row["id"])] = row
+    return [filas[key] for key in keys if key in filas]
+
+
 @datapenal_bp.route("/new_search", methods=["GET"])
 @login_required
 def new_search():
@@ -109,8 +149,10 @@ def new_search():
 
         # Rama para el campo "legajo"
         if search_field == "legajo":
-            pattern = build_legajo_regexp(query)
-            if not pattern:
+            # Filtro sobre las columnas ppu_* indexadas (REGEXP solo como respaldo)
+            filtro_dp = build_legajo_filter(query, field_map_datapenal["legajo"])
+            filtro_cons = build_legajo_filter(query, field_map_consulta["legajo"])
+            if not filtro_dp:
                 current_app.logger.warning(
                     "new_search: Formato inválido en 'query' para 'legajo'"
                 )
@@ -124,30 +166,40 @@ def new_search():
                     LENGTH({field_map_datapenal["legajo"]}) AS match_length,
                     'datapenal' AS source
                 FROM datapenal
-                WHERE {field_map_datapenal["legajo"]} REGEXP %s
+                WHERE {filtro_dp[0]}
                 ORDER BY match_length ASC
                 LIMIT 10
             """
-            params_datapenal = (pattern,)
+            params_datapenal = tuple(filtro_dp[1])
             sql_consulta = f"""
                 SELECT
                     *,
                     LENGTH({field_map_consulta["legajo"]}) AS match_length,
                     'consulta' AS source
                 FROM consulta_ppupenal
-                WHERE {field_map_consulta["legajo"]} REGEXP %s
+                WHERE {filtro_cons[0]}
                 ORDER BY match_length ASC
                 LIMIT 10
             """
-            params_consulta = (pattern,)
-            cursor.execute(sql_datapenal, params_datapenal)
-            results_datapenal = cursor.fetchall()
-            cursor.execute(sql_consulta, params_consulta)
-            results_consulta = cursor.fetchall()
+            params_consulta = tuple(filtro_cons[1])
+            results_datapenal, results_consulta = run_parallel_queries([
+                (sql_datapenal, params_datapenal),
+                (sql_consulta, params_consulta),
+            ])
             combined_results = results_datapenal + results_consulta
 
         # Rama para el campo "casoFiscalCompleto"
         elif search_field == "casoFiscalCompleto":
+            # Índice de pares (número, año): búsquedas normal, invertida y por
+            # prefijo en una sola consulta indexada con LIMIT 10.
+            top = buscar_casos_fiscales(connection, query, limit=10)
+            if top is not None:
+                combined_results = _filas_por_clave(
+                    top, field_map_datapenal["casoFiscalCompleto"]
+                )
+                return jsonify(combined_results), 200
+
+            # Respaldo: LIKE sobre ambas columnas + filtro en Python
             query_sin_prefijo = query.upper().replace("CASO", "").strip()
             partes = query_sin_prefijo.split("-")
             if len(partes) >= 3 and partes[1].isdigit() and partes[2].isdigit():
@@ -174,8 +226,6 @@ def new_search():
                 f"%{query_sin_prefijo}%",
                 f"%{query_invertida}%",
             )
-            cursor.execute(sql_datapenal, params_datapenal)
-            results_datapenal = cursor.fetchall()
 
             sql_consulta = f"""
                 SELECT
@@ -194,8 +244,10 @@ def new_search():
                 f"%{query_sin_prefijo}%",
                 f"%{query_invertida}%",
             )
-            cursor.execute(sql_consulta, params_consulta)
-            results_consulta = cursor.fetchall()
+            results_datapenal, results_consulta = run_parallel_queries([
+                (sql_datapenal, params_datapenal),
+                (sql_consulta, params_consulta),
+            ])
             candidatos = results_datapenal + results_consulta
 
             patron_exp_flexible = r'\b\d{6,10}\s*-\s*\d{4}\s*-\s*\d{1,4}(?:\s*-\s*\d+)?\b'
@@ -305,159 +357,132 @@ def new_search():
 
         # Rama para el campo "casoJudicial"
         elif search_field == "casoJudicial":
-            sql_datapenal = """
-                SELECT
-                    *,
-                    LENGTH(origen) AS match_length,
-                    'datapenal' AS source
-                FROM datapenal
-                WHERE origen REGEXP %s OR origen REGEXP %s
-            """
-            params_datapenal = (exp_pattern_1, exp_pattern_2)
-            cursor.execute(sql_datapenal, params_datapenal)
-            results_datapenal = cursor.fetchall()
-            sql_consulta = """
-                SELECT
-                    *,
-                    LENGTH(origen) AS match_length,
-                    'consulta' AS source
-                FROM consulta_ppupenal
-                WHERE origen REGEXP %s OR origen REGEXP %s
-            """
-            params_consulta = (exp_pattern_1, exp_pattern_2)
-            cursor.execute(sql_consulta, params_consulta)
-            results_consulta = cursor.fetchall()
-            candidatos = results_datapenal + results_consulta
-
-            def coincide_caso_judicial(row):
-                exp_full = (
-                    (row.get("origen") or "")
-                    .replace("Exp.", "")
-                    .replace("CASO", "")
-                    .strip()
-                )
-                exp_parts = exp_full.split("-")
-                if not exp_parts:
-                    return False
-                query_clean = query.strip().upper()
-                query_fragments = query_clean.split("-")
-                if not query_fragments:
-                    return False
-                if query_clean.endswith("-"):
-                    if query_fragments[0].isdigit():
-                        query_first = query_fragments[0].zfill(5)
-                    else:
-                        return False
-                    return exp_parts[0] == query_first
-                exp_first = exp_parts[0]
-                query_first = query_fragments[0]
-                if query_first.startswith("0"):
-                    if not exp_first.upper().startswith(query_first):
-                        return False
-                else:
-                    if not exp_first.lstrip("0").startswith(query_first):
+            # Índice de expedientes (expediente_origen): rango por número y filtro
+            # de fragmentos solo sobre esos candidatos.
+            top = buscar_expedientes(cursor, query, limit=10)
+            if top is not None:
+                combined_results = _filas_por_clave(top, "origen")
+            else:
+                # Respaldo: REGEXP sobre toda la tabla + filtro en Python
+                sql_datapenal = """
+                    SELECT
+                        *,
+                        LENGTH(origen) AS match_length,
+                        'datapenal' AS source
+                    FROM datapenal
+                    WHERE origen REGEXP %s OR origen REGEXP %s
+                """
+                params_datapenal = (exp_pattern_1, exp_pattern_2)
+                sql_consulta = """
+                    SELECT
+                        *,
+                        LENGTH(origen) AS match_length,
+                        'consulta' AS source
+                    FROM consulta_ppupenal
+                    WHERE origen REGEXP %s OR origen REGEXP %s
+                """
+                params_consulta = (exp_pattern_1, exp_pattern_2)
+                results_datapenal, results_consulta = run_parallel_queries([
+                    (sql_datapenal, params_datapenal),
+                    (sql_consulta, params_consulta),
+                ])
+                candidatos = results_datapenal + results_consulta
+
+                def coincide_caso_judicial(row):
+                    exp_full = (
+                        (row.get("origen") or "")
+                        .replace("Exp.", "")
+                        .replace("CASO", "")
+                        .strip()
+                    )
+                    exp_parts = exp_full.split("-")
+                    if not exp_parts:
                         return False
-                for frag in query_fragments[1:]:
-                    if not any(frag in part for part in exp_parts[1:]):
+                    query_clean = query.strip().upper()
+                    query_fragments = query_clean.split("-")
+                    if not query_fragments:
                         return False
-                return True
+                    if query_clean.endswith("-"):
+                        if query_fragments[0].isdigit():
+                            query_first = query_fragments[0].zfill(5)
+                        else:
+                            return False
+                        return exp_parts[0] == query_first
+                    exp_first = exp_parts[0]
+                    query_first = query_fragments[0]
+                    if query_first.startswith("0"):
+                        if not exp_first.upper().startswith(query_first):
+                            return False
+                    else:
+                        if not exp_first.lstrip("0").startswith(query_first):
+                            return False
+                    for frag in query_fragments[1:]:
+                        if not any(frag in part for part in exp_parts[1:]):
+                            return False
+                    return True
 
-            filtrados = [r for r in candidatos if coincide_caso_judicial(r)]
-            combined_results = filtrados[:10]
+                filtrados = [r for r in candidatos if coincide_caso_judicial(r)]
+                combined_results = filtrados[:10]
 
         # Rama para el campo "denunciado"
         elif search_field == "denunciado":
-            # Filtro preliminar: limitar la cantidad de registros solicitados a la base de datos.
-            preliminary_query = f"%{query.upper()}%"
-            sql_datapenal = """
-                SELECT
-                    *,
-                    'datapenal' AS source
-                FROM datapenal
-                WHERE denunciado IS NOT NULL AND UPPER(denunciado) LIKE %s
-                LIMIT 100
-            """
-            cursor.execute(sql_datapenal, (preliminary_query,))
-            results_datapenal = cursor.fetchall()
-
-            sql_consulta = """
-                SELECT
-                    *,
-                    'consulta' AS source
-                FROM consulta_ppupenal
-                WHERE denunciado IS NOT NULL AND UPPER(denunciado) LIKE %s
-                LIMIT 100
-            """
-            cursor.execute(sql_consulta, (preliminary_query,))
-            results_consulta = cursor.fetchall()
-
-            candidates = results_datapenal + results_consulta
-
-            # Se intenta importar una versión optimizada de Levenshtein (rapidfuzz).
-            try:
-                from rapidfuzz.distance.Levenshtein import (
-                    distance as levenshtein_distance,
-                )
-            except ImportError:
-                # Si no está disponible, se utiliza la implementación propia en Python.
-                def levenshtein_distance(s, t):
-                    if s == t:
-                        return 0
-                    if len(s) == 0:
-                        return len(t)
-                    if len(t) == 0:
-                        return len(s)
-                    v0 = list(range(len(t) + 1))
-                    for i in range(1, len(s) + 1):
-                        v1 = [i] + [0] * len(t)
-                        for j in range(1, len(t) + 1):
-                            cost = 0 if s[i - 1] == t[j - 1] else 1
-                            v1[j] = min(
-                                v1[j - 1] + 1, v0[j] + 1, v0[j - 1] + cost
-                            )
-                        v0 = v1
-                    return v0[len(t)]
-
-            def _normalize(text):
-                text = (text or "").upper().strip()
-                replacements = {
-                    "V": "B",
-                    "Z": "S",
-                    "Y": "I",
-                }
-                for old, new in replacements.items():
-                    text = text.replace(old, new)
-                return text
-
-            normalized_query = _normalize(query)
-
-            filtered = []
-            for row in candidates:
-                name = row.get("denunciado")
-                if name:
-                    # Se separa el campo en tokens, usando la coma como delimitador.
-                    tokens = [token.strip() for token in name.split(",")]
-                    min_distance = float("inf")
-                    for token in tokens:
-                        norm_token = _normalize(token)
-                        # Se verifica si el término de búsqueda ya está contenido (coincidencia parcial).
-                        if normalized_query in norm_token:
-                            dist = 0
-                        else:
-                            dist = levenshtein_distance(
-                                normalized_query, norm_token
-                            )
-                        if dist < min_distance:
-                            min_distance = dist
-                        if min_distance == 0:
-                            break  # No es necesario seguir evaluando si se encontró una coincidencia exacta parcial.
-                    threshold = 2
-                    if min_distance <= threshold:
-                        row["levenshtein"] = min_distance
+            # Índice difuso en memoria: todas las filas a distancia <= 2, sin el
+            # prefiltro LIKE (que perdía los errores de tipeo) ni el corte en 100.
+            top = search_denunciado(query, limit=10)
+            if top is not None:
+                ids_por_fuente = defaultdict(list)
+                for (source, row_id), _dist in top:
+                    ids_por_fuente[source].append(row_id)
+                filas = {}
+                for source, ids in ids_por_fuente.items():
+                    table = "datapenal" if source == "datapenal" else "consulta_ppupenal"
+                    placeholders = ", ".join(["%s"] * len(ids))
+                    cursor.execute(
+                        f"SELECT *, %s AS source FROM {table} WHERE id IN ({placeholders})",
+                        [source] + ids,
+                    )
+                    for row in cursor.fetchall():
+                        filas[(source, row["id"])] = row
+                combined_results = []
+                for key, dist in top:
+                    row = filas.get(key)
+                    if row is not None:
+                        row["levenshtein"] = dist
+                        combined_results.append(row)
+            else:
+                # Respaldo: filtro preliminar LIKE + Levenshtein sobre los candidatos
+                preliminary_query = f"%{query.upper()}%"
+                sql_datapenal = """
+                    SELECT
+                        *,
+                        'datapenal' AS source
+                    FROM datapenal
+                    WHERE denunciado IS NOT NULL AND UPPER(denunciado) LIKE %s
+                    LIMIT 100
+                """
+                sql_consulta = """
+                    SELECT
+                        *,
+                        'consulta' AS source
+                    FROM consulta_ppupenal
+                    WHERE denunciado IS NOT NULL AND UPPER(denunciado) LIKE %s
+                    LIMIT 100
+                """
+                results_datapenal, results_consulta = run_parallel_queries([
+                    (sql_datapenal, (preliminary_query,)),
+                    (sql_consulta, (preliminary_query,)),
+                ])
+
+                normalized_query = normalize_name(query)
+                filtered = []
+                for row in results_datapenal + results_consulta:
+                    dist = match_distance(normalized_query, split_names(row.get("denunciado")))
+                    if dist is not None and dist <= MAX_DISTANCE:
+                        row["levenshtein"] = dist
                         filtered.append(row)
 
-            filtered.sort(key=lambda x: x["levenshtein"])
-            combined_results = filtered[:10]
+                filtered.sort(key=lambda x: x["levenshtein"])
+                combined_results = filtered[:10]
 
         # Rama genérica para otros campos
         else:
@@ -533,50 +558,28 @@ def new_search():
 def get_years():
     """
     Devuelve la lista de años únicos extraídos de registro_ppu,
-    ordenados de mayor a menor.
+    ordenados de mayor a menor. Sale de la caché de core (se invalida con las
+    altas) y lleva ETag: con If-None-Match vigente se responde 304 sin cuerpo.
     """
     current_app.logger.debug("→ Entrando a /api/years")  # <--- LOG
 
-    connection = get_db_connection()
-    if connection is None:
-        current_app.logger.error("get_years: No se pudo conectar a la base de datos")
-        return jsonify({"error": "Error al conectar con la base de datos"}), 500
-
-    cursor = None
     try:
-        cursor = connection.cursor(dictionary=True)
-        sql = """
-            SELECT DISTINCT
-              CAST(
-                SUBSTRING_INDEX(
-                  SUBSTRING_INDEX(registro_ppu, '-', 3),
-                  '-',
-                  -1
-                ) AS UNSIGNED
-              ) AS year
-            FROM datapenal
-            WHERE registro_ppu IS NOT NULL AND registro_ppu != ''
-            ORDER BY year DESC
-        """
-        current_app.logger.debug("get_years: Ejecutando SQL:\n%s", sql)  # <--- LOG
-        cursor.execute(sql)
-        rows = cursor.fetchall()
-        current_app.logger.debug(
-            "get_years: Filas obtenidas: %d", len(rows)
-        )  # <--- LOG
-
-        años = [str(r["year"]) for r in rows if r.get("year") is not None]
+        cached = get_ppu_years()
+        if cached is None:
+            current_app.logger.error("get_years: No se pudo conectar a la base de datos")
+            return jsonify({"error": "Error al conectar con la base de datos"}), 500
+        años, etag = cached
         current_app.logger.debug(
             "get_years: Lista de años resultante → %s", años
         )  # <--- LOG
-        return jsonify({"years": años})
+        response = jsonify({"years": años})
+        response.set_etag(etag)
+        # El navegador guarda la respuesta pero revalida siempre con el ETag
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
     except Exception as e:
         current_app.logger.error("Error en /api/years: %s", e, exc_info=True)
         return jsonify({"error": "Error al obtener años"}), 500
-    finally:
-        if cursor is not None:
-            cursor.close()
-        connection.close()
 
 
 #from datetime import date, datetime, timedelta
@@ -752,6 +755,193 @@ def _sort_and_interleave(rows, order_ppu: str = "desc", interleave: bool = True)
 
     return out
 
+# ---- Orden PPU + intercalado en MySQL por búsqueda indexada (keyset) ----
+# Reproduce _sort_and_interleave sin numerar toda la tabla: por año (desc/asc), las
+# denuncias (D) y los legajos (L. y LEG-) se leen como dos flujos ordenados por
+# (ppu_numero, ppu_sufijo, id) con búsquedas LIMITadas sobre idx_ppu_tipo_anio, y se
+# intercalan D, L, D, L... en Python; los "otros" (sin tipo/año reconocible) van al
+# final del año (el de fecha_ingreso), leídos por idx_ppu_otro_fecha.
+#
+# Coste por página: unas pocas búsquedas de `limit` filas por año tocado, más las
+# filas que descartan los filtros (abogado, texto, archivados) dentro de cada índice.
+# El total (COUNT) solo se calcula en la primera página y viaja en el cursor; las
+# páginas por ?page= (sin cursor) recorren desde el principio offset + limit filas.
+#
+# Diferencias con el orden anterior (ventanas ROW_NUMBER): los empates exactos de
+# (número, sufijo) se ordenan por id en la misma dirección, un LEG- sin año pasa a
+# "otros" de su año de ingreso y los "otros" van por registro_ppu e id, como en
+# _sort_and_interleave.
+register_schema_migration(
+    "0014_datapenal_ppu_otro",
+    [
+        "ALTER TABLE datapenal ADD COLUMN ppu_otro TINYINT(1) AS"
+        " (ppu_tipo NOT IN ('D', 'L', 'LEG') OR ppu_anio IS NULL) STORED INVISIBLE",
+        "ALTER TABLE datapenal ADD INDEX idx_ppu_otro_fecha (ppu_otro, fecha_ingreso)",
+    ],
+)
+
+_PPU_FLUJOS = {"D": ("D",), "L": ("L", "LEG")}
+
+
+def _encode_ppu_cursor(estado: dict) -> str:
+    raw = json.dumps(estado, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_ppu_cursor(raw: str):
+    try:
+        estado = json.loads(base64.urlsafe_b64decode(raw + "=" * (-len(raw) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(estado, dict) or not isinstance(estado.get("y"), int):
+        return None
+    return estado
+
+
+def _and(where_clause: str, cond: str) -> str:
+    return f"{where_clause} AND {cond}" if where_clause else f"WHERE {cond}"
+
+
+def _ppu_seek_flujo(cursor, where_clause, params, tipo, anio, desc, despues, limite):
+    """Siguientes `limite` filas (id, clave) de `tipo`/`anio` tras la clave `despues`."""
+    d = "DESC" if desc else "ASC"
+    where = _and(where_clause, "d.ppu_tipo = %s AND d.ppu_anio = %s")
+    args = list(params) + [tipo, anio]
+    if despues is not None:
+        where += f" AND (d.ppu_numero, d.ppu_sufijo, d.id) {'<' if desc else '>'} (%s, %s, %s)"
+        args += list(despues)
+    cursor.execute(
+        f"SELECT d.id, d.ppu_numero AS k_num, d.ppu_sufijo AS k_suf FROM datapenal d {where}"
+        f" ORDER BY d.ppu_numero {d}, d.ppu_sufijo {d}, d.id {d} LIMIT %s",
+        args + [limite],
+    )
+    return [(r["id"], [r["k_num"], r["k_suf"], r["id"]]) for r in cursor.fetchall()]
+
+
+def _ppu_seek_legajos(cursor, where_clause, params, anio, desc, despues, limite):
+    """L. y LEG- del año como un solo flujo (mezcla de dos búsquedas por índice)."""
+    filas = []
+    for tipo in _PPU_FLUJOS["L"]:
+        filas += _ppu_seek_flujo(cursor, where_clause, params, tipo, anio, desc, despues, limite)
+    filas.sort(key=lambda f: (f[1][0], f[1][1], f[1][2]), reverse=desc)
+    return filas[:limite]
+
+
+def _ppu_seek_otros(cursor, where_clause, params, anio, desc, despues, limite):
+    """"Otros" con fecha_ingreso en `anio`, por registro_ppu e id (como en Python)."""
+    where = _and(where_clause, "d.ppu_otro = 1 AND d.fecha_ingreso >= %s AND d.fecha_ingreso < %s")
+    args = list(params) + [f"{anio:04d}-01-01", f"{anio + 1:04d}-01-01"]
+    reg = "COALESCE(UPPER(TRIM(d.registro_ppu)), '')"
+    if despues is not None:
+        where += f" AND ({reg}, d.id) > (%s, %s)"
+        args += list(despues)
+    cursor.execute(
+        f"SELECT d.id, {reg} AS k_reg FROM datapenal d {where}"
+        " ORDER BY k_reg ASC, d.id ASC LIMIT %s",
+        args + [limite],
+    )
+    return [(r["id"], [r["k_reg"], r["id"]]) for r in cursor.fetchall()]
+
+
+def _ppu_siguiente_anio(cursor, where_clause, params, desc, antes=None):
+    """Año siguiente (en el orden de la página) con filas, o None."""
+    cmp = "<" if desc else ">"
+    agg = "MAX" if desc else "MIN"
+    where = _and(where_clause, "d.ppu_tipo IN ('D', 'L', 'LEG') AND d.ppu_anio IS NOT NULL")
+    args = list(params)
+    if antes is not None:
+        where += f" AND d.ppu_anio {cmp} %s"
+        args.append(antes)
+    cursor.execute(f"SELECT {agg}(d.ppu_anio) AS anio FROM datapenal d {where}", args)
+    candidatos = [(cursor.fetchone() or {}).get("anio")]
+
+    where = _and(where_clause, "d.ppu_otro = 1 AND d.fecha_ingreso IS NOT NULL")
+    args = list(params)
+    if antes is not None:
+        if desc:
+            where += " AND d.fecha_ingreso < %s"
+            args.append(f"{antes:04d}-01-01")
+        else:
+            where += " AND d.fecha_ingreso >= %s"
+            args.append(f"{antes + 1:04d}-01-01")
+    cursor.execute(f"SELECT YEAR({agg}(d.fecha_ingreso)) AS anio FROM datapenal d {where}", args)
+    candidatos.append((cursor.fetchone() or {}).get("anio"))
+
+    candidatos = [int(a) for a in candidatos if a is not None]
+    if not candidatos:
+        return None
+    return max(candidatos) if desc else min(candidatos)
+
+
+def _buscar_page_sql(cursor, where_clause, params, order_ppu="desc", interleave=True,
+                     limit=200, offset=0, after=None):
+    """
+    Página de `buscar` por búsquedas indexadas. Devuelve (filas, total, next_cursor).
+
+    `after` es el estado decodificado de un cursor anterior: año, fase ("dl" u
+    "otros"), última clave leída de cada flujo, a quién le toca en el intercalado y
+    el total. Sin cursor se salta `offset` filas recorriéndolas.
+    """
+    desc = (order_ppu or "desc").strip().lower() != "asc"
+
+    if after is not None and after.get("n") is not None:
+        total = int(after["n"])
+    else:
+        cursor.execute(f"SELECT COUNT(*) AS total FROM datapenal d {where_clause}", params)
+        total = int((cursor.fetchone() or {}).get("total") or 0)
+
+    if after is not None:
+        estado = dict(after)
+        offset = 0
+    else:
+        anio = _ppu_siguiente_anio(cursor, where_clause, params, desc)
+        if anio is None:
+            return [], total, None
+        estado = {"y": anio, "f": "dl", "d": None, "l": None, "t": "D", "o": None}
+
+    pedir = offset + limit
+    ids = []
+    while len(ids) < pedir and estado is not None:
+        anio, faltan = estado["y"], pedir - len(ids)
+        if estado["f"] == "dl":
+            den = _ppu_seek_flujo(cursor, where_clause, params, "D", anio, desc, estado["d"], faltan)
+            leg = _ppu_seek_legajos(cursor, where_clause, params, anio, desc, estado["l"], faltan)
+            i = j = 0
+            while len(ids) < pedir and (i < len(den) or j < len(leg)):
+                # Intercalado: D, L, D, L...; sin intercalar, todas las D y luego las L
+                toca_d = estado["t"] == "D" if interleave else True
+                if (toca_d and i < len(den)) or j >= len(leg):
+                    ids.append(den[i][0]); estado["d"] = den[i][1]; i += 1
+                    estado["t"] = "L"
+                else:
+                    ids.append(leg[j][0]); estado["l"] = leg[j][1]; j += 1
+                    estado["t"] = "D"
+            if i == len(den) and j == len(leg) and len(den) < faltan and len(leg) < faltan:
+                estado.update(f="otros", o=None)
+            continue
+        otros = _ppu_seek_otros(cursor, where_clause, params, anio, desc, estado["o"], faltan)
+        for id_, clave in otros:
+            ids.append(id_)
+            estado["o"] = clave
+        if len(otros) < faltan:
+            siguiente = _ppu_siguiente_anio(cursor, where_clause, params, desc, anio)
+            estado = None if siguiente is None else {
+                "y": siguiente, "f": "dl", "d": None, "l": None, "t": "D", "o": None,
+            }
+
+    ids = ids[offset:]
+    if not ids:
+        return [], total, None
+    placeholders = ", ".join(["%s"] * len(ids))
+    cursor.execute(f"SELECT d.* FROM datapenal d WHERE d.id IN ({placeholders})", ids)
+    by_id = {r["id"]: r for r in cursor.fetchall()}
+    rows = [by_id[i] for i in ids if i in by_id]
+
+    next_cursor = None
+    if estado is not None and len(ids) == limit:
+        next_cursor = _encode_ppu_cursor(dict(estado, n=total))
+    return rows, total, next_cursor
+
 # ---------------------------------------------------------------------
 #  /api/datapenal/buscar  (versión mejorada: rango + orden PPU + intercalado)
 # ---------------------------------------------------------------------
@@ -779,6 +969,12 @@ def buscar():
     - abogado (según rol y ?abogado=)
     - mostrar_archivados (etiqueta != 'ARCHIVO')
     - paginación: page, limit
+
+    Motor:
+    - engine=sql (default): orden, intercalado y página con búsquedas indexadas
+      sobre las columnas ppu_* (ver _buscar_page_sql). Devuelve `next_cursor`;
+      pasarlo como ?cursor= pide la página siguiente sin recorrer las anteriores.
+    - engine=python: comportamiento anterior (ordena todo el rango en memoria).
     """
 
     hoy = date.today()
@@ -812,6 +1008,13 @@ def buscar():
     limit = max(1, min(limit, 10000))
     offset = (page - 1) * limit
 
+    # Motor de orden/paginación y cursor keyset
+    engine = (request.args.get("engine", "") or "").strip().lower() or "sql"
+    cursor_raw = (request.args.get("cursor", "") or "").strip()
+    after = _decode_ppu_cursor(cursor_raw) if cursor_raw else None
+    if cursor_raw and after is None:
+        return jsonify({"error": "Parámetro 'cursor' inválido."}), 400
+
     # Otros filtros
     mostrar_archivados = _safe_bool(request.args.get("mostrar_archivados", "true"), default=True)
 
@@ -906,6 +1109,11 @@ def buscar():
                 )
                 params.append(q_like)
             conditions.append("(" + " OR ".join(subconds) + ")")
+            # Candidatos desde el índice invertido: el LIKE solo se evalúa sobre ellos
+            filtro_txt = text_index_filter(connection, q_raw, alias="d")
+            if filtro_txt:
+                conditions.append(filtro_txt[0])
+                params.extend(filtro_txt[1])
 
         # 3) Excluir archivados si corresponde
         if not mostrar_archivados:
@@ -914,28 +1122,49 @@ def buscar():
 
         # 4) Filtro abogado (usando parte final tras ';')
         if abogado_filter:
-            conditions.append("UPPER(TRIM(SUBSTRING_INDEX(d.abogado, ';', -1))) = %s")
+            conditions.append("d.abogado_key = %s")
             params.append(abogado_filter)
 
         where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
 
-        # Traemos todo del rango para poder ordenar/intercalar correctamente
-        sql = f"""
-            SELECT d.*
-            FROM datapenal d
-            {where_clause}
-        """
+        data_page = None
+        next_cursor = None
+        if engine == "sql":
+            try:
+                data_page, total_records, next_cursor = _buscar_page_sql(
+                    cursor, where_clause, params,
+                    order_ppu=order_ppu, interleave=interleave,
+                    limit=limit, offset=offset, after=after,
+                )
+            except mysql.connector.Error as err:
+                # p. ej. columnas ppu_* aún no migradas: se usa el camino en memoria
+                current_app.logger.warning("buscar: orden en SQL no disponible (%s); se usa engine=python", err)
+                engine = "python"
+
+        if engine != "sql":
+            # Traemos todo del rango para poder ordenar/intercalar correctamente
+            sql = f"""
+                SELECT d.*
+                FROM datapenal d
+                {where_clause}
+            """
 
-        current_app.logger.debug("buscar SQL:\n%s", sql)
-        current_app.logger.debug("buscar params: %s", params)
+            current_app.logger.debug("buscar SQL:\n%s", sql)
+            current_app.logger.debug("buscar params: %s", params)
 
-        cursor.execute(sql, params)
-        rows = cursor.fetchall()
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
 
-        current_app.logger.debug("buscar: filas obtenidas desde BD (antes de ordenar/paginar): %d", len(rows))
+            current_app.logger.debug("buscar: filas obtenidas desde BD (antes de ordenar/paginar): %d", len(rows))
 
-        # Limpieza abogado + Nones
-        for row in rows:
+            # Orden por PPU + intercalado por año (D/L)
+            rows_sorted = _sort_and_interleave(rows, order_ppu=order_ppu, interleave=interleave)
+
+            total_records = len(rows_sorted)
+            data_page = rows_sorted[offset: offset + limit]
+
+        # Limpieza abogado + Nones (solo la página)
+        for row in data_page:
             abogado = row.get("abogado") or ""
             if ";" in abogado:
                 row["abogado"] = abogado.split(";")[-1].strip()
@@ -943,12 +1172,7 @@ def buscar():
                 if v is None:
                     row[k] = ""
 
-        # Orden por PPU + intercalado por año (D/L)
-        rows_sorted = _sort_and_interleave(rows, order_ppu=order_ppu, interleave=interleave)
-
-        total_records = len(rows_sorted)
         total_pages = (total_records + limit - 1) // limit
-        data_page = rows_sorted[offset: offset + limit]
 
         respuesta = {
             "data": data_page,
@@ -961,6 +1185,8 @@ def buscar():
             "used_year": None,  # lo mantengo para no romper nada
             "order_ppu": order_ppu,
             "interleave": interleave,
+            "engine": engine,
+            "next_cursor": next_cursor,
         }
         return jsonify(respuesta), 200
 
@@ -983,6 +1209,16 @@ def buscar():
 #  Opcional: si el front manda from & to => filtra por fecha_ingreso
 # ---------------------------------------------------------------------
 
+# Claves de orden de parse_ppu / sufijo() sobre las columnas ppu_* (mismo orden que
+# el sort en Python, resuelto por MySQL mientras se recorre el cursor)
+_SQL_EXPORT_ANIO = "COALESCE(ppu_anio, 0)"
+_SQL_EXPORT_PRIORIDAD = "CASE ppu_tipo WHEN 'D' THEN 1 WHEN 'LEG' THEN 2 WHEN 'L' THEN 3 ELSE 4 END"
+_SQL_EXPORT_SUFIJO = (
+    "CASE WHEN registro_ppu LIKE '%-%-%-%'"
+    " THEN UPPER(SUBSTRING_INDEX(SUBSTRING_INDEX(registro_ppu, '-', 4), '-', -1))"
+    " ELSE '' END"
+)
+
 @datapenal_bp.route("/exportar_excel", methods=["GET"])
 @login_required
 def exportar_excel():
@@ -997,7 +1233,8 @@ def exportar_excel():
           * tipo (ALL | LEGAJO | DENUNCIA)
           * (Compat) ppu_inicio/ppu_fin opcional como filtro extra
       - Métricas por año y totales
-      - Formato avanzado: tablas de Excel, centrado, anchos inteligentes, filas prohibidas en rojo
+      - Formato avanzado: cabecera con autofiltro, centrado, anchos inteligentes, filas prohibidas en rojo
+      - Memoria constante: filas desde el cursor a hojas constant_memory (excel_stream) y envío por trozos
       - ✅ Orden columnas: registro_ppu (1ra fija). fecha_ingreso NO es fija.
       - ✅ TODAS las columnas tipo fecha -> Excel Date real + formato dd-mm-aaaa (filtrable)
       - ✅ Ajuste “inteligente”: centrado y simétrico, pero sin reventar por textos largos (p.ej. 1500 palabras)
@@ -1087,9 +1324,9 @@ def exportar_excel():
             conds.append("(etiqueta IS NULL OR etiqueta <> %s)")
             params.append("ARCHIVO")
 
-        # 3) Abogado
+        # 3) Abogado (columna abogado_key indexada junto con fecha_ingreso)
         if abogado_filter:
-            conds.append("UPPER(TRIM(SUBSTRING_INDEX(abogado,';',-1))) = %s")
+            conds.append("abogado_key = %s")
             params.append(abogado_filter)
 
         # 4) Búsqueda global
@@ -1114,90 +1351,59 @@ def exportar_excel():
                 sub.append(f"{c} REGEXP %s")
                 params.append(rx)
             conds.append("(" + " OR ".join(sub) + ")")
+            filtro_txt = text_index_filter(conn, query)
+            if filtro_txt:
+                conds.append(filtro_txt[0])
+                params.extend(filtro_txt[1])
 
-        where = "WHERE " + " AND ".join(conds) if conds else ""
-
-        cursor.execute(f"SELECT * FROM datapenal {where}", params)
-        rows = cursor.fetchall()
+        # ── Tipo: LEGAJO / DENUNCIA (sobre la columna ppu_tipo indexada) ──
+        if tipo == "LEGAJO":
+            conds.append("ppu_tipo <> 'D'")
+        elif tipo == "DENUNCIA":
+            conds.append("ppu_tipo = 'D'")
 
-        # Orden inicial
-        rows.sort(key=lambda r: parse_ppu(r.get("registro_ppu")))
+        where = "WHERE " + " AND ".join(conds) if conds else ""
 
         # ── Filtro por rango PPU (SOLO si llega) ──
-        if ppu_inicio or ppu_fin:
-            start_t = parse_ppu(ppu_inicio) if ppu_inicio else (0, 0, 0, "")
-            end_t = parse_ppu(ppu_fin) if ppu_fin else (999999, 9999, 9999, "ZZZZ")
-            y_min, y_max = start_t[1], end_t[1]
-
-            rows = [
-                r for r in rows
-                if y_min <= parse_ppu(r.get("registro_ppu"))[1] <= y_max
-                and start_t <= parse_ppu(r.get("registro_ppu")) <= end_t
-            ]
+        start_t = parse_ppu(ppu_inicio) if ppu_inicio else (0, 0, 0, "")
+        end_t = parse_ppu(ppu_fin) if ppu_fin else (999999, 9999, 9999, "ZZZZ")
+        y_min, y_max = start_t[1], end_t[1]
 
-        final = rows
-
-        # Tipo: LEGAJO / DENUNCIA
-        if tipo == "LEGAJO":
-            final = [
-                r for r in final
-                if not str(r.get("registro_ppu", "")).upper().startswith("D-")
-            ]
-        elif tipo == "DENUNCIA":
-            final = [
-                r for r in final
-                if str(r.get("registro_ppu", "")).upper().startswith("D-")
-            ]
+        def _en_rango(r):
+            if not (ppu_inicio or ppu_fin):
+                return True
+            t = parse_ppu(r.get("registro_ppu"))
+            return y_min <= t[1] <= y_max and start_t <= t <= end_t
 
         banned_kw = ["ACUM", "ACUMULADO", "SUSPENDIDO", "ANULADO", "DERIVADO", "DUPLICADO"]
-        for r in final:
-            ab = (r.get("abogado") or "").split(";")[-1].strip().upper()
-            r["abogado"] = ab
-            r["_prohibida"] = any(kw in ab for kw in banned_kw)
-
-        # ── Agrupar por año de PPU ──
-        data_by_year = defaultdict(list)
-        for r in final:
-            yr = parse_ppu(r.get("registro_ppu"))[1]
-            data_by_year[yr].append(r)
-        years = sorted(data_by_year.keys(), reverse=True)
 
         allowed = [
             "CUBA", "AGUILAR", "POLO", "MAU", "ASCURRA", "MARTINEZ",
             "FLORES", "PALACIOS", "POMAR", "ROJAS", "FRISANCHO", "NAVARRO",
         ]
-
-        keys = [abogado_filter] if abogado_filter else (allowed + ["OTROS"])
-        counts = {key: {str(y): 0 for y in years} | {"Total": 0} for key in keys}
-
-        for r in final:
-            if r.get("_prohibida"):
-                continue
-            ab = r.get("abogado", "")
-            if abogado_filter and ab != abogado_filter:
-                continue
-
-            key = (
-                ab if abogado_filter else
-                (difflib.get_close_matches(ab, allowed, n=1, cutoff=0.8) or ["OTROS"])[0]
-            )
-            yr = str(parse_ppu(r.get("registro_ppu"))[1])
-            counts.setdefault(key, {str(y): 0 for y in years} | {"Total": 0})
-            if yr in counts[key]:
-                counts[key][yr] += 1
-            counts[key]["Total"] += 1
-
-        metrics = []
-        for key in keys:
-            c = counts.get(key, {str(y): 0 for y in years} | {"Total": 0})
-            row = {"Abogado": key}
-            for y in years:
-                row[str(y)] = c.get(str(y), 0)
-            row["Total"] = c.get("Total", 0)
-            metrics.append(row)
+        def _preparar(r):
+            ab = abogado_key(r.get("abogado"))
+            r["abogado"] = ab
+            r["_prohibida"] = any(kw in ab for kw in banned_kw)
+            return r
+
+        # ── Caché: mismos filtros efectivos y misma versión de datapenal ──
+        cache_key = export_cache_key("exportar_excel", {
+            "from": f_ini_raw if use_date_filter else "",
+            "to": f_fin_raw if use_date_filter else "",
+            "query": query,
+            "mostrar_archivados": mostrar_archivados,
+            "abogado": abogado_filter,
+            "tipo": tipo if tipo in ("LEGAJO", "DENUNCIA") else "ALL",
+            "ppu_inicio": ppu_inicio,
+            "ppu_fin": ppu_fin,
+            "historico": is_historico,
+        }, data_version(conn, ["datapenal"]))
+        cached = send_cached_export(cache_key)
+        if cached is not None:
+            return cached
 
         # ── Excel ──
-        output = BytesIO()
         fecha_cod = datetime.now().strftime("%d-%m-%Y %Hh%Mm")
         display = abogado_filter or "GENERAL"
 
@@ -1209,404 +1415,167 @@ def exportar_excel():
         # Columnas a excluir SIEMPRE
         EXCLUDE_COLS = {"item", "fecha_e_situacional", "last_modified", "_prohibida", "id"}
 
-        def _to_excel_date(v):
-            if v is None or v == "":
-                return None
-            if isinstance(v, datetime):
-                return v.date()
-            if isinstance(v, date):
-                return v
-            s = str(v).strip()
-            if not s:
-                return None
-            try:
-                s2 = s.replace("Z", "")
-                if "T" in s2:
-                    s2 = s2.replace("T", " ")
-                if " " in s2:
-                    return datetime.fromisoformat(s2).date()
-                return date.fromisoformat(s2)
-            except Exception:
-                return None
-
-        def _looks_like_date_key(k: str) -> bool:
-            kk = (k or "").strip().lower()
-            if not kk:
-                return False
-            tokens = [
-                "fecha", "fch", "date", "ingreso", "venc", "vence", "notifi", "audien",
-                "plazo", "deriv", "recep", "remis", "emision", "cita", "acto",
-            ]
-            return any(t in kk for t in tokens)
-
-        def _coerce_date_fields(rr: dict) -> dict:
-            for k in list(rr.keys()):
-                if _looks_like_date_key(k):
-                    rr[k] = _to_excel_date(rr.get(k))
-            return rr
-
-        def _reorder_and_clean_for_excel(records):
-            out = []
-            for r in records:
-                rr = dict(r)
-
-                for k in list(rr.keys()):
-                    if k in EXCLUDE_COLS:
-                        rr.pop(k, None)
-
-                rr = _coerce_date_fields(rr)
-
-                ordered = {}
-                if "registro_ppu" in rr:
-                    ordered["registro_ppu"] = rr.get("registro_ppu")
-                for k, v in rr.items():
-                    if k != "registro_ppu":
-                        ordered[k] = v
-
-                out.append(ordered)
-            return out
-
-        def _safe_len(v) -> int:
-            try:
-                return len(str(v))
-            except Exception:
-                return 0
-
-        def _pick_wrap_columns(df: pd.DataFrame):
-            wrap_cols = set()
-            if df is None or df.empty:
-                return wrap_cols
-
-            for c in df.columns:
-                if str(c) == "registro_ppu":
-                    continue
-
-                max_len = 0
-                for v in df[c].head(300).tolist():
-                    L = _safe_len(v)
-                    if L > max_len:
-                        max_len = L
-                    if max_len >= 220:
-                        break
-
-                if max_len >= 220:
-                    wrap_cols.add(c)
-
-            return wrap_cols
-
-        def _date_to_datetime(v):
-            if v is None or v == "":
-                return None
-            if isinstance(v, datetime):
-                return v
-            if isinstance(v, date):
-                return datetime(v.year, v.month, v.day)
-            try:
-                s = str(v).strip().replace("Z", "")
-                if "T" in s:
-                    s = s.replace("T", " ")
-                if " " in s:
-                    return datetime.fromisoformat(s)
-                d = date.fromisoformat(s)
-                return datetime(d.year, d.month, d.day)
-            except Exception:
-                return None
-
-        def _rewrite_date_columns_as_excel_dates(ws, df, startrow, startcol, date_cols, date_fmt):
-            if df is None or df.empty or not date_cols:
-                return
-
-            for i in range(len(df)):
-                excel_row = startrow + 1 + i  # +1 por header
-                for col_name in date_cols:
-                    if col_name not in df.columns:
-                        continue
-                    j = df.columns.get_loc(col_name)
-                    excel_col = startcol + j
-                    val = df.iat[i, j]
-                    if pd.isna(val) or val is None or val == "":
-                        continue
-                    dt = _date_to_datetime(val)
-                    if dt is None:
-                        continue
-                    ws.write_datetime(excel_row, excel_col, dt, date_fmt)
-
-        with pd.ExcelWriter(output, engine="xlsxwriter", datetime_format="dd-mm-yyyy") as writer:
-            wb = writer.book
-
-            title_fmt = wb.add_format({
-                "align": "center",
-                "valign": "vcenter",
-                "bold": True,
-                "font_size": 14,
-            })
-
-            cell_fmt = wb.add_format({"align": "center", "valign": "vcenter", "text_wrap": False})
-            date_fmt = wb.add_format({"num_format": "dd-mm-yyyy", "align": "center", "valign": "vcenter"})
-            wrap_fmt = wb.add_format({"align": "center", "valign": "top", "text_wrap": True})
-
-            red_fmt = wb.add_format({"bg_color": "#FFC7CE", "font_color": "#9C0006"})
-            red_date_fmt = wb.add_format({
-                "bg_color": "#FFC7CE",
-                "font_color": "#9C0006",
-                "num_format": "dd-mm-yyyy",
-                "align": "center",
-                "valign": "vcenter",
-            })
-            red_wrap_fmt = wb.add_format({
-                "bg_color": "#FFC7CE",
-                "font_color": "#9C0006",
-                "align": "center",
-                "valign": "top",
-                "text_wrap": True,
-            })
-
-            # -----------------------------
-            # Helper para escribir una hoja de datos con TODO el formato
-            # -----------------------------
-            def _write_data_sheet(sheet_name: str, ordered_rows: list, sheet_title: str):
-                cleaned = _reorder_and_clean_for_excel(ordered_rows)
-                df = pd.DataFrame(cleaned)
-
-                df.to_excel(writer, sheet_name, startrow=1, startcol=1, index=False, header=True)
-                wsx = writer.sheets[sheet_name]
+        # Tipos de columna una sola vez (fecha / texto largo), no por fila
+        column_types = load_column_types(conn, "datapenal")
 
-                wsx.merge_range(
-                    0, 1, 0, 1 + max(1, df.shape[1]) - 1,
-                    sheet_title,
-                    title_fmt,
-                )
+        book = StreamingWorkbook()
+        try:
+            # Orden de las hojas: Métricas, CONSOLIDADO (opcional) y un año por hoja
+            ws = book.add_worksheet("Métricas")
 
-                nr2, nc2 = len(df), len(df.columns)
-                if nc2 <= 0:
-                    return
+            # ─────────────────────────────────────────────
+            # Hojas por año: un único recorrido ordenado por año y, dentro del año,
+            # por tipo, sufijo y número (el orden que antes se hacía en Python)
+            # ─────────────────────────────────────────────
+            sql_anios = (
+                f"SELECT *, {_SQL_EXPORT_ANIO} AS _anio FROM datapenal {where}"
+                f" ORDER BY _anio DESC, {_SQL_EXPORT_PRIORIDAD}, {_SQL_EXPORT_SUFIJO},"
+                " COALESCE(ppu_numero, 0), ppu_sufijo, id"
+            )
+            cursor.execute(sql_anios, params)
+            plan = ColumnPlan.from_cursor(cursor, column_types, exclude=EXCLUDE_COLS | {"_anio"})
 
-                wsx.add_table(
-                    1, 1, 1 + nr2, 1 + nc2 - 1,
-                    {"columns": [{"header": h} for h in df.columns], "style": "Table Style Medium 9"},
+            consolidado = None
+            if use_date_filter and (not is_historico):
+                consolidado = DataSheet(
+                    book, "CONSOLIDADO", plan,
+                    f"CONSOLIDADO (from {f_ini_raw} to {f_fin_raw}) - {display} a la fecha de {fecha_cod}",
                 )
 
-                # Freeze: header + 1ra columna fija (registro_ppu)
-                wsx.freeze_panes(2, 2)
-
-                wrap_cols = _pick_wrap_columns(df)
-
-                # widths inteligentes con caps
-                col_widths = {}
-                for col in df.columns:
-                    if str(col) == "registro_ppu":
-                        col_widths[col] = 20
-                        continue
-
-                    base = max(10, min(28, len(str(col)) + 2))
+            # Abogado canónico de cada abogado_key (tabla abogado_alias), sin difflib por fila
+            clave_abogado = {} if abogado_filter else resolve_abogado_aliases(allowed)
 
-                    max_seen = 0
-                    for v in df[col].head(250).tolist():
-                        L = _safe_len(v)
-                        if L > max_seen:
-                            max_seen = L
-                        if max_seen >= 120:
-                            break
-
-                    if _looks_like_date_key(str(col)):
-                        col_widths[col] = 14
-                    else:
-                        if str(col) in wrap_cols:
-                            col_widths[col] = min(40, max(base, 22))
-                        else:
-                            col_widths[col] = min(28, max(base, min(22, max_seen + 2)))
-
-                # apply columns fmt
-                for j, col in enumerate(df.columns):
-                    excel_col = 1 + j
-
-                    if str(col) == "registro_ppu":
-                        wsx.set_column(excel_col, excel_col, col_widths[col], cell_fmt)
-                        continue
-
-                    if _looks_like_date_key(str(col)):
-                        wsx.set_column(excel_col, excel_col, col_widths[col], date_fmt)
-                        continue
+            years = []
+            keys = [abogado_filter] if abogado_filter else (allowed + ["OTROS"])
+            counts = {key: {"Total": 0} for key in keys}
+            hoja = None
+            for r in iter_rows(cursor):
+                if not _en_rango(r):
+                    continue
+                r = _preparar(r)
+                yr = r.pop("_anio")
+                if not years or years[-1] != yr:
+                    if hoja is not None:
+                        hoja.finish()
+                    years.append(yr)
+                    hoja = DataSheet(
+                        book, str(yr), plan,
+                        f"Base de datos del año {yr} - {display} a la fecha de {fecha_cod}",
+                    )
+                hoja.write_row(r, r["_prohibida"])
+
+                # Métricas en el mismo recorrido
+                if r["_prohibida"]:
+                    continue
+                ab = r["abogado"]
+                if abogado_filter and ab != abogado_filter:
+                    continue
+                if abogado_filter:
+                    key = ab
+                else:
+                    key = clave_abogado.get(ab)
+                    if key is None:  # abogado dado de alta durante la exportación
+                        key = (difflib.get_close_matches(ab, allowed, n=1, cutoff=0.8) or ["OTROS"])[0]
+                        clave_abogado[ab] = key
+                c = counts.setdefault(key, {"Total": 0})
+                c[str(yr)] = c.get(str(yr), 0) + 1
+                c["Total"] += 1
+            if hoja is not None:
+                hoja.finish()
 
-                    if str(col) in wrap_cols:
-                        wsx.set_column(excel_col, excel_col, col_widths[col], wrap_fmt)
-                    else:
-                        wsx.set_column(excel_col, excel_col, col_widths[col], cell_fmt)
-
-                # fuerza fechas como Date real Excel
-                date_cols = [c for c in df.columns if _looks_like_date_key(str(c))]
-                _rewrite_date_columns_as_excel_dates(
-                    wsx, df,
-                    startrow=1, startcol=1,
-                    date_cols=date_cols,
-                    date_fmt=date_fmt,
+            # ─────────────────────────────────────────────
+            # ✅ CONSOLIDADO (solo si rango activo y NO histórico): TODO por registro_ppu
+            # ─────────────────────────────────────────────
+            if consolidado is not None:
+                cursor.execute(
+                    f"SELECT * FROM datapenal {where}"
+                    f" ORDER BY {_SQL_EXPORT_PRIORIDAD}, COALESCE(ppu_anio, 0),"
+                    " COALESCE(ppu_numero, 0), ppu_sufijo, id",
+                    params,
                 )
-
-                # row heights con cap
-                for idx in range(nr2):
-                    row_vals = df.iloc[idx].to_dict()
-                    max_len_row = 0
-                    for c in wrap_cols:
-                        if c in row_vals:
-                            max_len_row = max(max_len_row, _safe_len(row_vals.get(c)))
-                            if max_len_row >= 1200:
-                                break
-
-                    if max_len_row >= 220:
-                        scaled = 30 + int(min(90, (max_len_row - 220) / 11))
-                        wsx.set_row(2 + idx, min(120, max(30, scaled)))
-                    else:
-                        wsx.set_row(2 + idx, 18)
-
-                # filas prohibidas rojo
-                for idx, r in enumerate(ordered_rows):
-                    if r.get("_prohibida"):
-                        excel_row = 2 + idx
-                        for col_idx, col_name in enumerate(df.columns):
-                            val = df.iat[idx, col_idx]
-                            excel_col = 1 + col_idx
-
-                            if str(col_name) == "registro_ppu":
-                                if pd.isna(val):
-                                    wsx.write_blank(excel_row, excel_col, None, red_fmt)
-                                else:
-                                    wsx.write(excel_row, excel_col, val, red_fmt)
-                                continue
-
-                            if _looks_like_date_key(str(col_name)):
-                                if pd.isna(val):
-                                    wsx.write_blank(excel_row, excel_col, None, red_date_fmt)
-                                else:
-                                    dt = _date_to_datetime(val)
-                                    if dt is None:
-                                        wsx.write(excel_row, excel_col, str(val), red_fmt)
-                                    else:
-                                        wsx.write_datetime(excel_row, excel_col, dt, red_date_fmt)
-                                continue
-
-                            fmt = red_wrap_fmt if str(col_name) in wrap_cols else red_fmt
-                            if pd.isna(val):
-                                wsx.write_blank(excel_row, excel_col, None, fmt)
-                            else:
-                                wsx.write(excel_row, excel_col, val, fmt)
+                for r in iter_rows(cursor):
+                    if _en_rango(r):
+                        r = _preparar(r)
+                        consolidado.write_row(r, r["_prohibida"])
+                consolidado.finish()
 
             # ─────────────────────────────────────────────
             # Hoja Métricas (con gráfico)
             # ─────────────────────────────────────────────
-            dfm = pd.DataFrame(metrics)
-            if years:
-                dfm = dfm[["Abogado"] + [str(y) for y in years] + ["Total"]]
-
-            if "Total" in dfm.columns and len(dfm) > 0:
-                dfm = dfm.sort_values(by="Total", ascending=False).reset_index(drop=True)
-
-            dfm.to_excel(writer, "Métricas", startrow=1, startcol=1, index=False, header=True)
-
-            ws = writer.sheets["Métricas"]
-            last_col = 1 + max(1, dfm.shape[1]) - 1
-            ws.merge_range(0, 1, 0, last_col, f"Métricas de {display} al {fecha_cod}", title_fmt)
+            metrics = []
+            for key in keys:
+                c = counts.get(key, {})
+                row = {"Abogado": key}
+                for y in years:
+                    row[str(y)] = c.get(str(y), 0)
+                row["Total"] = c.get("Total", 0)
+                metrics.append(row)
+            metrics.sort(key=lambda m: m["Total"], reverse=True)
+            headers = ["Abogado"] + [str(y) for y in years] + ["Total"]
+
+            nr, nc = len(metrics), len(headers)
+            last_col = 1 + nc - 1
+            ws.merge_range(0, 1, 0, last_col, f"Métricas de {display} al {fecha_cod}", book.title_fmt)
+            for j, h in enumerate(headers):
+                ws.write_string(1, 1 + j, h, book.header_fmt)
+            for i, m in enumerate(metrics):
+                for j, h in enumerate(headers):
+                    ws.write(2 + i, 1 + j, m[h], book.cell_fmt)
+            ws.autofilter(1, 1, max(2, 1 + nr), last_col)
+            ws.set_column(1, last_col, 14, book.cell_fmt)
+            ws.set_column(1, 1, 18, book.cell_fmt)
+            ws.freeze_panes(2, 0)
+
+            header_row = 1
+            data_start_row = 2
+            data_end_row = 1 + nr
+            abg_col = 1
+            total_col = last_col
+
+            chart1 = book.add_chart({"type": "column"})
+            chart1.add_series({
+                "name":       ["Métricas", header_row, total_col],
+                "categories": ["Métricas", data_start_row, abg_col, data_end_row, abg_col],
+                "values":     ["Métricas", data_start_row, total_col, data_end_row, total_col],
+                "data_labels": {"value": True},
+            })
+            chart1.set_title({"name": "Totales por abogado"})
+            chart1.set_legend({"none": True})
+            chart1.set_y_axis({"major_gridlines": {"visible": True}})
+            chart1.set_style(10)
+            ws.insert_chart(1, 1 + nc + 2, chart1, {"x_scale": 1.25, "y_scale": 1.25})
 
-            nr, nc = len(dfm), len(dfm.columns)
-            if nc > 0:
-                ws.add_table(
-                    1, 1, 1 + nr, 1 + nc - 1,
-                    {"columns": [{"header": h} for h in dfm.columns], "style": "Table Style Medium 9"},
-                )
-                ws.set_column(1, 1 + nc - 1, 14, cell_fmt)
-                ws.set_column(1, 1, 18, cell_fmt)
-                ws.freeze_panes(2, 0)
-
-                header_row = 1
-                data_start_row = 2
-                data_end_row = 1 + nr
-                abg_col = 1
-                total_col = 1 + (nc - 1)
-
-                chart1 = wb.add_chart({"type": "column"})
-                chart1.add_series({
-                    "name":       ["Métricas", header_row, total_col],
-                    "categories": ["Métricas", data_start_row, abg_col, data_end_row, abg_col],
-                    "values":     ["Métricas", data_start_row, total_col, data_end_row, total_col],
+            if years:
+                summary_row = 3 + nr
+                ws.write(summary_row, 1, "Año", book.cell_fmt)
+                ws.write(summary_row, 2, "Total", book.cell_fmt)
+
+                for i, y in enumerate(years):
+                    total_y = sum(m[str(y)] for m in metrics)
+                    ws.write(summary_row + 1 + i, 1, str(y), book.cell_fmt)
+                    ws.write(summary_row + 1 + i, 2, total_y, book.cell_fmt)
+
+                chart2 = book.add_chart({"type": "line"})
+                chart2.add_series({
+                    "name":       "Total por año",
+                    "categories": ["Métricas", summary_row + 1, 1, summary_row + len(years), 1],
+                    "values":     ["Métricas", summary_row + 1, 2, summary_row + len(years), 2],
+                    "marker":     {"type": "circle", "size": 6},
                     "data_labels": {"value": True},
                 })
-                chart1.set_title({"name": "Totales por abogado"})
-                chart1.set_legend({"none": True})
-                chart1.set_y_axis({"major_gridlines": {"visible": True}})
-                chart1.set_style(10)
-                ws.insert_chart(1, 1 + nc + 2, chart1, {"x_scale": 1.25, "y_scale": 1.25})
-
-                if years:
-                    summary_row = 3 + nr
-                    ws.write(summary_row, 1, "Año", cell_fmt)
-                    ws.write(summary_row, 2, "Total", cell_fmt)
-
-                    totals_by_year = []
-                    for y in years:
-                        col = str(y)
-                        totals_by_year.append(int(dfm[col].sum()) if col in dfm.columns else 0)
-
-                    for i, y in enumerate(years):
-                        ws.write(summary_row + 1 + i, 1, str(y), cell_fmt)
-                        ws.write(summary_row + 1 + i, 2, totals_by_year[i], cell_fmt)
-
-                    chart2 = wb.add_chart({"type": "line"})
-                    chart2.add_series({
-                        "name":       "Total por año",
-                        "categories": ["Métricas", summary_row + 1, 1, summary_row + len(years), 1],
-                        "values":     ["Métricas", summary_row + 1, 2, summary_row + len(years), 2],
-                        "marker":     {"type": "circle", "size": 6},
-                        "data_labels": {"value": True},
-                    })
-                    chart2.set_title({"name": "Tendencia (Total por año)"})
-                    chart2.set_legend({"none": True})
-                    chart2.set_y_axis({"major_gridlines": {"visible": True}})
-                    chart2.set_style(10)
-                    ws.insert_chart(summary_row, 4, chart2, {"x_scale": 1.15, "y_scale": 1.0})
+                chart2.set_title({"name": "Tendencia (Total por año)"})
+                chart2.set_legend({"none": True})
+                chart2.set_y_axis({"major_gridlines": {"visible": True}})
+                chart2.set_style(10)
+                ws.insert_chart(summary_row, 4, chart2, {"x_scale": 1.15, "y_scale": 1.0})
 
-            # ─────────────────────────────────────────────
-            # ✅ NUEVO: CONSOLIDADO (solo si rango activo y NO histórico)
-            # ─────────────────────────────────────────────
-            if use_date_filter and (not is_historico):
-                consolidado_rows = sorted(final, key=lambda r: parse_ppu(r.get("registro_ppu")))
-                _write_data_sheet(
-                    "CONSOLIDADO",
-                    consolidado_rows,
-                    f"CONSOLIDADO (from {f_ini_raw} to {f_fin_raw}) - {display} a la fecha de {fecha_cod}",
-                )
-
-            # ─────────────────────────────────────────────
-            # Hojas por año
-            # ─────────────────────────────────────────────
-            def tipo_ord(p): return 0 if str(p).upper().startswith("D-") else 1
-
-            def sufijo(p):
-                parts = str(p).upper().split("-")
-                return parts[3] if len(parts) >= 4 else ""
-
-            for y in years:
-                ordered = sorted(
-                    data_by_year[y],
-                    key=lambda r: (
-                        tipo_ord(r.get("registro_ppu")),
-                        parse_ppu(r.get("registro_ppu"))[0],
-                        sufijo(r.get("registro_ppu")),
-                    ),
-                )
-
-                _write_data_sheet(
-                    str(y),
-                    ordered,
-                    f"Base de datos del año {y} - {display} a la fecha de {fecha_cod}",
-                )
+            path = book.close()
+        except Exception:
+            book.discard()
+            raise
 
-        excel_data = output.getvalue()
-        response = make_response(excel_data)
-        response.headers.set("Content-Disposition", f'attachment; filename="{filename}"')
-        response.headers.set(
-            "Content-Type",
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        )
-        return response
+        # El archivo queda en la caché de exportaciones y sale del disco por trozos
+        return cache_and_send(cache_key, path, filename)
 
     except Exception as e:
         current_app.logger.error("exportar_excel error: %s", e, exc_info=True)
@@ -1644,13 +1613,15 @@ def obtener_historiales():
             SELECT registro_ppu, version_id, abogado, denunciado, origen, juzgado,
                    fiscalia, departamento, e_situacional,
                    DATE_FORMAT(fecha_version, '%d-%m-%Y') AS fecha_version,
-                   usuario_modificacion, ruta
-            FROM datapenal_versioning
+                   usuario_modificacion, ruta, delta
+            FROM {{tabla}}
             WHERE registro_ppu IN ({format_strings})
-            ORDER BY registro_ppu, fecha_version DESC
         """
-        cursor.execute(sql, tuple(ppus))
-        rows = cursor.fetchall()
+        # Historial completo: versiones calientes y archivadas
+        sql, params = union_archivo(sql, ppus, "datapenal_versioning")
+        cursor.execute(sql + " ORDER BY registro_ppu, fecha_version DESC", params)
+        # Las versiones delta solo guardan lo que cambió: se completan con las anteriores
+        rows = reconstruir_versiones(cursor.fetchall())
 
         rows_filtrados = [
             row
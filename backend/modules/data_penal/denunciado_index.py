@@ -0,0 +1,393 @@
+# backend/modules/data_penal/denunciado_index.py
+# -*- coding: utf-8 -*-
+"""
+Índice difuso en memoria para la búsqueda por `denunciado` de /api/new_search.
+
+Cada fila de datapenal / consulta_ppupenal aporta sus nombres (el campo separado
+por comas), normalizados con la misma equivalencia V→B, Z→S, Y→I del buscador.
+Una fila coincide con la consulta si algún nombre la contiene (distancia 0) o está
+a distancia Levenshtein <= 2.
+
+- Contención: índice de trigramas nombre -> candidatos, verificados con `in`.
+- Distancia: diccionarios de borrados simétricos (SymSpell) sobre los primeros y
+  los últimos PREFIX_LEN caracteres. Si dos nombres están a distancia <= k, sus
+  prefijos (y sus sufijos) comparten un borrado de <= k caracteres, así que la
+  intersección de ambos diccionarios no pierde candidatos; se verifican con
+  Levenshtein completo.
+
+Los cambios llegan por la tabla `denunciado_cambios` (la llenan triggers) y se
+aplican al inicio de cada búsqueda.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import mysql.connector
+
+from backend.core import get_db_connection, register_schema_migration
+
+logger = logging.getLogger(__name__)
+
+try:
+    from rapidfuzz.distance.Levenshtein import distance as _rf_distance
+except ImportError:  # pragma: no cover - depende del entorno
+    _rf_distance = None
+
+MAX_DISTANCE = 2
+PREFIX_LEN = 7
+# Segundos que se releen los cambios recientes (commits que llegan fuera de orden)
+CHANGE_LOG_GRACE = 10
+CHANGE_LOG_RETENTION_DAYS = 7
+
+SOURCES = {"datapenal": "datapenal", "consulta": "consulta_ppupenal"}
+# Orden de las fuentes en los empates (el de new_search: datapenal primero)
+_SOURCE_RANK = {source: i for i, source in enumerate(SOURCES)}
+
+RowKey = Tuple[str, int]  # (source, id)
+
+
+# ---------------------------------------------------------------------
+#  Normalización y distancia (las mismas reglas que usaba new_search)
+# ---------------------------------------------------------------------
+
+_REPLACEMENTS = {"V": "B", "Z": "S", "Y": "I"}
+
+
+def normalize_name(text: str) -> str:
+    text = (text or "").upper().strip()
+    for old, new in _REPLACEMENTS.items():
+        text = text.replace(old, new)
+    return text
+
+
+def split_names(denunciado: str) -> List[str]:
+    """Nombres normalizados de un campo `denunciado` (separados por coma)."""
+    out = []
+    for token in (denunciado or "").split(","):
+        norm = normalize_name(token)
+        if norm:
+            out.append(norm)
+    return out
+
+
+def levenshtein(s: str, t: str, cutoff: Optional[int] = None) -> int:
+    """Distancia de Levenshtein; con `cutoff` devuelve cutoff + 1 apenas se supera."""
+    if _rf_distance is not None:
+        return _rf_distance(s, t, score_cutoff=cutoff)
+    if s == t:
+        return 0
+    if cutoff is not None and abs(len(s) - len(t)) > cutoff:
+        return cutoff + 1
+    if not s:
+        return len(t)
+    if not t:
+        return len(s)
+    if cutoff is None:
+        cutoff = max(len(s), len(t))
+    # Programación dinámica restringida a la banda |i - j| <= cutoff
+    big = cutoff + 1
+    n = len(t)
+    prev = [j if j <= cutoff else big for j in range(n + 1)]
+    for i in range(1, len(s) + 1):
+        lo = max(1, i - cutoff)
+        hi = min(n, i + cutoff)
+        cur = [big] * (n + 1)
+        cur[0] = i if i <= cutoff else big
+        si = s[i - 1]
+        row_min = cur[0]
+        for j in range(lo, hi + 1):
+            v = prev[j - 1] + (si != t[j - 1])
+            if prev[j] + 1 < v:
+                v = prev[j] + 1
+            if cur[j - 1] + 1 < v:
+                v = cur[j - 1] + 1
+            cur[j] = v if v < big else big
+            if cur[j] < row_min:
+                row_min = cur[j]
+        if row_min > cutoff:
+            return big
+        prev = cur
+    return prev[n] if prev[n] <= cutoff else big
+
+
+def match_distance(query_norm: str, names: Iterable[str]) -> Optional[int]:
+    """Distancia de la fila: 0 si algún nombre contiene la consulta, si no el mínimo Levenshtein."""
+    best = None
+    for name in names:
+        if query_norm in name:
+            return 0
+        d = levenshtein(query_norm, name, cutoff=MAX_DISTANCE)
+        if best is None or d < best:
+            best = d
+    return best
+
+
+def _deletes(word: str, max_distance: int = MAX_DISTANCE) -> Set[str]:
+    out = {word}
+    for k in range(1, min(max_distance, len(word)) + 1):
+        for idx in combinations(range(len(word)), k):
+            out.add("".join(c for i, c in enumerate(word) if i not in idx))
+    return out
+
+
+def _trigrams(word: str) -> Set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+# ---------------------------------------------------------------------
+#  Índice
+# ---------------------------------------------------------------------
+
+class DenunciadoIndex:
+    """Nombres normalizados -> filas, con búsquedas por contención y por distancia."""
+
+    def __init__(self):
+        self._rows_by_name: Dict[str, Set[RowKey]] = {}
+        self._names_by_row: Dict[RowKey, Set[str]] = {}
+        self._by_trigram: Dict[str, Set[str]] = {}
+        self._by_prefix: Dict[str, Set[str]] = {}
+        self._by_suffix: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._names_by_row)
+
+    # -- mantenimiento --
+    def add_row(self, key: RowKey, denunciado: str) -> None:
+        self.remove_row(key)
+        names = set(split_names(denunciado))
+        if not names:
+            return
+        self._names_by_row[key] = names
+        for name in names:
+            rows = self._rows_by_name.get(name)
+            if rows is None:
+                rows = self._rows_by_name[name] = set()
+                for tri in _trigrams(name):
+                    self._by_trigram.setdefault(tri, set()).add(name)
+                for variant in _deletes(name[:PREFIX_LEN]):
+                    self._by_prefix.setdefault(variant, set()).add(name)
+                for variant in _deletes(name[-PREFIX_LEN:]):
+                    self._by_suffix.setdefault(variant, set()).add(name)
+            rows.add(key)
+
+    def remove_row(self, key: RowKey) -> None:
+        names = self._names_by_row.pop(key, None)
+        if not names:
+            return
+        for name in names:
+            rows = self._rows_by_name.get(name)
+            if rows is None:
+                continue
+            rows.discard(key)
+            if rows:
+                continue
+            del self._rows_by_name[name]
+            for tri in _trigrams(name):
+                bucket = self._by_trigram.get(tri)
+                if bucket is not None:
+                    bucket.discard(name)
+                    if not bucket:
+                        del self._by_trigram[tri]
+            for table, part in ((self._by_prefix, name[:PREFIX_LEN]),
+                                (self._by_suffix, name[-PREFIX_LEN:])):
+                for variant in _deletes(part):
+                    bucket = table.get(variant)
+                    if bucket is not None:
+                        bucket.discard(name)
+                        if not bucket:
+                            del table[variant]
+
+    # -- consulta --
+    def _containing(self, q: str) -> Set[str]:
+        if len(q) < 3:
+            return {name for name in self._rows_by_name if q in name}
+        buckets = []
+        for tri in _trigrams(q):
+            bucket = self._by_trigram.get(tri)
+            if not bucket:
+                return set()
+            buckets.append(bucket)
+        buckets.sort(key=len)
+        cands = set(buckets[0])
+        for bucket in buckets[1:]:
+            cands &= bucket
+            if not cands:
+                return cands
+        return {name for name in cands if q in name}
+
+    def _near(self, q: str) -> Dict[str, int]:
+        by_prefix: Set[str] = set()
+        for variant in _deletes(q[:PREFIX_LEN]):
+            bucket = self._by_prefix.get(variant)
+            if bucket:
+                by_prefix |= bucket
+        if not by_prefix:
+            return {}
+        cands: Set[str] = set()
+        for variant in _deletes(q[-PREFIX_LEN:]):
+            bucket = self._by_suffix.get(variant)
+            if bucket:
+                cands |= bucket & by_prefix
+        out = {}
+        qlen = len(q)
+        for name in cands:
+            if abs(len(name) - qlen) > MAX_DISTANCE:
+                continue
+            d = levenshtein(q, name, cutoff=MAX_DISTANCE)
+            if d <= MAX_DISTANCE:
+                out[name] = d
+        return out
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[RowKey, int]]:
+        """
+        Filas a distancia <= MAX_DISTANCE ordenadas por (distancia, fuente, id), con
+        datapenal antes que consulta; con `limit` solo las `limit` primeras.
+        """
+        q = normalize_name(query)
+        if not q:
+            return []
+        best: Dict[RowKey, int] = {}
+        for name in self._containing(q):
+            for key in self._rows_by_name[name]:
+                best[key] = 0
+        for name, d in self._near(q).items():
+            for key in self._rows_by_name[name]:
+                if d < best.get(key, MAX_DISTANCE + 1):
+                    best[key] = d
+        ranked = [(d, _SOURCE_RANK.get(key[0], len(SOURCES)), key) for key, d in best.items()]
+        if limit is not None and limit < len(ranked):
+            ranked = heapq.nsmallest(limit, ranked)
+        else:
+            ranked.sort()
+        return [(key, d) for d, _rank, key in ranked]
+
+
+# ---------------------------------------------------------------------
+#  Sincronización con MySQL
+# ---------------------------------------------------------------------
+
+def _change_triggers(table: str, tag: str) -> List[str]:
+    ins = f"INSERT INTO denunciado_cambios (tabla, ref_id) VALUES ('{table}', %s.id)"
+    return [
+        f"CREATE TRIGGER trg_denunciado_{tag}_i AFTER INSERT ON {table} FOR EACH ROW "
+        + ins % "NEW",
+        f"CREATE TRIGGER trg_denunciado_{tag}_u AFTER UPDATE ON {table} FOR EACH ROW "
+        f"BEGIN IF NOT (OLD.denunciado <=> NEW.denunciado) THEN {ins % 'NEW'}; END IF; END",
+        f"CREATE TRIGGER trg_denunciado_{tag}_d AFTER DELETE ON {table} FOR EACH ROW "
+        + ins % "OLD",
+    ]
+
+
+register_schema_migration(
+    "0003_denunciado_cambios",
+    [
+        "CREATE TABLE IF NOT EXISTS denunciado_cambios ("
+        " seq BIGINT AUTO_INCREMENT PRIMARY KEY,"
+        " tabla VARCHAR(32) NOT NULL,"
+        " ref_id BIGINT NOT NULL,"
+        " creado TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+        " INDEX idx_creado (creado)"
+        ")",
+    ]
+    + _change_triggers("datapenal", "dp")
+    + _change_triggers("consulta_ppupenal", "cons"),
+)
+
+_index: Optional[DenunciadoIndex] = None
+_watermark = 0
+_last_purge = 0.0
+_lock = threading.Lock()
+
+
+def _load_rows(cur, source: str, ids: Optional[List[int]] = None):
+    table = SOURCES[source]
+    if ids is None:
+        cur.execute(f"SELECT id, denunciado FROM {table} WHERE denunciado IS NOT NULL")
+    else:
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur.execute(f"SELECT id, denunciado FROM {table} WHERE id IN ({placeholders})", ids)
+    return cur.fetchall()
+
+
+def _build(cur) -> DenunciadoIndex:
+    global _watermark
+    # La marca se toma antes de leer: lo que cambie durante la carga se reaplica
+    cur.execute("SELECT COALESCE(MAX(seq), 0) FROM denunciado_cambios")
+    _watermark = int(cur.fetchone()[0])
+    idx = DenunciadoIndex()
+    for source in SOURCES:
+        for row_id, denunciado in _load_rows(cur, source):
+            idx.add_row((source, row_id), denunciado)
+    logger.info("Índice de denunciados construido: %d filas", len(idx))
+    return idx
+
+
+def _apply_changes(cur, idx: DenunciadoIndex) -> None:
+    global _watermark, _last_purge
+    cur.execute(
+        "SELECT seq, tabla, ref_id, creado < NOW() - INTERVAL %s SECOND"
+        " FROM denunciado_cambios WHERE seq > %s ORDER BY seq",
+        (CHANGE_LOG_GRACE, _watermark),
+    )
+    changes = cur.fetchall()
+    if not changes:
+        return
+    by_source: Dict[str, Set[int]] = {}
+    table_to_source = {t: s for s, t in SOURCES.items()}
+    settled, advancing = _watermark, True
+    for seq, tabla, ref_id, old_enough in changes:
+        source = table_to_source.get(tabla)
+        if source is not None:
+            by_source.setdefault(source, set()).add(int(ref_id))
+        # La marca solo avanza sobre el tramo inicial de cambios "asentados";
+        # los recientes se vuelven a leer en la próxima búsqueda (es idempotente)
+        if advancing and old_enough:
+            settled = seq
+        else:
+            advancing = False
+    for source, ids in by_source.items():
+        ids = sorted(ids)
+        found = {row_id: den for row_id, den in _load_rows(cur, source, ids)}
+        for row_id in ids:
+            if row_id in found:
+                idx.add_row((source, row_id), found[row_id])
+            else:
+                idx.remove_row((source, row_id))
+    _watermark = settled
+
+    if time.monotonic() - _last_purge > 3600:
+        _last_purge = time.monotonic()
+        cur.execute(
+            "DELETE FROM denunciado_cambios WHERE seq <= %s AND creado < NOW() - INTERVAL %s DAY",
+            (_watermark, CHANGE_LOG_RETENTION_DAYS),
+        )
+
+
+def search_denunciado(query: str, limit: Optional[int] = None) -> Optional[List[Tuple[RowKey, int]]]:
+    """
+    Filas ((fuente, id), distancia) que coinciden con `query`, o None si el índice
+    no está disponible (sin conexión o tabla de cambios aún no migrada).
+    """
+    global _index
+    with _lock:
+        cnx = get_db_connection()
+        if cnx is None:
+            return None
+        cur = cnx.cursor()
+        try:
+            if _index is None:
+                _index = _build(cur)
+            else:
+                _apply_changes(cur, _index)
+            cnx.commit()
+            return _index.search(query, limit)
+        except mysql.connector.Error as err:
+            logger.warning("Índice de denunciados no disponible: %s", err)
+            return None
+        finally:
+            cur.close()
+            cnx.close()
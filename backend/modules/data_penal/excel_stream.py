@@ -0,0 +1,259 @@
+# backend/modules/data_penal/excel_stream.py
+# -*- coding: utf-8 -*-
+"""
+Motor de exportación a Excel con memoria constante.
+
+- StreamingWorkbook: xlsxwriter en modo `constant_memory` sobre un archivo temporal;
+  cada fila se vuelca a disco al pasar a la siguiente.
+- ColumnPlan: decide UNA vez por columna (a partir de INFORMATION_SCHEMA) si es el
+  PPU, una fecha, texto largo (con ajuste de línea) o texto normal.
+- DataSheet: hoja de datos (título, cabecera, autofiltro, filas prohibidas en rojo,
+  alturas y anchos) que recibe las filas de una en una, tal como salen del cursor.
+- send_workbook: envía el archivo por trozos y lo borra al cerrar la respuesta.
+
+En constant_memory no se pueden crear tablas de Excel (add_table): la cabecera lleva
+un formato propio y el rango de datos un autofiltro.
+"""
+
+import os
+import tempfile
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import xlsxwriter
+from flask import send_file
+
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+FETCH_BATCH = 500
+# Filas que se miran para el ancho de las columnas de texto normal
+WIDTH_SAMPLE_ROWS = 250
+# Texto a partir del cual la fila crece (columnas con ajuste de línea)
+WRAP_MIN_LEN = 220
+
+_DATE_TYPES = {"date", "datetime", "timestamp"}
+_TEXT_TYPES = {"tinytext", "text", "mediumtext", "longtext"}
+_CHAR_TYPES = {"char", "varchar"}
+_DATE_NAME_TOKENS = (
+    "fecha", "fch", "date", "ingreso", "venc", "vence", "notifi", "audien",
+    "plazo", "deriv", "recep", "remis", "emision", "cita", "acto",
+)
+
+
+def looks_like_date_key(name: str) -> bool:
+    kk = (name or "").strip().lower()
+    return bool(kk) and any(t in kk for t in _DATE_NAME_TOKENS)
+
+
+def to_excel_datetime(v) -> Optional[datetime]:
+    """Fecha (sin hora) como datetime para write_datetime, o None si no es fecha."""
+    if v is None or v == "":
+        return None
+    if isinstance(v, datetime):
+        return datetime(v.year, v.month, v.day)
+    if isinstance(v, date):
+        return datetime(v.year, v.month, v.day)
+    try:
+        s = str(v).strip().replace("Z", "")
+        if "T" in s:
+            s = s.replace("T", " ")
+        if " " in s:
+            d = datetime.fromisoformat(s)
+        else:
+            d = date.fromisoformat(s)
+        return datetime(d.year, d.month, d.day)
+    except Exception:
+        return None
+
+
+def load_column_types(connection, table: str) -> Dict[str, Tuple[str, Optional[int]]]:
+    """{columna: (DATA_TYPE, CHARACTER_MAXIMUM_LENGTH)} de `table` en el esquema actual."""
+    cur = connection.cursor()
+    try:
+        cur.execute(
+            "SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH"
+            " FROM INFORMATION_SCHEMA.COLUMNS"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+            (table,),
+        )
+        return {name: ((dtype or "").lower(), maxlen) for name, dtype, maxlen in cur.fetchall()}
+    finally:
+        cur.close()
+
+
+def iter_rows(cursor, batch: int = FETCH_BATCH) -> Iterable[dict]:
+    """Filas de un cursor sin buffer, de `batch` en `batch`."""
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        yield from rows
+
+
+class ColumnPlan:
+    """Columnas a exportar y su tipo de celda: "ppu", "date", "wrap" o "text"."""
+
+    def __init__(self, names: List[str], types: Dict[str, Tuple[str, Optional[int]]],
+                 exclude: Iterable[str] = (), first: Optional[str] = "registro_ppu"):
+        excluded = set(exclude)
+        names = [n for n in names if n not in excluded]
+        if first and first in names:
+            names.remove(first)
+            names.insert(0, first)
+        self.names = names
+        self.kinds = [self._kind(n, types.get(n), first) for n in names]
+        self.wrap_names = [n for n, k in zip(names, self.kinds) if k == "wrap"]
+
+    @staticmethod
+    def _kind(name, col_type, first) -> str:
+        if name == first:
+            return "ppu"
+        dtype, maxlen = col_type or ("", None)
+        if dtype in _DATE_TYPES:
+            return "date"
+        # Fechas guardadas como texto: solo se confía en el nombre si la columna es corta
+        if looks_like_date_key(name) and (not dtype or (dtype in _CHAR_TYPES and (maxlen or 0) <= 40)):
+            return "date"
+        if dtype in _TEXT_TYPES or (maxlen or 0) >= WRAP_MIN_LEN:
+            return "wrap"
+        return "text"
+
+    @classmethod
+    def from_cursor(cls, cursor, types, **kwargs) -> "ColumnPlan":
+        return cls([d[0] for d in cursor.description], types, **kwargs)
+
+
+class StreamingWorkbook:
+    """Workbook constant_memory en un archivo temporal con los formatos compartidos."""
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="penal_export_", suffix=".xlsx")
+        os.close(fd)
+        self.wb = xlsxwriter.Workbook(self.path, {
+            "constant_memory": True,
+            "default_date_format": "dd-mm-yyyy",
+        })
+        add = self.wb.add_format
+        self.title_fmt = add({"align": "center", "valign": "vcenter", "bold": True, "font_size": 14})
+        self.header_fmt = add({
+            "bold": True, "font_color": "#FFFFFF", "bg_color": "#4F81BD",
+            "align": "center", "valign": "vcenter", "border": 1,
+        })
+        self.cell_fmt = add({"align": "center", "valign": "vcenter", "text_wrap": False})
+        self.date_fmt = add({"num_format": "dd-mm-yyyy", "align": "center", "valign": "vcenter"})
+        self.wrap_fmt = add({"align": "center", "valign": "top", "text_wrap": True})
+        red = {"bg_color": "#FFC7CE", "font_color": "#9C0006"}
+        self.red_fmt = add(dict(red))
+        self.red_date_fmt = add(dict(red, num_format="dd-mm-yyyy", align="center", valign="vcenter"))
+        self.red_wrap_fmt = add(dict(red, align="center", valign="top", text_wrap=True))
+        self.formats = {
+            "ppu": (self.cell_fmt, self.red_fmt),
+            "date": (self.date_fmt, self.red_date_fmt),
+            "wrap": (self.wrap_fmt, self.red_wrap_fmt),
+            "text": (self.cell_fmt, self.red_fmt),
+        }
+
+    def add_worksheet(self, name: str):
+        return self.wb.add_worksheet(name)
+
+    def add_chart(self, options: dict):
+        return self.wb.add_chart(options)
+
+    def close(self) -> str:
+        self.wb.close()
+        return self.path
+
+    def discard(self) -> None:
+        try:
+            self.wb.close()
+        except Exception:
+            pass
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class DataSheet:
+    """
+    Hoja de datos escrita fila a fila: título en la fila 0, cabecera en la 1 y datos
+    desde la 2, a partir de la columna B. Los anchos se calculan mientras se escribe.
+    """
+
+    def __init__(self, book: StreamingWorkbook, name: str, plan: ColumnPlan, title: str):
+        self.book = book
+        self.plan = plan
+        self.ws = book.add_worksheet(name)
+        self.row = 2
+        self._seen_len = [0] * len(plan.names)
+        ncols = len(plan.names)
+        if ncols > 1:
+            self.ws.merge_range(0, 1, 0, ncols, title, book.title_fmt)
+        else:
+            self.ws.write_string(0, 1, title, book.title_fmt)
+        for j, name in enumerate(plan.names):
+            self.ws.write_string(1, 1 + j, str(name), book.header_fmt)
+
+    def write_row(self, values: dict, prohibida: bool = False) -> None:
+        ws, r = self.ws, self.row
+        max_len = 0
+        for name in self.plan.wrap_names:
+            v = values.get(name)
+            if v is not None:
+                max_len = max(max_len, len(str(v)))
+        if max_len >= WRAP_MIN_LEN:
+            ws.set_row(r, min(120, max(30, 30 + int(min(90, (max_len - WRAP_MIN_LEN) / 11)))))
+        else:
+            ws.set_row(r, 18)
+
+        sample = r - 2 < WIDTH_SAMPLE_ROWS
+        for j, (name, kind) in enumerate(zip(self.plan.names, self.plan.kinds)):
+            fmt = self.book.formats[kind][1 if prohibida else 0]
+            v = values.get(name)
+            if kind == "date":
+                v = to_excel_datetime(v)
+            if v is None or v == "":
+                if prohibida:
+                    ws.write_blank(r, 1 + j, None, fmt)
+                continue
+            if kind == "date":
+                ws.write_datetime(r, 1 + j, v, fmt)
+                continue
+            ws.write(r, 1 + j, v, fmt)
+            if sample and kind == "text":
+                self._seen_len[j] = max(self._seen_len[j], len(str(v)))
+        self.row += 1
+
+    def finish(self) -> int:
+        """Anchos, autofiltro y paneles fijos. Devuelve el número de filas de datos."""
+        ws = self.ws
+        for j, (name, kind) in enumerate(zip(self.plan.names, self.plan.kinds)):
+            fmt = self.book.formats[kind][0]
+            base = max(10, min(28, len(str(name)) + 2))
+            if kind == "ppu":
+                width = 20
+            elif kind == "date":
+                width = 14
+            elif kind == "wrap":
+                width = min(40, max(base, 22))
+            else:
+                width = min(28, max(base, min(22, self._seen_len[j] + 2)))
+            ws.set_column(1 + j, 1 + j, width, fmt)
+        if self.plan.names:
+            ws.autofilter(1, 1, max(1, self.row - 1), len(self.plan.names))
+        ws.freeze_panes(2, 2)
+        return self.row - 2
+
+
+def send_workbook(path: str, filename: str):
+    """Respuesta que envía `path` por trozos (sin cargarlo en memoria) y luego lo borra."""
+    response = send_file(path, mimetype=XLSX_MIMETYPE, as_attachment=True, download_name=filename)
+
+    def _cleanup():
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    response.call_on_close(_cleanup)
+    return response
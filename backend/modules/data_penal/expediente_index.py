@@ -0,0 +1,186 @@
+# backend/modules/data_penal/expediente_index.py
+# -*- coding: utf-8 -*-
+"""
+Componentes de los expedientes judiciales citados en `origen`, para la búsqueda
+`casoJudicial` de /api/new_search.
+
+La tabla `expediente_origen` guarda una fila por expediente encontrado en el
+`origen` de datapenal / consulta_ppupenal ("00123-2023-0-1801-JR-PE-01"), con sus
+partes como columnas generadas e indexadas:
+
+    numero-anio-incidente-sede-organo-especialidad-juzgado
+
+La mantienen triggers (procedimiento `penal_indexar_expedientes`), así que siempre
+está al día. Una consulta por fragmentos ("00123-2023-", "123-20", "0012") se
+resuelve con un rango sobre `numero` / `numero_sin_ceros` y el filtro fino de
+fragmentos solo corre sobre esos candidatos.
+"""
+
+import logging
+from typing import List, Optional, Tuple
+
+import mysql.connector
+
+from backend.core import register_schema_migration
+
+logger = logging.getLogger(__name__)
+
+# Mismo formato que exp_pattern_2 de new_search (exp_pattern_1 es un caso particular)
+EXPEDIENTE_REGEXP = "[0-9]{5}-[0-9]{4}-[0-9]{1,2}-[A-Z0-9]+-[A-Z]{2}-[A-Z]{2}-[0-9]{1,2}"
+# Expedientes que se extraen como máximo de un mismo `origen`
+EXPEDIENTES_POR_FILA = 10
+CANDIDATE_BATCH = 500
+
+SOURCES = {"datapenal": "datapenal", "consulta": "consulta_ppupenal"}
+
+RowKey = Tuple[str, int]  # (source, id)
+
+
+def _parte(n: int) -> str:
+    return f"SUBSTRING_INDEX(SUBSTRING_INDEX(expediente, '-', {n}), '-', -1)"
+
+
+def _triggers(table: str, tag: str) -> List[str]:
+    call = f"CALL penal_indexar_expedientes('{table}', NEW.id, NEW.origen)"
+    return [
+        f"CREATE TRIGGER trg_expediente_{tag}_i AFTER INSERT ON {table} FOR EACH ROW {call}",
+        f"CREATE TRIGGER trg_expediente_{tag}_u AFTER UPDATE ON {table} FOR EACH ROW "
+        f"BEGIN IF NOT (OLD.origen <=> NEW.origen) THEN {call}; END IF; END",
+        f"CREATE TRIGGER trg_expediente_{tag}_d AFTER DELETE ON {table} FOR EACH ROW "
+        f"DELETE FROM expediente_origen WHERE tabla = '{table}' AND ref_id = OLD.id",
+    ]
+
+
+def _carga_inicial(table: str) -> str:
+    numeros = " UNION ALL ".join(f"SELECT {n} AS n" for n in range(1, EXPEDIENTES_POR_FILA + 1))
+    extraido = f"REGEXP_SUBSTR(t.origen, '{EXPEDIENTE_REGEXP}', 1, k.n)"
+    return (
+        "INSERT IGNORE INTO expediente_origen (tabla, ref_id, pos, expediente)"
+        f" SELECT '{table}', t.id, k.n, UPPER({extraido})"
+        f" FROM {table} t JOIN ({numeros}) k"
+        f" WHERE t.origen REGEXP '{EXPEDIENTE_REGEXP}' AND {extraido} IS NOT NULL"
+    )
+
+
+register_schema_migration(
+    "0004_expediente_origen",
+    [
+        "CREATE TABLE IF NOT EXISTS expediente_origen ("
+        " tabla VARCHAR(32) NOT NULL,"
+        " ref_id BIGINT NOT NULL,"
+        " pos TINYINT UNSIGNED NOT NULL,"
+        " expediente VARCHAR(64) NOT NULL,"
+        " numero CHAR(5) AS (SUBSTRING_INDEX(expediente, '-', 1)) STORED,"
+        " numero_sin_ceros VARCHAR(5) AS (TRIM(LEADING '0' FROM SUBSTRING_INDEX(expediente, '-', 1))) STORED,"
+        f" anio SMALLINT UNSIGNED AS (CAST({_parte(2)} AS UNSIGNED)) STORED,"
+        f" incidente VARCHAR(2) AS ({_parte(3)}) STORED,"
+        f" sede VARCHAR(16) AS ({_parte(4)}) STORED,"
+        f" organo CHAR(2) AS ({_parte(5)}) STORED,"
+        f" especialidad CHAR(2) AS ({_parte(6)}) STORED,"
+        " juzgado VARCHAR(2) AS (SUBSTRING_INDEX(expediente, '-', -1)) STORED,"
+        " PRIMARY KEY (tabla, ref_id, pos),"
+        " INDEX idx_numero (tabla, numero, ref_id),"
+        " INDEX idx_numero_sin_ceros (tabla, numero_sin_ceros, ref_id),"
+        " INDEX idx_anio (anio, numero)"
+        ")",
+        "DROP PROCEDURE IF EXISTS penal_indexar_expedientes",
+        "CREATE PROCEDURE penal_indexar_expedientes("
+        " IN p_tabla VARCHAR(32), IN p_id BIGINT, IN p_origen TEXT)"
+        " BEGIN"
+        "  DECLARE n INT DEFAULT 1;"
+        "  DECLARE e VARCHAR(64);"
+        "  DELETE FROM expediente_origen WHERE tabla = p_tabla AND ref_id = p_id;"
+        f"  SET e = REGEXP_SUBSTR(p_origen, '{EXPEDIENTE_REGEXP}', 1, n);"
+        f"  WHILE e IS NOT NULL AND n <= {EXPEDIENTES_POR_FILA} DO"
+        "   INSERT IGNORE INTO expediente_origen (tabla, ref_id, pos, expediente)"
+        "   VALUES (p_tabla, p_id, n, UPPER(e));"
+        "   SET n = n + 1;"
+        f"   SET e = REGEXP_SUBSTR(p_origen, '{EXPEDIENTE_REGEXP}', 1, n);"
+        "  END WHILE;"
+        " END",
+    ]
+    + _triggers("datapenal", "dp")
+    + _triggers("consulta_ppupenal", "cons")
+    + [_carga_inicial("datapenal"), _carga_inicial("consulta_ppupenal")],
+)
+
+
+def coincide_expediente(expediente: str, query: str) -> bool:
+    """
+    Reglas de coincidencia de casoJudicial sobre un expediente:
+      - "123-" : el número, completado a 5 dígitos, es exactamente el del expediente.
+      - "0012" : el número empieza por el fragmento (con sus ceros).
+      - "12"   : el número sin ceros a la izquierda empieza por el fragmento.
+    Los fragmentos siguientes deben aparecer dentro de alguna de las demás partes.
+    """
+    parts = expediente.upper().split("-")
+    query_clean = query.strip().upper()
+    fragments = query_clean.split("-")
+    if query_clean.endswith("-"):
+        return fragments[0].isdigit() and parts[0] == fragments[0].zfill(5)
+    first = fragments[0]
+    if first.startswith("0"):
+        if not parts[0].startswith(first):
+            return False
+    elif not parts[0].lstrip("0").startswith(first):
+        return False
+    return all(any(frag in part for part in parts[1:]) for frag in fragments[1:])
+
+
+def _numero_filter(query: str) -> Optional[Tuple[str, list]]:
+    """
+    Predicado indexado sobre el número del expediente, o None si ningún expediente
+    puede coincidir. Sin primer fragmento ("-2023") no hay restricción.
+    """
+    query_clean = query.strip().upper()
+    first = query_clean.split("-")[0]
+    if query_clean.endswith("-"):
+        if not first.isdigit() or len(first) > 5:
+            return None
+        return "numero = %s", [first.zfill(5)]
+    if not first:
+        return "1 = 1", []
+    if not first.isdigit() or len(first) > 5:
+        return None
+    if first.startswith("0"):
+        return "numero LIKE %s", [first + "%"]
+    return "numero_sin_ceros LIKE %s", [first + "%"]
+
+
+def buscar_expedientes(cursor, query: str, limit: int = 10) -> Optional[List[RowKey]]:
+    """
+    (fuente, id) de las primeras `limit` filas (datapenal antes que consulta, por id)
+    con algún expediente que coincide con `query`. None si la tabla no está disponible.
+    """
+    filtro = _numero_filter(query)
+    if filtro is None:
+        return []
+    cond, params = filtro
+    found: List[RowKey] = []
+    try:
+        for source, table in SOURCES.items():
+            last_id, last_pos = 0, 0
+            while len(found) < limit:
+                cursor.execute(
+                    "SELECT ref_id, pos, expediente FROM expediente_origen"
+                    f" WHERE tabla = %s AND {cond}"
+                    " AND (ref_id > %s OR (ref_id = %s AND pos > %s))"
+                    " ORDER BY ref_id, pos LIMIT %s",
+                    [table] + params + [last_id, last_id, last_pos, CANDIDATE_BATCH],
+                )
+                rows = cursor.fetchall()
+                for row in rows:
+                    ref_id, pos, expediente = (
+                        (row["ref_id"], row["pos"], row["expediente"])
+                        if isinstance(row, dict) else row
+                    )
+                    last_id, last_pos = ref_id, pos
+                    key = (source, ref_id)
+                    if len(found) < limit and key not in found and coincide_expediente(expediente, query):
+                        found.append(key)
+                if len(rows) < CANDIDATE_BATCH:
+                    break
+    except mysql.connector.Error as err:
+        logger.warning("Índice de expedientes no disponible: %s", err)
+        return None
+    return found
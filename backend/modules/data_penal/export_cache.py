@@ -0,0 +1,256 @@
+# backend/modules/data_penal/export_cache.py
+# -*- coding: utf-8 -*-
+"""
+Caché en disco de los Excel exportados (exportar_excel, exportar_excel_plazos y
+los reportes de plazos vencidos / no vencidos).
+
+- La clave es el SHA-256 del nombre del reporte, los filtros ya normalizados
+  (abogado efectivo según el rol, fechas, tipo, archivados...) y la versión de
+  datos de las tablas que lee el reporte.
+- `penal_data_version` guarda contadores por (tabla, conexión) que suben triggers en
+  cada INSERT / UPDATE / DELETE de datapenal y datapenal_plazos. La versión de una
+  tabla es la suma de sus contadores: cualquier escritura confirmada la sube, cambia
+  la clave y el archivo anterior deja de servirse (el LRU lo acaba borrando). Cada
+  conexión solo toca su propia fila, así que los escritores no esperan unos a otros
+  en una fila común ni pueden bloquearse en orden cruzado; las filas de conexiones
+  cerradas se suman a la fila base (conexion = 0) cuando hay más de VERSION_FILAS_MAX.
+- Cada entrada es `<clave>.xlsx` + `<clave>.json` (nombre de descarga). Un acierto
+  actualiza el mtime del .xlsx, que es el orden LRU; al guardar se borran las
+  entradas más antiguas hasta respetar EXPORT_CACHE_MAX_FILES y EXPORT_CACHE_MAX_MB.
+
+El nombre del archivo (y la fecha del título) es el del momento en que se generó.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Iterable, Optional
+
+import mysql.connector
+from flask import send_file
+
+from backend.core import get_db_connection, register_schema_migration
+from backend.modules.data_penal.excel_stream import XLSX_MIMETYPE, send_workbook
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CACHE_DIR = os.environ.get("PENAL_EXPORT_CACHE_DIR") or os.path.join(
+    tempfile.gettempdir(), "penal_export_cache"
+)
+EXPORT_CACHE_MAX_FILES = int(os.environ.get("PENAL_EXPORT_CACHE_FILES", "64"))
+EXPORT_CACHE_MAX_MB = float(os.environ.get("PENAL_EXPORT_CACHE_MB", "256"))
+
+VERSIONED_TABLES = {"datapenal": "dp", "datapenal_plazos": "plazos"}
+VERSION_FILAS_MAX = int(os.environ.get("PENAL_DATA_VERSION_ROWS", "256"))
+
+_evict_lock = threading.Lock()
+
+
+def _triggers(table: str, tag: str, bump: str) -> list:
+    return [
+        f"CREATE TRIGGER trg_version_{tag}_{ev[0].lower()} AFTER {ev} ON {table} FOR EACH ROW {bump}"
+        for ev in ("INSERT", "UPDATE", "DELETE")
+    ]
+
+
+def _bump_conexion(table: str) -> str:
+    return (
+        "INSERT INTO penal_data_version (tabla, conexion, version)"
+        f" VALUES ('{table}', CONNECTION_ID(), 1) ON DUPLICATE KEY UPDATE version = version + 1"
+    )
+
+
+# Un contador por (tabla, conexión) en lugar de una fila por tabla que todos los
+# escritores bloquearían hasta su commit
+register_schema_migration(
+    "0006_penal_data_version",
+    [
+        "CREATE TABLE IF NOT EXISTS penal_data_version ("
+        " tabla VARCHAR(32) NOT NULL,"
+        " conexion BIGINT UNSIGNED NOT NULL DEFAULT 0,"
+        " version BIGINT UNSIGNED NOT NULL DEFAULT 0,"
+        " PRIMARY KEY (tabla, conexion)"
+        ")",
+        "INSERT IGNORE INTO penal_data_version (tabla) VALUES "
+        + ", ".join(f"('{t}')" for t in VERSIONED_TABLES),
+    ]
+    + [
+        stmt for table, tag in VERSIONED_TABLES.items()
+        for stmt in _triggers(table, tag, _bump_conexion(table))
+    ],
+)
+
+
+# ---------------------------------------------------------------------
+#  Clave
+# ---------------------------------------------------------------------
+
+def data_version(connection, tables: Iterable[str]) -> Optional[str]:
+    """
+    Sello "tabla:versión,..." de `tables`, leído en la misma conexión (y antes) que
+    los datos del reporte. None si la tabla de versiones no existe o está incompleta.
+    """
+    tables = sorted(set(tables))
+    cur = connection.cursor()
+    try:
+        cur.execute(
+            "SELECT tabla, SUM(version), COUNT(*) FROM penal_data_version"
+            f" WHERE tabla IN ({', '.join(['%s'] * len(tables))}) GROUP BY tabla",
+            tables,
+        )
+        rows = cur.fetchall()
+    except mysql.connector.Error as err:
+        logger.warning("Versión de datos no disponible (%s); exportación sin caché", err)
+        return None
+    finally:
+        cur.close()
+    versions = {t: int(v) for t, v, _n in rows}
+    if set(versions) != set(tables):
+        return None
+    if any(n > VERSION_FILAS_MAX for _t, _v, n in rows):
+        compactar_versiones()
+    return ",".join(f"{t}:{versions[t]}" for t in tables)
+
+
+def compactar_versiones() -> None:
+    """
+    Suma a la fila base (conexion = 0) los contadores de conexiones que ya no existen
+    y los borra, en su propia conexión. La suma de cada tabla no cambia.
+    """
+    cnx = get_db_connection()
+    if cnx is None:
+        return
+    cur = cnx.cursor()
+    try:
+        cur.execute("SELECT GET_LOCK('penal_data_version', 0)")
+        if cur.fetchone()[0] != 1:
+            return
+        try:
+            # Una conexión cerrada ya no escribe: sus filas no cambian tras leerlas
+            cur.execute(
+                "SELECT tabla, conexion, version FROM penal_data_version"
+                " WHERE conexion <> 0"
+                "   AND conexion NOT IN (SELECT ID FROM information_schema.PROCESSLIST)"
+                " FOR UPDATE"
+            )
+            muertas = cur.fetchall()
+            sumas: dict = {}
+            for tabla, _conexion, version in muertas:
+                sumas[tabla] = sumas.get(tabla, 0) + version
+            for tabla, suma in sumas.items():
+                cur.execute(
+                    "INSERT INTO penal_data_version (tabla, conexion, version) VALUES (%s, 0, %s)"
+                    " ON DUPLICATE KEY UPDATE version = version + VALUES(version)",
+                    (tabla, suma),
+                )
+            if muertas:
+                cur.executemany(
+                    "DELETE FROM penal_data_version WHERE tabla = %s AND conexion = %s",
+                    [(tabla, conexion) for tabla, conexion, _v in muertas],
+                )
+            cnx.commit()
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('penal_data_version')")
+            cur.fetchall()
+    except mysql.connector.Error as err:
+        logger.warning("No se pudo compactar penal_data_version: %s", err)
+        try:
+            cnx.rollback()
+        except Exception:
+            pass
+    finally:
+        cur.close()
+        cnx.close()
+
+
+def export_cache_key(report: str, params: dict, version: Optional[str]) -> Optional[str]:
+    """Clave del reporte con esos filtros y esa versión de datos (None = no cachear)."""
+    if version is None or EXPORT_CACHE_MAX_FILES <= 0:
+        return None
+    payload = json.dumps([report, params, version], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# ---------------------------------------------------------------------
+#  Almacén
+# ---------------------------------------------------------------------
+
+def _paths(key: str):
+    base = os.path.join(EXPORT_CACHE_DIR, key)
+    return base + ".xlsx", base + ".json"
+
+
+def send_cached_export(key: Optional[str]):
+    """Respuesta con el Excel cacheado para `key`, o None si no está."""
+    if key is None:
+        return None
+    xlsx_path, meta_path = _paths(key)
+    try:
+        with open(meta_path, encoding="utf-8") as fh:
+            filename = json.load(fh)["filename"]
+        os.utime(xlsx_path)  # más reciente en el orden LRU
+        return send_file(xlsx_path, mimetype=XLSX_MIMETYPE, as_attachment=True,
+                         download_name=filename)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def cache_and_send(key: Optional[str], path: str, filename: str):
+    """
+    Guarda en la caché el Excel recién generado en `path` y lo envía. Si no hay
+    clave o falla el guardado, se envía el temporal y se borra como siempre.
+    """
+    if key is None:
+        return send_workbook(path, filename)
+    xlsx_path, meta_path = _paths(key)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        shutil.move(path, xlsx_path + suffix)
+        os.replace(xlsx_path + suffix, xlsx_path)
+        with open(meta_path + suffix, "w", encoding="utf-8") as fh:
+            json.dump({"filename": filename}, fh, ensure_ascii=False)
+        os.replace(meta_path + suffix, meta_path)
+    except OSError as err:
+        logger.warning("No se pudo guardar el Excel en la caché: %s", err)
+        for candidate in (path, xlsx_path + suffix, xlsx_path):
+            if os.path.exists(candidate):
+                return send_workbook(candidate, filename)
+        raise
+    response = send_file(xlsx_path, mimetype=XLSX_MIMETYPE, as_attachment=True,
+                         download_name=filename)
+    _evict()
+    return response
+
+
+def _evict() -> None:
+    """Borra las entradas menos usadas hasta respetar los límites de archivos y tamaño."""
+    max_bytes = EXPORT_CACHE_MAX_MB * 1024 * 1024
+    with _evict_lock:
+        try:
+            entries = []
+            with os.scandir(EXPORT_CACHE_DIR) as it:
+                for e in it:
+                    if e.name.endswith(".xlsx") and e.is_file():
+                        st = e.stat()
+                        entries.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            return
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        count = len(entries)
+        for _mtime, size, xlsx_path in entries:
+            if count <= EXPORT_CACHE_MAX_FILES and total <= max_bytes:
+                break
+            # Primero el .json: sin él la entrada ya no se sirve
+            for p in (xlsx_path[:-5] + ".json", xlsx_path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            count -= 1
+            total -= size
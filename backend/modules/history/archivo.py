@@ -0,0 +1,284 @@
+# backend/modules/history/archivo.py
+# -*- coding: utf-8 -*-
+"""
+Archivo frío de datapenal_plazos y datapenal_versioning.
+
+Las tablas solo crecen, pero el trabajo diario (notificaciones, reportes de
+vencidos, listado de plazos) toca filas recientes o abiertas. Un proceso periódico
+mueve a tablas `<tabla>_archivo` (mismo esquema, CREATE TABLE ... LIKE):
+
+  - plazos ATENDIDA sin cambios desde hace PLAZOS_ARCHIVO_DIAS;
+  - versiones anteriores a la última fila completa (delta = 0) de cada PPU con más
+    de VERSIONES_ARCHIVO_DIAS, siempre que ninguna de ellas sea una notificación
+    sin leer. Así las versiones que quedan en caliente empiezan por una fila
+    completa y se reconstruyen sin el archivo.
+
+Cada lote se bloquea con FOR UPDATE y se vuelve a comprobar la condición antes de
+copiarlo y borrarlo: lo que cambió entre la SELECT y el movimiento se queda en caliente.
+
+Lectura:
+  - union_archivo(): la misma SELECT sobre la tabla caliente y la fría (UNION ALL),
+    para los historiales pedidos explícitamente.
+  - tabla_con_archivo(): tabla derivada caliente + fría para listados con
+    ?incluir_historico=true.
+
+Se usan tablas frías y no PARTITION BY: las particiones de MySQL exigen que la
+fecha forme parte de todas las claves únicas. Un ALTER sobre la tabla caliente
+debe repetirse en la fría (la copia usa solo las columnas comunes).
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import mysql.connector
+from flask import Blueprint, jsonify
+
+from backend.core import get_db_connection, register_schema_migration, role_required
+# 0009 (columna delta) debe aplicarse antes de copiar el esquema de datapenal_versioning
+from backend.modules.history import versioning  # noqa: F401
+
+logger = logging.getLogger(__name__)
+
+archivo_bp = Blueprint("archivo_bp", __name__)
+
+ARCHIVO_TABLAS = {
+    "datapenal_plazos": "datapenal_plazos_archivo",
+    "datapenal_versioning": "datapenal_versioning_archivo",
+}
+PLAZOS_ARCHIVO_DIAS = int(os.environ.get("PENAL_ARCHIVE_PLAZOS_DAYS", "180"))
+VERSIONES_ARCHIVO_DIAS = int(os.environ.get("PENAL_ARCHIVE_VERSIONS_DAYS", "365"))
+# Horas entre ejecuciones del archivo programado (0 = desactivado)
+ARCHIVO_INTERVALO_HORAS = float(os.environ.get("PENAL_ARCHIVE_INTERVAL_HOURS", "24"))
+ARCHIVO_LOTE = 1000
+# Fecha desde la que get_notifications cuenta versiones (no leídas no se archivan)
+NOTIFICACIONES_DESDE = "2025-02-02"
+
+_programado = threading.Event()
+
+register_schema_migration(
+    "0010_archivo_frio",
+    [f"CREATE TABLE IF NOT EXISTS {frio} LIKE {tabla}" for tabla, frio in ARCHIVO_TABLAS.items()]
+    + [
+        "ALTER TABLE datapenal_plazos ADD INDEX idx_plazos_seguimiento (seguimiento, last_modified)",
+        "ALTER TABLE datapenal_versioning ADD INDEX idx_ver_fecha (fecha_version)",
+    ],
+)
+
+
+# ---------------------------------------------------------------------
+#  Lectura
+# ---------------------------------------------------------------------
+
+def union_archivo(select_sql: str, params: Sequence, tabla: str) -> Tuple[str, list]:
+    """
+    `select_sql` (con `{tabla}` en el FROM) sobre la tabla caliente y la fría, unidas
+    con UNION ALL. Cada rama lleva su propio WHERE, así que usa sus índices; un
+    ORDER BY / LIMIT añadido después se aplica al resultado unido.
+    """
+    frio = ARCHIVO_TABLAS[tabla]
+    sql = f"({select_sql.format(tabla=tabla)}) UNION ALL ({select_sql.format(tabla=frio)})"
+    return sql, list(params) * 2
+
+
+def tabla_con_archivo(tabla: str, historico: bool = True) -> str:
+    """Fuente para el FROM: la tabla caliente o, con `historico`, caliente + fría."""
+    if not historico:
+        return tabla
+    return f"(SELECT * FROM {tabla} UNION ALL SELECT * FROM {ARCHIVO_TABLAS[tabla]})"
+
+
+# ---------------------------------------------------------------------
+#  Archivo
+# ---------------------------------------------------------------------
+
+def _columnas_comunes(cur, tabla: str) -> List[str]:
+    cur.execute(
+        "SELECT c.COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS c"
+        " JOIN INFORMATION_SCHEMA.COLUMNS f"
+        "   ON f.TABLE_SCHEMA = c.TABLE_SCHEMA AND f.TABLE_NAME = %s"
+        "  AND f.COLUMN_NAME = c.COLUMN_NAME"
+        " WHERE c.TABLE_SCHEMA = DATABASE() AND c.TABLE_NAME = %s"
+        "   AND c.EXTRA NOT LIKE '%%GENERATED%%'"
+        " ORDER BY c.ORDINAL_POSITION",
+        (ARCHIVO_TABLAS[tabla], tabla),
+    )
+    return [f"`{r[0]}`" for r in cur.fetchall()]
+
+
+def _mover(cnx, cur, tabla: str, clave: str, columnas: List[str], ids: list) -> None:
+    """
+    Copia `ids` a la tabla fría y los borra de la caliente en la transacción abierta
+    (las filas ya deben estar bloqueadas con FOR UPDATE) y confirma.
+    """
+    if not ids:
+        cnx.commit()
+        return
+    cols = ", ".join(columnas)
+    placeholders = ", ".join(["%s"] * len(ids))
+    cur.execute(
+        f"INSERT INTO {ARCHIVO_TABLAS[tabla]} ({cols})"
+        f" SELECT {cols} FROM {tabla} WHERE {clave} IN ({placeholders})",
+        ids,
+    )
+    cur.execute(f"DELETE FROM {tabla} WHERE {clave} IN ({placeholders})", ids)
+    cnx.commit()
+
+
+def archivar_plazos(cnx, cur, dias: int = PLAZOS_ARCHIVO_DIAS) -> int:
+    columnas = _columnas_comunes(cur, "datapenal_plazos")
+    total = 0
+    while True:
+        cur.execute(
+            "SELECT id FROM datapenal_plazos"
+            " WHERE seguimiento = 'ATENDIDA'"
+            "   AND COALESCE(last_modified, fecha_atencion) < NOW() - INTERVAL %s DAY"
+            " ORDER BY id LIMIT %s",
+            (dias, ARCHIVO_LOTE),
+        )
+        ids = [r[0] for r in cur.fetchall()]
+        if not ids:
+            return total
+        # Se bloquean y se vuelve a comprobar la condición: un plazo reabierto entre
+        # la SELECT y el movimiento se queda en caliente
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur.execute(
+            f"SELECT id FROM datapenal_plazos WHERE id IN ({placeholders})"
+            "   AND seguimiento = 'ATENDIDA'"
+            "   AND COALESCE(last_modified, fecha_atencion) < NOW() - INTERVAL %s DAY"
+            " FOR UPDATE",
+            ids + [dias],
+        )
+        vigentes = [r[0] for r in cur.fetchall()]
+        _mover(cnx, cur, "datapenal_plazos", "id", columnas, vigentes)
+        total += len(vigentes)
+        if len(ids) < ARCHIVO_LOTE:
+            return total
+
+
+def _versiones_vigentes(cur, ids: list, dias: int) -> list:
+    """
+    Bloquea todas las versiones de los PPU de `ids` y devuelve los de `ids` que
+    siguen siendo archivables con los datos bloqueados: anteriores a la última fila
+    completa con más de `dias` y sin ninguna notificación sin leer antes de ella.
+    Una versión marcada como no leída entre la SELECT y el movimiento no se archiva.
+    """
+    placeholders = ", ".join(["%s"] * len(ids))
+    cur.execute(
+        "SELECT version_id, registro_ppu,"
+        "       (delta = 0 AND fecha_version < NOW() - INTERVAL %s DAY) AS es_corte,"
+        "       (COALESCE(leido, 0) = 0 AND fecha_version >= %s) AS sin_leer"
+        "  FROM datapenal_versioning"
+        " WHERE registro_ppu IN ("
+        f"       SELECT registro_ppu FROM datapenal_versioning WHERE version_id IN ({placeholders}))"
+        " FOR UPDATE",
+        [dias, NOTIFICACIONES_DESDE] + list(ids),
+    )
+    por_ppu: Dict[object, list] = {}
+    for version_id, registro_ppu, es_corte, sin_leer in cur.fetchall():
+        por_ppu.setdefault(registro_ppu, []).append((version_id, es_corte, sin_leer))
+
+    candidatos = set(ids)
+    vigentes = []
+    for versiones in por_ppu.values():
+        corte = max((v for v, es_corte, _ in versiones if es_corte), default=None)
+        if corte is None:
+            continue
+        anteriores = [(v, sin_leer) for v, _, sin_leer in versiones if v < corte]
+        if any(sin_leer for _, sin_leer in anteriores):
+            continue
+        vigentes.extend(v for v, _ in anteriores if v in candidatos)
+    return sorted(vigentes)
+
+
+def archivar_versiones(cnx, cur, dias: int = VERSIONES_ARCHIVO_DIAS) -> int:
+    columnas = _columnas_comunes(cur, "datapenal_versioning")
+    total = 0
+    while True:
+        cur.execute(
+            "SELECT v.version_id"
+            "  FROM datapenal_versioning v"
+            "  JOIN (SELECT registro_ppu, MAX(version_id) AS corte"
+            "          FROM datapenal_versioning"
+            "         WHERE delta = 0 AND fecha_version < NOW() - INTERVAL %s DAY"
+            "         GROUP BY registro_ppu) f"
+            "    ON f.registro_ppu = v.registro_ppu AND v.version_id < f.corte"
+            " WHERE NOT EXISTS ("
+            "        SELECT 1 FROM datapenal_versioning u"
+            "         WHERE u.registro_ppu = f.registro_ppu AND u.version_id < f.corte"
+            "           AND COALESCE(u.leido, 0) = 0 AND u.fecha_version >= %s)"
+            " ORDER BY v.version_id LIMIT %s",
+            (dias, NOTIFICACIONES_DESDE, ARCHIVO_LOTE),
+        )
+        ids = [r[0] for r in cur.fetchall()]
+        if not ids:
+            return total
+        vigentes = _versiones_vigentes(cur, ids, dias)
+        _mover(cnx, cur, "datapenal_versioning", "version_id", columnas, vigentes)
+        total += len(vigentes)
+        if len(ids) < ARCHIVO_LOTE:
+            return total
+
+
+def ejecutar_archivo() -> Optional[Dict[str, int]]:
+    """
+    Mueve al archivo frío lo que ya no es "caliente". Devuelve las filas movidas por
+    tabla, o None si otro proceso lo está ejecutando o no hay conexión.
+    """
+    cnx = get_db_connection()
+    if cnx is None:
+        return None
+    cur = cnx.cursor()
+    try:
+        # Un único proceso a la vez (varios workers comparten la base)
+        cur.execute("SELECT GET_LOCK('penal_archivo', 0)")
+        if cur.fetchone()[0] != 1:
+            return None
+        try:
+            movidas = {
+                "datapenal_plazos": archivar_plazos(cnx, cur),
+                "datapenal_versioning": archivar_versiones(cnx, cur),
+            }
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('penal_archivo')")
+            cur.fetchall()
+        logger.info("Archivo frío: %s", movidas)
+        return movidas
+    except mysql.connector.Error as err:
+        logger.error("Error al archivar plazos/versiones: %s", err)
+        try:
+            cnx.rollback()
+        except Exception:
+            pass
+        return None
+    finally:
+        cur.close()
+        cnx.close()
+
+
+def iniciar_archivo_programado() -> None:
+    """Hilo en segundo plano que ejecuta el archivo cada ARCHIVO_INTERVALO_HORAS."""
+    if ARCHIVO_INTERVALO_HORAS <= 0 or _programado.is_set():
+        return
+    _programado.set()
+
+    def _bucle():
+        while True:
+            time.sleep(ARCHIVO_INTERVALO_HORAS * 3600)
+            try:
+                ejecutar_archivo()
+            except Exception:
+                logger.exception("Error en el archivo programado")
+
+    threading.Thread(target=_bucle, name="penal-archivo", daemon=True).start()
+
+
+@archivo_bp.route("/archivo/ejecutar", methods=["POST"])
+@role_required(["admin"])
+def ejecutar_archivo_endpoint():
+    movidas = ejecutar_archivo()
+    if movidas is None:
+        return jsonify({"error": "El archivo ya se está ejecutando o no hay conexión"}), 409
+    return jsonify({"movidas": movidas}), 200
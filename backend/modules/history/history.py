@@ -1,14 +1,26 @@
 ﻿# C:\...\backend\modules\history\history.py
 
 import os
+import re
+import logging
+import threading
 from datetime import date, datetime
+from typing import Dict, List, Optional, Sequence
 
+import mysql.connector
+import unidecode
 from flask import Blueprint, jsonify, request, current_app, send_file, session
 
 from backend.core import (
     login_required,
     get_db_connection,
+    register_schema_migration,
+    run_parallel_queries,
 )
+from backend.modules.history.archivo import union_archivo
+from backend.modules.history.versioning import DELTA_COLUMNS, reconstruir_versiones
+
+logger = logging.getLogger(__name__)
 
 history_bp = Blueprint("history_bp", __name__)
 
@@ -42,17 +54,194 @@ VERSION_ONLY_COLUMNS = {
 }
 
 
+_ESPACIOS = re.compile(r"\s+")
+
+
 def _norm(v):
     """Quita mayúsc/minúsc, tildes y espacios para comparar."""
-    import unidecode, re
     if v is None:
         return ""
     v = str(v).strip().lower()
     v = unidecode.unidecode(v)
-    v = re.sub(r"\s+", " ", v)
+    v = _ESPACIOS.sub(" ", v)
     return v
 
 
+def _campos_cambiados(current: dict, versions: List[dict]) -> List[str]:
+    """Campos de COLUMNS_MAP con alguna versión no vacía distinta del valor actual."""
+    changed = []
+    for snake in COLUMNS_MAP:
+        cur_norm = _norm(current.get(snake))
+        if any(_norm(v.get(snake)) != cur_norm for v in versions if v.get(snake) not in (None, "")):
+            changed.append(snake)
+    return changed
+
+
+# ---------------------------------------------------------------------
+#  Máscara de campos cambiados por registro_ppu
+# ---------------------------------------------------------------------
+# historial_campos.campos: bit i = i-ésimo campo de COLUMNS_MAP (en su orden; si
+# cambia el mapa hace falta una migración que vuelva a encolar todo). Los triggers
+# de datapenal y datapenal_versioning encolan el PPU en historial_campos_pendiente
+# y la máscara se recalcula (con _norm) la primera vez que se consulta.
+HISTORY_FIELDS = list(COLUMNS_MAP)
+HISTORY_SYNC_BATCH = 500
+# Segundos que una consulta espera a otra sincronización antes de usar el cálculo directo
+HISTORY_SYNC_WAIT = 2.0
+
+_campos_sync_lock = threading.Lock()
+
+
+def _campos_triggers(table: str, tag: str) -> List[str]:
+    enqueue = (
+        "INSERT INTO historial_campos_pendiente (registro_ppu, ver) VALUES ({ref}.registro_ppu, 1)"
+        " ON DUPLICATE KEY UPDATE ver = ver + 1"
+    )
+    cols = sorted(set(COLUMNS_MAP.values()))
+    changed = " OR ".join(f"NOT (OLD.{c} <=> NEW.{c})" for c in cols)
+    return [
+        f"CREATE TRIGGER trg_hist_campos_{tag}_i AFTER INSERT ON {table} FOR EACH ROW "
+        + enqueue.format(ref="NEW"),
+        f"CREATE TRIGGER trg_hist_campos_{tag}_u AFTER UPDATE ON {table} FOR EACH ROW "
+        f"BEGIN IF {changed} THEN "
+        + enqueue.format(ref="NEW") + "; "
+        + enqueue.format(ref="OLD") + "; END IF; END",
+        f"CREATE TRIGGER trg_hist_campos_{tag}_d AFTER DELETE ON {table} FOR EACH ROW "
+        + enqueue.format(ref="OLD"),
+    ]
+
+
+register_schema_migration(
+    "0008_historial_campos",
+    [
+        "CREATE TABLE IF NOT EXISTS historial_campos ("
+        " registro_ppu VARCHAR(100) NOT NULL PRIMARY KEY,"
+        " campos INT UNSIGNED NOT NULL DEFAULT 0"
+        ")",
+        "CREATE TABLE IF NOT EXISTS historial_campos_pendiente ("
+        " registro_ppu VARCHAR(100) NOT NULL PRIMARY KEY,"
+        " ver INT UNSIGNED NOT NULL DEFAULT 1"
+        ")",
+    ]
+    + _campos_triggers("datapenal", "dp")
+    + _campos_triggers("datapenal_versioning", "ver")
+    + [
+        # Carga inicial: todo PPU con versiones entra por la cola
+        "INSERT IGNORE INTO historial_campos_pendiente (registro_ppu)"
+        " SELECT DISTINCT registro_ppu FROM datapenal_versioning WHERE registro_ppu IS NOT NULL",
+    ],
+)
+
+
+def _mascara(campos: List[str]) -> int:
+    return sum(1 << i for i, snake in enumerate(HISTORY_FIELDS) if snake in campos)
+
+
+def _campos_de_mascara(mask: int) -> List[str]:
+    return [snake for i, snake in enumerate(HISTORY_FIELDS) if mask >> i & 1]
+
+
+def sync_historial_campos(ppus: Optional[Sequence[str]] = None,
+                          max_rows: int = HISTORY_SYNC_BATCH) -> bool:
+    """
+    Recalcula la máscara de los PPU pendientes (solo los de `ppus` si se indican,
+    hasta `max_rows`). Devuelve True si ninguno de ellos quedó pendiente.
+    """
+    if not _campos_sync_lock.acquire(timeout=HISTORY_SYNC_WAIT):
+        return False
+    cnx = None
+    cur = None
+    try:
+        cnx = get_db_connection()
+        if cnx is None:
+            return False
+        cur = cnx.cursor(dictionary=True)
+        if ppus is None:
+            cur.execute(
+                "SELECT registro_ppu, ver FROM historial_campos_pendiente LIMIT %s", (max_rows + 1,)
+            )
+        else:
+            if not ppus:
+                return True
+            cur.execute(
+                "SELECT registro_ppu, ver FROM historial_campos_pendiente"
+                f" WHERE registro_ppu IN ({', '.join(['%s'] * len(ppus))}) LIMIT %s",
+                list(ppus) + [max_rows + 1],
+            )
+        pending = cur.fetchall()
+        if not pending:
+            return True
+        batch = pending[:max_rows]
+        keys = [p["registro_ppu"] for p in batch]
+        placeholders = ", ".join(["%s"] * len(keys))
+        cols = ", ".join(f"{col} AS {snake}" for snake, col in COLUMNS_MAP.items())
+        cur.execute(f"SELECT {cols} FROM datapenal WHERE registro_ppu IN ({placeholders})", keys)
+        current_map = {r["registro_ppu"]: r for r in cur.fetchall()}
+        # Versiones calientes y archivadas: la máscara cubre todo el historial
+        cur.execute(*union_archivo(
+            f"SELECT {cols} FROM {{tabla}} WHERE registro_ppu IN ({placeholders})",
+            keys, "datapenal_versioning",
+        ))
+        versions_map: Dict[str, List[dict]] = {}
+        for v in cur.fetchall():
+            versions_map.setdefault(v["registro_ppu"], []).append(v)
+        cur.executemany(
+            "INSERT INTO historial_campos (registro_ppu, campos) VALUES (%s, %s)"
+            " ON DUPLICATE KEY UPDATE campos = VALUES(campos)",
+            [
+                (ppu, _mascara(_campos_cambiados(current_map.get(ppu, {}), versions_map.get(ppu, []))))
+                for ppu in keys
+            ],
+        )
+        # Solo se desencola la versión procesada: un cambio concurrente la incrementa
+        cur.executemany(
+            "DELETE FROM historial_campos_pendiente WHERE registro_ppu = %s AND ver = %s",
+            [(p["registro_ppu"], p["ver"]) for p in batch],
+        )
+        cnx.commit()
+        return len(pending) <= max_rows
+    except mysql.connector.Error as err:
+        logger.warning("No se pudo sincronizar historial_campos: %s", err)
+        try:
+            cnx.rollback()
+        except Exception:
+            pass
+        return False
+    finally:
+        if cur is not None:
+            cur.close()
+        if cnx is not None:
+            cnx.close()
+        _campos_sync_lock.release()
+
+
+def campos_cambiados(ppus: Sequence[str]) -> Optional[Dict[str, List[str]]]:
+    """
+    {ppu: campos cambiados} desde historial_campos (una búsqueda por clave primaria),
+    o None si la tabla no está disponible o al día y hay que calcularlo directamente.
+    """
+    if not sync_historial_campos(ppus, max_rows=max(len(ppus), HISTORY_SYNC_BATCH)):
+        return None
+    cnx = get_db_connection()
+    if cnx is None:
+        return None
+    cur = cnx.cursor()
+    try:
+        cur.execute(
+            "SELECT registro_ppu, campos FROM historial_campos"
+            f" WHERE registro_ppu IN ({', '.join(['%s'] * len(ppus))})",
+            list(ppus),
+        )
+        masks = dict(cur.fetchall())
+    except mysql.connector.Error as err:
+        logger.warning("historial_campos no disponible: %s", err)
+        return None
+    finally:
+        cur.close()
+        cnx.close()
+    return {ppu: _campos_de_mascara(masks.get(ppu, 0)) for ppu in ppus}
+
+
 # 1) ¿QUÉ CAMPOS CAMBIARON? ──────────────────────────────────
 @history_bp.route("/busqueda_rapida_history_available", methods=["GET"])
 @login_required
@@ -65,50 +254,48 @@ def history_available_penal():
         current_app.logger.warning("   ppu vacío; 400")
         return jsonify(success=False, fields=[]), 400
 
-    conn = get_db_connection()
-    if conn is None:
-        current_app.logger.error("   conexión BD fallida; 500")
-        return jsonify(success=False, fields=[]), 500
-
-    cur = conn.cursor(dictionary=True)
     try:
+        # Máscara precalculada; si no está al día, cálculo sobre las versiones
+        fields = campos_cambiados([ppu])
+        if fields is not None:
+            current_app.logger.debug("   campos cambiados (máscara): %s", fields[ppu])
+            return jsonify(success=True, fields=fields[ppu]), 200
+
         cols_versions = ",\n       ".join(
             [f"{col} AS {snake}" for snake, col in COLUMNS_MAP.items()] +
             [f"{col} AS {snake}" for snake, col in VERSION_ONLY_COLUMNS.items()]
         )
 
-        sql_versions = f"""
+        sql_versions, params_versions = union_archivo(f"""
             SELECT version_id,
                    {cols_versions}
-              FROM datapenal_versioning
+              FROM {{tabla}}
+             WHERE registro_ppu = %s
+        """, (ppu,), "datapenal_versioning")
+        sql_versions += " ORDER BY version_id"
+
+        sql_current = f"""
+            SELECT {', '.join(f"{col} AS {snake}"
+                              for snake, col in COLUMNS_MAP.items())}
+              FROM datapenal
              WHERE registro_ppu = %s
-             ORDER BY version_id
         """
 
         current_app.logger.debug("   SQL versiones:\n%s", sql_versions)
-        cur.execute(sql_versions, (ppu,))
-        versions = cur.fetchall()
+        # Versiones y fila actual son independientes: se consultan a la vez
+        versions, current_rows = run_parallel_queries([
+            (sql_versions, params_versions),
+            (sql_current, (ppu,)),
+        ])
         current_app.logger.debug("   versiones encontradas: %d", len(versions))
 
         if not versions:
             return jsonify(success=True, fields=[]), 200
 
-        sql_current = f"""
-            SELECT {', '.join(f"{col} AS {snake}"
-                              for snake, col in COLUMNS_MAP.items())}
-              FROM datapenal
-             WHERE registro_ppu = %s
-        """
-        cur.execute(sql_current, (ppu,))
-        current = cur.fetchone() or {}
+        current = current_rows[0] if current_rows else {}
         current_app.logger.debug("   fila actual obtenida")
 
-        changed = []
-        for snake in COLUMNS_MAP:
-            cur_norm = _norm(current.get(snake))
-            hist_norms = [_norm(v.get(snake)) for v in versions if v.get(snake) not in (None, "")]
-            if any(h != cur_norm for h in hist_norms):
-                changed.append(snake)
+        changed = _campos_cambiados(current, versions)
 
         current_app.logger.debug("   campos cambiados: %s", changed)
         return jsonify(success=True, fields=changed), 200
@@ -120,10 +307,6 @@ def history_available_penal():
         return jsonify(success=False, fields=[]), 500
 
     finally:
-        try:
-            cur.close()
-        finally:
-            conn.close()
         current_app.logger.debug("<< /history_available – fin")
 
 
@@ -142,6 +325,16 @@ def history_available_bulk_penal():
     placeholders = ",".join(["%s"] * len(ppus))
     current_app.logger.debug("   ppus recibidos: %s", ppus)
 
+    # Una búsqueda por clave primaria en historial_campos por PPU
+    try:
+        result = campos_cambiados(ppus)
+    except Exception:
+        current_app.logger.exception("   ERROR leyendo historial_campos")
+        result = None
+    if result is not None:
+        current_app.logger.debug("   resultado bulk (máscaras) listo")
+        return jsonify(result), 200
+
     conn = get_db_connection()
     if conn is None:
         current_app.logger.error("   conexión BD fallida; 500")
@@ -154,14 +347,13 @@ def history_available_bulk_penal():
             [f"{col} AS {snake}" for snake, col in VERSION_ONLY_COLUMNS.items()]
         )
 
-        sql_versions = f"""
-            SELECT registro_ppu,
-                   version_id,
+        # Se agrupa por PPU en Python: la unión con el archivo no necesita orden
+        sql_versions, params_versions = union_archivo(f"""
+            SELECT version_id,
                    {cols_versions}
-              FROM datapenal_versioning
+              FROM {{tabla}}
              WHERE registro_ppu IN ({placeholders})
-             ORDER BY registro_ppu, version_id
-        """
+        """, ppus, "datapenal_versioning")
 
         sql_current = f"""
             SELECT registro_ppu,
@@ -171,7 +363,7 @@ def history_available_bulk_penal():
         """
 
         current_app.logger.debug("   SQL versiones bulk:\n%s", sql_versions)
-        cur.execute(sql_versions, ppus)
+        cur.execute(sql_versions, params_versions)
         all_versions = cur.fetchall()
 
         current_app.logger.debug("   SQL current bulk:\n%s", sql_current)
@@ -192,14 +384,7 @@ def history_available_bulk_penal():
                 result[ppu] = []
                 continue
 
-            changed = []
-            for snake in COLUMNS_MAP:
-                cur_norm = _norm(cur_row.get(snake))
-                hist_norms = [_norm(v.get(snake)) for v in versions if v.get(snake) not in (None, "")]
-                if any(h != cur_norm for h in hist_norms):
-                    changed.append(snake)
-
-            result[ppu] = changed
+            result[ppu] = _campos_cambiados(cur_row, versions)
 
         current_app.logger.debug("   resultado bulk listo")
         return jsonify(result), 200
@@ -252,34 +437,44 @@ def busqueda_rapida_history_penal():
         cur_val = (cur.fetchone() or {}).get("cur_value")
         current_app.logger.debug("   valor actual = %s", cur_val)
 
+        # Todas las versiones: en columnas de DELTA_COLUMNS las delta se completan con
+        # las anteriores; los valores vacíos se descartan después de reconstruir
         if field == "e_situacional":
             sql_versions = f"""
                 SELECT version_id,
                        {real_col} AS old_value,
                        fecha_version,
                        usuario_modificacion,
-                       `ruta` AS ruta
-                  FROM datapenal_versioning
+                       `ruta` AS ruta,
+                       delta
+                  FROM {{tabla}}
                  WHERE registro_ppu = %s
-                   AND {real_col} IS NOT NULL
-                   AND CAST({real_col} AS CHAR) <> ''
-                 ORDER BY version_id
             """
         else:
             sql_versions = f"""
                 SELECT version_id,
                        {real_col} AS old_value,
                        fecha_version,
-                       usuario_modificacion
-                  FROM datapenal_versioning
+                       usuario_modificacion,
+                       delta
+                  FROM {{tabla}}
                  WHERE registro_ppu = %s
-                   AND {real_col} IS NOT NULL
-                   AND CAST({real_col} AS CHAR) <> ''
-                 ORDER BY version_id
             """
 
-        cur.execute(sql_versions, (ppu,))
+        # Historial pedido explícitamente: versiones calientes y archivadas
+        sql_versions, params_versions = union_archivo(sql_versions, (ppu,), "datapenal_versioning")
+        cur.execute(sql_versions + " ORDER BY version_id", params_versions)
         versions = cur.fetchall()
+        if real_col.strip("`") in DELTA_COLUMNS:
+            reconstruir_versiones(versions, columns=["old_value"])
+        else:
+            # Columna que se guarda siempre: un NULL es un valor, no "igual que la anterior"
+            for v in versions:
+                v.pop("delta", None)
+        versions = [
+            v for v in versions
+            if v.get("old_value") is not None and str(v["old_value"]) != ""
+        ]
         current_app.logger.debug("   versiones encontradas: %d", len(versions))
 
         cur_norm = _norm(cur_val)
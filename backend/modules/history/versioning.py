@@ -0,0 +1,194 @@
+# backend/modules/history/versioning.py
+# -*- coding: utf-8 -*-
+"""
+Versiones de datapenal_versioning guardadas como diferencias.
+
+Cada versión de un registro_ppu se guarda de una de dos formas:
+  - delta = 0: fila completa (todas las filas anteriores a este cambio, la primera
+    versión de cada PPU y una "foto" cada VERSIONING_SNAPSHOT_EVERY versiones).
+  - delta = 1: solo las columnas de DELTA_COLUMNS que cambiaron respecto a la versión
+    anterior; las demás quedan en NULL ("igual que la anterior"). Un valor que pasa
+    a vacío, o una columna que el escritor no pasa, se guarda como ''.
+
+abogado, registro_ppu, ruta, hash_sha, fecha_version, usuario y leido se guardan
+siempre (los usan notificaciones y la búsqueda de duplicados).
+
+insertar_version() escribe una versión; reconstruir_versiones() rellena los NULL
+de las filas delta a partir de las versiones anteriores del mismo PPU. Los lectores
+deben traer todas las versiones del PPU (sin filtrar por columnas delta) y filtrar
+después de reconstruir.
+
+Las versiones de una consulta (filas completas sin registro_ppu) pasan a un PPU al
+acumularla o convertirla en ingreso nuevo; antes de moverlas, fijar_versiones_posteriores()
+reescribe como filas completas las delta del PPU posteriores a ellas, que si no se
+completarían con los valores de la consulta.
+"""
+
+import os
+from typing import Dict, Iterable, List, Optional
+
+from backend.core import register_schema_migration
+
+# Columnas que solo se guardan cuando cambian
+DELTA_COLUMNS = [
+    "denunciado", "origen", "nr de exp completo", "delito", "informe_juridico",
+    "item", "juzgado", "fiscalia", "departamento", "e_situacional",
+]
+VERSIONING_DELTA = os.environ.get("PENAL_VERSIONING_DELTA", "1") == "1"
+# Versiones entre dos filas completas (la cadena a recorrer nunca es más larga)
+VERSIONING_SNAPSHOT_EVERY = int(os.environ.get("PENAL_VERSIONING_SNAPSHOT_EVERY", "10"))
+
+register_schema_migration(
+    "0009_versioning_delta",
+    [
+        "ALTER TABLE datapenal_versioning ADD COLUMN delta TINYINT(1) NOT NULL DEFAULT 0",
+        "ALTER TABLE datapenal_versioning ADD INDEX idx_ver_ppu_delta (registro_ppu, delta, version_id)",
+    ],
+)
+
+
+def _valor(v) -> str:
+    return "" if v is None else str(v)
+
+
+def _ultima_version(cursor, registro_ppu: str) -> Optional[tuple]:
+    """
+    (valores reconstruidos de la última versión, versiones desde la última fila
+    completa) o None si el PPU no tiene versiones.
+    """
+    cols = ", ".join(f"`{c}`" for c in DELTA_COLUMNS)
+    cursor.execute(
+        f"SELECT delta, {cols} FROM datapenal_versioning"
+        " WHERE registro_ppu = %s AND version_id >= ("
+        "  SELECT COALESCE(MAX(version_id), 0) FROM datapenal_versioning"
+        "  WHERE registro_ppu = %s AND delta = 0)"
+        " ORDER BY version_id",
+        (registro_ppu, registro_ppu),
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    estado: Dict[str, object] = {}
+    for row in rows:
+        valores = row if isinstance(row, dict) else dict(zip(["delta"] + DELTA_COLUMNS, row))
+        for c in DELTA_COLUMNS:
+            if not valores["delta"] or valores[c] is not None:
+                estado[c] = valores[c]
+    return estado, len(rows)
+
+
+def insertar_version(connection, data: dict) -> None:
+    """
+    INSERT en datapenal_versioning de `data` ({columna: valor}). Con registro_ppu y
+    el modo delta activo, las columnas de DELTA_COLUMNS iguales a la versión
+    anterior se guardan como NULL.
+    """
+    data = dict(data)
+    cursor = connection.cursor()
+    try:
+        registro_ppu = data.get("registro_ppu")
+        anterior = None
+        if VERSIONING_DELTA and registro_ppu:
+            # Bloquea el PPU hasta el commit del llamador: dos escritores concurrentes
+            # no calculan su delta contra la misma versión anterior
+            cursor.execute("SELECT 1 FROM datapenal WHERE registro_ppu = %s FOR UPDATE", (registro_ppu,))
+            cursor.fetchall()
+            anterior = _ultima_version(cursor, registro_ppu)
+        if anterior is not None and anterior[1] < VERSIONING_SNAPSHOT_EVERY:
+            estado = anterior[0]
+            for c in DELTA_COLUMNS:
+                if c not in data:
+                    # El escritor no la guarda: vacía, no "igual que la anterior"
+                    data[c] = ""
+                elif _valor(data[c]) == _valor(estado.get(c)):
+                    data[c] = None
+                elif data[c] is None:
+                    data[c] = ""
+            data["delta"] = 1
+        else:
+            data["delta"] = 0
+        cols = ", ".join(f"`{k}`" for k in data)
+        placeholders = ", ".join(["%s"] * len(data))
+        cursor.execute(
+            f"INSERT INTO datapenal_versioning ({cols}) VALUES ({placeholders})",
+            tuple(data.values()),
+        )
+    finally:
+        cursor.close()
+
+
+def reconstruir_versiones(rows: List[dict], columns: Optional[Iterable[str]] = None,
+                          key: str = "registro_ppu") -> List[dict]:
+    """
+    Rellena en su sitio las columnas delta de `rows` (todas las versiones de cada
+    PPU, con `version_id` y `delta`) con el valor vigente en esa versión. `columns`
+    son las claves a rellenar (por defecto las de DELTA_COLUMNS presentes). Quita
+    `delta` de cada fila y devuelve `rows` en el mismo orden.
+    """
+    grupos: Dict[object, List[dict]] = {}
+    for row in rows:
+        grupos.setdefault(row.get(key), []).append(row)
+    for versiones in grupos.values():
+        versiones = sorted(versiones, key=lambda r: r.get("version_id") or 0)
+        cols = list(columns) if columns is not None else [c for c in DELTA_COLUMNS if c in versiones[0]]
+        estado: Dict[str, object] = {}
+        for row in versiones:
+            es_delta = row.pop("delta", 0)
+            for c in cols:
+                if es_delta and row.get(c) is None:
+                    row[c] = estado.get(c)
+                else:
+                    estado[c] = row.get(c)
+    return rows
+
+
+def fijar_versiones_posteriores(connection, registro_ppu: str, consulta_ppu: str) -> int:
+    """
+    Antes de mover a `registro_ppu` las versiones de `consulta_ppu`: convierte en
+    filas completas (delta = 0) las versiones delta de `registro_ppu` posteriores a la
+    primera de la consulta, con los valores reconstruidos solo con su propia cadena.
+    Trabaja en caliente y en el archivo frío. Devuelve las filas reescritas.
+    """
+    from backend.modules.history.archivo import ARCHIVO_TABLAS, union_archivo
+
+    tablas = ("datapenal_versioning", ARCHIVO_TABLAS["datapenal_versioning"])
+    cursor = connection.cursor(dictionary=True)
+    try:
+        sql, params = union_archivo(
+            "SELECT MIN(version_id) AS desde FROM {tabla}"
+            " WHERE consulta_ppu = %s AND NOT (registro_ppu <=> %s)",
+            (consulta_ppu, registro_ppu), "datapenal_versioning",
+        )
+        cursor.execute(sql, params)
+        desdes = [r["desde"] for r in cursor.fetchall() if r["desde"] is not None]
+        if not desdes:
+            return 0
+        desde = min(desdes)
+
+        cols = ", ".join(f"`{c}`" for c in DELTA_COLUMNS)
+        sql, params = union_archivo(
+            f"SELECT version_id, delta, {cols} FROM {{tabla}}"
+            " WHERE registro_ppu = %s AND NOT (consulta_ppu <=> %s)",
+            (registro_ppu, consulta_ppu), "datapenal_versioning",
+        )
+        cursor.execute(sql, params)
+        filas = cursor.fetchall()
+        delta_posteriores = {
+            r["version_id"] for r in filas if r["delta"] and r["version_id"] > desde
+        }
+        if not delta_posteriores:
+            return 0
+        reconstruir_versiones(filas, columns=DELTA_COLUMNS)
+
+        asignaciones = ", ".join(f"`{c}` = %s" for c in DELTA_COLUMNS)
+        for fila in filas:
+            if fila["version_id"] not in delta_posteriores:
+                continue
+            valores = [fila.get(c) for c in DELTA_COLUMNS] + [fila["version_id"]]
+            for tabla in tablas:
+                cursor.execute(
+                    f"UPDATE {tabla} SET {asignaciones}, delta = 0 WHERE version_id = %s", valores
+                )
+        return len(delta_posteriores)
+    finally:
+        cursor.close()
@@ -1,18 +1,19 @@
 import logging
 import os
 import re
-import hashlib
 from datetime import datetime
 from uuid import uuid4
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, session
 from werkzeug.utils import secure_filename
 import mysql.connector
 
 from backend.core import (
-    get_db_connection, login_required, role_required,
-    allowed_file, normalize_text, validate_expediente_juzgado
+    get_db_connection, get_request_db, login_required, role_required,
+    allowed_file, normalize_text, validate_expediente_juzgado,
+    note_ppu_year, invalidate_ppu_years, sha256_file,
 )
+from backend.modules.ingresos.numeracion import NumeracionError, asignar_numero, liberar_numero
 
 ingresos_bp = Blueprint("ingresos", __name__)
 logger = logging.getLogger(__name__)
@@ -54,73 +55,27 @@ def generar_registro():
         return jsonify({"registro_ppu": registro_ppu})
 
     else:
-        connection = get_db_connection()
-        if connection is None:
-            return jsonify({"error": "Error al conectar con la base de datos"}), 500
-
-        try:
-            cursor = connection.cursor(dictionary=True)
-
-            if tipo == 'LEGAJO':
-                if int(year) >= 2023:
-                    prefix = 'L. '
-                    regex_pattern = r'^{}0*\d+-{}(?:-[A-Z]+)?$'.format(re.escape(prefix), year)
-                else:
-                    prefix = 'LEG-'
-                    regex_pattern = r'^{}0*\d+-{}(?:-[A-Z]+)?$'.format(re.escape(prefix), year)
-            elif tipo == 'DENUNCIA':
-                prefix = 'D-'
-                regex_pattern = r'^D-0*\d+-{}(?:-[A-Z]+)?$'.format(year)
-            else:
-                return jsonify({"error": "Tipo inválido"}), 400
-
-            cursor.execute("""
-                SELECT registro_ppu FROM datapenal
-                WHERE registro_ppu REGEXP %s
-            """, (regex_pattern,))
-            registros = cursor.fetchall()
-
-            numeros = []
-            for reg in registros:
-                registro_ppu = reg['registro_ppu']
-                if tipo == 'LEGAJO':
-                    if int(year) >= 2023:
-                        match = re.match(r'^{}0*(\d+)-{}'.format(re.escape(prefix), year), registro_ppu)
-                    else:
-                        match = re.match(r'^{}0*(\d+)-{}'.format(re.escape(prefix), year), registro_ppu)
-                else:
-                    match = re.match(r'^D-0*(\d+)-{}'.format(year), registro_ppu)
-                if match:
-                    numero = int(match.group(1))
-                    numeros.append(numero)
-
+        if tipo == 'LEGAJO':
             if int(year) >= 2023:
-                if numeros:
-                    numeros.sort()
-                    for i in range(1, len(numeros)):
-                        if numeros[i] > numeros[i-1] + 1:
-                            next_num = numeros[i-1] + 1
-                            break
-                    else:
-                        next_num = max(numeros) + 1
-                else:
-                    next_num = 1
+                prefix, ppu_tipo = 'L. ', 'L'
             else:
-                if numeros:
-                    next_num = max(numeros) + 1
-                else:
-                    next_num = 1
-
-            max_length = len(str(next_num))
-            registro_ppu = '{}{num:0{width}d}-{year}'.format(prefix, num=next_num, width=max_length, year=year)
-            return jsonify({"registro_ppu": registro_ppu})
+                prefix, ppu_tipo = 'LEG-', 'LEG'
+        elif tipo == 'DENUNCIA':
+            prefix, ppu_tipo = 'D-', 'D'
+        else:
+            return jsonify({"error": "Tipo inválido"}), 400
 
-        except Exception as e:
-            print(f"Error al generar registro: {e}")
+        # L: primer hueco libre; LEG y D: máximo + 1 (ver numeracion.SERIES).
+        # El número queda reservado para este usuario: otro admin no lo recibe.
+        try:
+            next_num = asignar_numero(ppu_tipo, int(year), session.get('username'))
+        except NumeracionError as e:
+            logger.error(f"Error al generar registro: {e}")
             return jsonify({"error": f"Error al generar registro: {e}"}), 500
-        finally:
-            cursor.close()
-            connection.close()
+
+        max_length = len(str(next_num))
+        registro_ppu = '{}{num:0{width}d}-{year}'.format(prefix, num=next_num, width=max_length, year=year)
+        return jsonify({"registro_ppu": registro_ppu})
 # —— patrones válidos de expediente judicial ——
 PATTERNS_ORIGEN = [
     re.compile(r'\d{5}-\d{4}-\d{1,2}-\d{4}[A-Z-]*-[A-Z]{2}-[A-Z]{2}-\d{1,2}', re.I),
@@ -205,7 +160,8 @@ def agregar_caso():
         origen_final = origen_bruto.upper()
     data['origen'] = origen_final
 
-    conn = get_db_connection()
+    # Conexión de la request: el INSERT se confirma al responder 2xx
+    conn = get_request_db()
     if conn is None:
         logger.error("Error al conectar con la base de datos")
         return jsonify(error="Error al conectar con la base de datos"), 500
@@ -255,21 +211,11 @@ def agregar_caso():
         elif tipo_ingreso == 'CONSULTA':
             data['e_situacional'] = 'CONSULTA'
             anio = datetime.now().year
-            cur.execute(
-                "SELECT etiqueta FROM datapenal WHERE etiqueta LIKE %s",
-                (f"CONSULTA-%-{anio}",)
-            )
-            usados = {
-                int(e.split('-')[1])
-                for (e,) in cur.fetchall()
-                if e and e.startswith('CONSULTA-') and e.endswith(str(anio))
-            }
-            for n in range(1, 1000):
-                if n not in usados:
-                    data['etiqueta'] = f"CONSULTA-{n:03d}-{anio}"
-                    break
-            else:
-                return jsonify(error="Límite de etiquetas CONSULTA alcanzado para este año."), 400
+            try:
+                n = asignar_numero('CONSULTA', anio, session.get('username'))
+            except NumeracionError as e:
+                return jsonify(error=str(e)), 400
+            data['etiqueta'] = f"CONSULTA-{n:03d}-{anio}"
 
         # 4️⃣ inserción incluyendo el registro_ppu recibido
         cols         = ', '.join(f'`{k}`' for k in data.keys())
@@ -279,7 +225,8 @@ def agregar_caso():
 
         logger.info(f"Insertando nuevo caso con PPU {registro_ppu}: {data}")
         cur.execute(sql, vals)
-        conn.commit()
+        # Un año nuevo invalida la caché de /api/years tras el commit
+        note_ppu_year(registro_ppu)
 
         # — Respondemos sin tocar el registro_ppu
         logger.info(f"Caso agregado exitosamente con PPU {registro_ppu}")
@@ -294,7 +241,6 @@ def agregar_caso():
 
     finally:
         cur.close()
-        conn.close()
 
 
 
@@ -315,8 +261,20 @@ def eliminar_caso():
 
     try:
         cursor = connection.cursor()
+        cursor.execute(
+            "SELECT ppu_tipo, ppu_anio, ppu_numero, etq_consulta_anio, etq_consulta_numero"
+            " FROM datapenal WHERE registro_ppu = %s",
+            (registro_ppu,),
+        )
+        numeros = cursor.fetchall()
         cursor.execute("DELETE FROM datapenal WHERE registro_ppu = %s", (registro_ppu,))
+        # Sus números (L. y CONSULTA-) vuelven a estar libres para la siguiente asignación
+        for ppu_tipo, ppu_anio, ppu_numero, etq_anio, etq_numero in numeros:
+            liberar_numero(cursor, ppu_tipo, ppu_anio, ppu_numero)
+            liberar_numero(cursor, 'CONSULTA', etq_anio, etq_numero)
         connection.commit()
+        # Puede haber sido el último PPU de su año
+        invalidate_ppu_years()
         return jsonify({"message": "Caso eliminado exitosamente"}), 200
     except Exception as e:
         print(f"Error al eliminar caso: {e}")
@@ -364,22 +322,15 @@ def upload_and_suggest():
     pdf.save(temp_path)
 
     # Calcular SHA-256
-    sha256 = hashlib.sha256()
-    with open(temp_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            sha256.update(chunk)
-    hash_sha = sha256.hexdigest()
+    hash_sha = sha256_file(temp_path)
 
     # Buscar sugerencia de juzgado
     suggested = ""
+    cur = None
     try:
-        cnx = mysql.connector.connect(
-            host="localhost",
-            database="monitoreo_descargas_sinoe",
-            user="root",
-            password="Manuel22",
-            charset='utf8mb4'
-        )
+        cnx = get_request_db("monitoreo_descargas_sinoe")
+        if cnx is None:
+            raise mysql.connector.Error("Sin conexión a monitoreo_descargas_sinoe")
         cur = cnx.cursor()
         cur.execute(
             "SELECT juzgado_incompleto FROM conteo_exp WHERE codigo_unico=%s LIMIT 1",
@@ -391,7 +342,6 @@ def upload_and_suggest():
         suggested = ""
     finally:
         if cur: cur.close()
-        if cnx: cnx.close()
 
     return jsonify(
         originalName=original,
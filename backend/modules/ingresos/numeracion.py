@@ -0,0 +1,287 @@
+# backend/modules/ingresos/numeracion.py
+# -*- coding: utf-8 -*-
+"""
+Asignación de números de PPU, consultas y etiquetas CONSULTA sin carreras.
+
+Cada serie (tipo de número) y año tiene una fila en `ppu_numeracion` con el siguiente
+número libre por arriba; las series que rellenan huecos guardan además los números
+libres por debajo en `ppu_hueco`. asignar_numero():
+
+  1. bloquea la fila (serie, año) con SELECT ... FOR UPDATE: dos asignaciones de la
+     misma serie y año se hacen una detrás de otra;
+  2. borra las reservas caducadas (en series con huecos, las no usadas vuelven al pool);
+  3. si el usuario ya tiene un número reservado sin usar, lo devuelve (la vista previa
+     "Generar PPU" se puede pulsar varias veces sin consumir números);
+  4. en series con huecos, si se insertó a mano un número mayor que el contador, lo
+     alcanza y registra los libres intermedios; en series máximo + 1 el contador es
+     MAX(usados, reservas vigentes) + 1, así que una reserva abandonada no deja hueco;
+  5. toma el hueco más bajo o el contador, comprobando en el índice que nadie lo usa;
+  6. lo deja reservado RESERVA_MINUTOS en `ppu_reserva` y confirma.
+
+Cada paso es una búsqueda por índice; solo la primera asignación de una serie/año
+recorre los números existentes para crear los huecos.
+
+Series (mismo criterio que antes en cada endpoint):
+  - L:        legajos desde 2023, primer hueco libre.
+  - LEG, D:   legajos anteriores a 2023 y denuncias, máximo + 1.
+  - CONS:     consulta_ppupenal.consulta_ppu, máximo + 1.
+  - CONSULTA: etiqueta CONSULTA-nnn-aaaa de datapenal, primer hueco (máx. 999).
+"""
+
+import logging
+import os
+from typing import Optional
+
+import mysql.connector
+
+from backend.core import get_db_connection, register_schema_migration
+
+logger = logging.getLogger(__name__)
+
+RESERVA_MINUTOS = int(os.environ.get("PENAL_PPU_RESERVA_MIN", "30"))
+
+
+class NumeracionError(Exception):
+    """No se pudo asignar un número (sin conexión o serie agotada)."""
+
+
+# serie -> (tabla, filtro de la serie, columna año, columna número, rellena huecos, máximo)
+SERIES = {
+    "L":        ("datapenal", "ppu_tipo = 'L'", "ppu_anio", "ppu_numero", True, None),
+    "LEG":      ("datapenal", "ppu_tipo = 'LEG'", "ppu_anio", "ppu_numero", False, None),
+    "D":        ("datapenal", "ppu_tipo = 'D'", "ppu_anio", "ppu_numero", False, None),
+    "CONS":     ("consulta_ppupenal", "ppu_tipo = 'CONS'", "ppu_anio", "ppu_numero", False, None),
+    "CONSULTA": ("datapenal", "etq_consulta_numero IS NOT NULL", "etq_consulta_anio",
+                 "etq_consulta_numero", True, 999),
+}
+
+register_schema_migration(
+    "0012_ppu_numeracion",
+    [
+        "CREATE TABLE IF NOT EXISTS ppu_numeracion ("
+        " serie VARCHAR(10) NOT NULL,"
+        " anio INT UNSIGNED NOT NULL,"
+        " siguiente INT UNSIGNED NOT NULL DEFAULT 1,"
+        " PRIMARY KEY (serie, anio)"
+        ")",
+        "CREATE TABLE IF NOT EXISTS ppu_hueco ("
+        " serie VARCHAR(10) NOT NULL,"
+        " anio INT UNSIGNED NOT NULL,"
+        " numero INT UNSIGNED NOT NULL,"
+        " PRIMARY KEY (serie, anio, numero)"
+        ")",
+        "CREATE TABLE IF NOT EXISTS ppu_reserva ("
+        " serie VARCHAR(10) NOT NULL,"
+        " anio INT UNSIGNED NOT NULL,"
+        " numero INT UNSIGNED NOT NULL,"
+        " usuario VARCHAR(100) NULL,"
+        " expira DATETIME NOT NULL,"
+        " PRIMARY KEY (serie, anio, numero),"
+        " INDEX idx_reserva_expira (serie, anio, expira)"
+        ")",
+        # Etiquetas CONSULTA-nnn-aaaa descompuestas (como las columnas ppu_*)
+        "ALTER TABLE datapenal ADD COLUMN etq_consulta_numero INT UNSIGNED AS (CASE"
+        " WHEN etiqueta REGEXP '^CONSULTA-[0-9]+-[0-9]{4}$'"
+        " THEN CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(etiqueta, '-', 2), '-', -1) AS UNSIGNED)"
+        " END) STORED INVISIBLE",
+        "ALTER TABLE datapenal ADD COLUMN etq_consulta_anio INT UNSIGNED AS (CASE"
+        " WHEN etiqueta REGEXP '^CONSULTA-[0-9]+-[0-9]{4}$'"
+        " THEN CAST(SUBSTRING_INDEX(etiqueta, '-', -1) AS UNSIGNED)"
+        " END) STORED INVISIBLE",
+        "ALTER TABLE datapenal ADD INDEX idx_etq_consulta (etq_consulta_anio, etq_consulta_numero)",
+    ],
+)
+
+
+def _usado(cur, serie: str, anio: int, numero: int) -> bool:
+    tabla, filtro, col_anio, col_num, _, _ = SERIES[serie]
+    cur.execute(
+        f"SELECT 1 FROM {tabla} WHERE {filtro} AND {col_anio} = %s AND {col_num} = %s LIMIT 1",
+        (anio, numero),
+    )
+    return cur.fetchone() is not None
+
+
+def _maximo(cur, serie: str, anio: int) -> int:
+    tabla, filtro, col_anio, col_num, _, _ = SERIES[serie]
+    cur.execute(f"SELECT MAX({col_num}) FROM {tabla} WHERE {filtro} AND {col_anio} = %s", (anio,))
+    return cur.fetchone()[0] or 0
+
+
+def _registrar_huecos(cur, serie: str, anio: int, desde: int, hasta: int) -> None:
+    """Guarda como libres los números de [desde, hasta] que no usa ninguna fila."""
+    if desde > hasta:
+        return
+    tabla, filtro, col_anio, col_num, _, _ = SERIES[serie]
+    cur.execute(
+        f"SELECT DISTINCT {col_num} FROM {tabla}"
+        f" WHERE {filtro} AND {col_anio} = %s AND {col_num} BETWEEN %s AND %s",
+        (anio, desde, hasta),
+    )
+    usados = {r[0] for r in cur.fetchall()}
+    cur.execute(
+        "SELECT numero FROM ppu_reserva WHERE serie = %s AND anio = %s AND numero BETWEEN %s AND %s",
+        (serie, anio, desde, hasta),
+    )
+    usados.update(r[0] for r in cur.fetchall())
+    libres = [(serie, anio, n) for n in range(desde, hasta + 1) if n not in usados]
+    if libres:
+        cur.executemany(
+            "INSERT IGNORE INTO ppu_hueco (serie, anio, numero) VALUES (%s, %s, %s)", libres
+        )
+
+
+def _reclamar_reservas(cur, serie: str, anio: int) -> None:
+    """Borra las reservas caducadas; en series con huecos, las no usadas vuelven al pool."""
+    if SERIES[serie][4]:
+        cur.execute(
+            "SELECT numero FROM ppu_reserva WHERE serie = %s AND anio = %s AND expira < NOW()",
+            (serie, anio),
+        )
+        for (numero,) in cur.fetchall():
+            if not _usado(cur, serie, anio, numero):
+                cur.execute(
+                    "INSERT IGNORE INTO ppu_hueco (serie, anio, numero) VALUES (%s, %s, %s)",
+                    (serie, anio, numero),
+                )
+    cur.execute(
+        "DELETE FROM ppu_reserva WHERE serie = %s AND anio = %s AND expira < NOW()", (serie, anio)
+    )
+
+
+def _reserva_propia(cur, serie: str, anio: int, usuario: Optional[str]) -> Optional[int]:
+    """
+    Número reservado (vigente y sin usar) que ya tiene `usuario` en la serie: volver
+    a pulsar "Generar" devuelve el mismo número en vez de consumir otro. Las reservas
+    propias que ya se usaron se borran.
+    """
+    if not usuario:
+        return None
+    cur.execute(
+        "SELECT numero FROM ppu_reserva WHERE serie = %s AND anio = %s AND usuario = %s"
+        " ORDER BY numero",
+        (serie, anio, usuario),
+    )
+    for (numero,) in cur.fetchall():
+        if not _usado(cur, serie, anio, numero):
+            return numero
+        cur.execute(
+            "DELETE FROM ppu_reserva WHERE serie = %s AND anio = %s AND numero = %s",
+            (serie, anio, numero),
+        )
+    return None
+
+
+def _maxima_reserva(cur, serie: str, anio: int) -> int:
+    cur.execute("SELECT MAX(numero) FROM ppu_reserva WHERE serie = %s AND anio = %s", (serie, anio))
+    return cur.fetchone()[0] or 0
+
+
+def asignar_numero(serie: str, anio: int, usuario: Optional[str] = None) -> int:
+    """
+    Número libre de `serie` para `anio`, reservado para `usuario` durante
+    RESERVA_MINUTOS. Dos llamadas concurrentes nunca reciben el mismo número.
+    Lanza NumeracionError si no hay conexión o la serie llegó a su máximo.
+    """
+    if serie not in SERIES:
+        raise ValueError(f"Serie de numeración desconocida: {serie}")
+    anio = int(anio)
+    huecos, tope = SERIES[serie][4], SERIES[serie][5]
+
+    cnx = get_db_connection()
+    if cnx is None:
+        raise NumeracionError("Error al conectar con la base de datos")
+    cur = cnx.cursor()
+    try:
+        cur.execute(
+            "INSERT IGNORE INTO ppu_numeracion (serie, anio, siguiente) VALUES (%s, %s, 1)",
+            (serie, anio),
+        )
+        cur.execute(
+            "SELECT siguiente FROM ppu_numeracion WHERE serie = %s AND anio = %s FOR UPDATE",
+            (serie, anio),
+        )
+        siguiente = cur.fetchone()[0]
+        _reclamar_reservas(cur, serie, anio)
+
+        numero = _reserva_propia(cur, serie, anio, usuario)
+        if numero is not None:
+            cur.execute(
+                "UPDATE ppu_reserva SET expira = NOW() + INTERVAL %s MINUTE"
+                " WHERE serie = %s AND anio = %s AND numero = %s",
+                (RESERVA_MINUTOS, serie, anio, numero),
+            )
+            cnx.commit()
+            return numero
+
+        maximo = _maximo(cur, serie, anio)
+        if huecos:
+            # Números puestos a mano por encima del contador
+            if maximo >= siguiente:
+                _registrar_huecos(cur, serie, anio, siguiente, maximo)
+                siguiente = maximo + 1
+        else:
+            # Máximo + 1 sobre lo usado y lo reservado: una reserva abandonada no deja
+            # hueco cuando caduca
+            siguiente = max(maximo, _maxima_reserva(cur, serie, anio)) + 1
+
+        if huecos:
+            while numero is None:
+                cur.execute(
+                    "SELECT numero FROM ppu_hueco WHERE serie = %s AND anio = %s"
+                    " ORDER BY numero LIMIT 1",
+                    (serie, anio),
+                )
+                fila = cur.fetchone()
+                if fila is None:
+                    break
+                cur.execute(
+                    "DELETE FROM ppu_hueco WHERE serie = %s AND anio = %s AND numero = %s",
+                    (serie, anio, fila[0]),
+                )
+                if not _usado(cur, serie, anio, fila[0]):
+                    numero = fila[0]
+        while numero is None:
+            candidato, siguiente = siguiente, siguiente + 1
+            if not _usado(cur, serie, anio, candidato):
+                numero = candidato
+
+        if tope is not None and numero > tope:
+            cnx.rollback()
+            raise NumeracionError(f"Límite de números {serie} alcanzado para {anio}.")
+
+        cur.execute(
+            "UPDATE ppu_numeracion SET siguiente = %s WHERE serie = %s AND anio = %s",
+            (siguiente, serie, anio),
+        )
+        cur.execute(
+            "REPLACE INTO ppu_reserva (serie, anio, numero, usuario, expira)"
+            " VALUES (%s, %s, %s, %s, NOW() + INTERVAL %s MINUTE)",
+            (serie, anio, numero, usuario, RESERVA_MINUTOS),
+        )
+        cnx.commit()
+        logger.info("Número %s-%s asignado: %s (%s)", serie, anio, numero, usuario)
+        return numero
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        logger.error("Error al asignar número %s-%s: %s", serie, anio, err)
+        raise NumeracionError(f"Error al asignar número: {err}") from err
+    finally:
+        cur.close()
+        cnx.close()
+
+
+def liberar_numero(cursor, serie: str, anio: int, numero: int) -> None:
+    """
+    Devuelve `numero` al pool de huecos (p. ej. al eliminar el caso) en la
+    transacción de `cursor`. Solo aplica a series que rellenan huecos; la próxima
+    asignación vuelve a comprobar que nadie lo usa.
+    """
+    if serie not in SERIES or not SERIES[serie][4] or not numero or not anio:
+        return
+    cursor.execute(
+        "INSERT IGNORE INTO ppu_hueco (serie, anio, numero)"
+        " SELECT serie, anio, %s FROM ppu_numeracion"
+        " WHERE serie = %s AND anio = %s AND siguiente > %s",
+        (numero, serie, anio, numero),
+    )
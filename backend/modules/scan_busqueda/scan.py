@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, jsonify, request
-import os, re, hashlib, shutil, requests, traceback
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+import os, re, shutil, traceback
+import json, tempfile, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import logging
-from flask import request as _flreq  # para reenviar cookies al backend
+
+from backend.core import login_required, get_db_connection, sha256_file
+from backend.modules.busqueda_rapida.busqueda_rapida import buscar_por_ppus
+from backend.modules.data_penal.export_cache import data_version
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pragma: no cover - depende del entorno
+    Observer = None
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -13,10 +25,28 @@ scan_bp = Blueprint("scan_bp", __name__)
 SOURCE_DIR = r"\\agarciaf\NOTIFICACIONES RENIEC\MESA DE PARTES\Correo\A pasar"
 DEST_BASE = str(Path(SOURCE_DIR) / "HALLADO")  # todo dentro de A pasar
 
+# Por defecto se mueve (el vigilante siempre usa este valor); un escaneo puede pedir {"move": false}
 MOVE_FILES = True
 DEDUP_BY_HASH = True
-API_BASE_URL = "http://127.0.0.1:5001/api"
-TIMEOUT_SEC = 15
+# Hilos para mover/copiar (la copia al share SMB es lo que más tarda)
+SCAN_WORKERS = int(os.environ.get("PENAL_SCAN_WORKERS", "8"))
+# Manifiesto de archivos ya procesados: {ruta: {"firma": [tamaño, mtime_ns], "info", "hecho",
+# "copiado"}}; "copiado" marca los que se copiaron sin moverlos (siguen en la carpeta)
+MANIFEST_PATH = os.environ.get("PENAL_SCAN_MANIFEST") or os.path.join(
+    tempfile.gettempdir(), "penal_scan_manifest.json"
+)
+
+# Vigilante de SOURCE_DIR: apagado salvo PENAL_SCAN_WATCH=1 (mueve archivos de la
+# bandeja compartida; actívalo solo en el proceso del servidor)
+WATCH_ENABLED = os.environ.get("PENAL_SCAN_WATCH", "0") == "1"
+WATCH_INTERVAL = float(os.environ.get("PENAL_SCAN_WATCH_INTERVAL", "30"))
+# Segundos que un archivo debe seguir igual (tamaño y fecha) antes de procesarlo
+WATCH_DEBOUNCE = float(os.environ.get("PENAL_SCAN_WATCH_DEBOUNCE", "5"))
+
+# PPU por consulta a la base durante el escaneo (las filas salen por lotes)
+SCAN_LOTE_PPU = 200
+
+_scan_lock = threading.Lock()  # un escaneo a la vez (comparten carpeta y manifiesto)
 
 # ==================== REGEX (capturan el PPU literal) ====================
 # group(1) = PPU EXACTO como está en el nombre; group(2) = año
@@ -32,18 +62,11 @@ RX_EXP  = re.compile(r"Exp\.\s*([0-9]{4,6}-20\d{2}-\d{1,2}-[A-Z0-9-]{3,})", re.I
 RX_CASO = re.compile(r"CASO[:\s]*([0-9]{3,6}-20\d{2})", re.IGNORECASE)
 
 # ==================== HELPERS ====================
-def _sha256(p: Path, chunk=1024*1024) -> str:
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for b in iter(lambda: f.read(chunk), b""):
-            h.update(b)
-    return h.hexdigest()
-
-def _safe_move_or_copy(src: Path, dst: Path) -> Path:
+def _safe_move_or_copy(src: Path, dst: Path, move: bool = MOVE_FILES) -> Path:
     dst.parent.mkdir(parents=True, exist_ok=True)
     if dst.exists() and DEDUP_BY_HASH:
         try:
-            if _sha256(src) == _sha256(dst):
+            if sha256_file(str(src)) == sha256_file(str(dst)):
                 return dst  # duplicado exacto → no mover
         except Exception:
             pass
@@ -56,158 +79,466 @@ def _safe_move_or_copy(src: Path, dst: Path) -> Path:
                 dst = alt
                 break
             i += 1
-    shutil.move(str(src), str(dst)) if MOVE_FILES else shutil.copy2(str(src), str(dst))
+    shutil.move(str(src), str(dst)) if move else shutil.copy2(str(src), str(dst))
     return dst
 
 def _extract_from_filename(name: str):
-    """Devuelve el PPU EXACTO del nombre; sin upper(), sin int(), sin formateos."""
+    """
+    Devuelve el PPU EXACTO del nombre; sin upper(), sin int(), sin formateos.
+    Cada patrón se evalúa una sola vez por nombre.
+    """
     name = (name or "").strip()
 
+    mE = RX_EXP.search(name)
+    mC = RX_CASO.search(name)
+    partes = {
+        "expedienteParte": (mE.group(1) if mE else "").strip(),
+        "casoParte": (mC.group(1) if mC else "").strip(),
+    }
+
     mD = RX_DEN.search(name)
     if mD:
-        full = mD.group(1)   # p.ej. "D-282-2025"
-        anio = mD.group(2)
-        return {
-            "tipo": "DENUNCIA",
-            "ppu": full,      # ← tal cual
-            "anio": anio,
-            "expedienteParte": (RX_EXP.search(name).group(1) if RX_EXP.search(name) else "").strip(),
-            "casoParte": (RX_CASO.search(name).group(1) if RX_CASO.search(name) else "").strip(),
-        }
+        # p.ej. "D-282-2025" ← tal cual
+        return {"tipo": "DENUNCIA", "ppu": mD.group(1), "anio": mD.group(2), **partes}
 
     mL = RX_LEG.search(name)
     if mL:
-        full = mL.group(1)   # p.ej. "L. 68-2020" o "LEG-0068-2020"
-        anio = mL.group(2)
-        return {
-            "tipo": "LEGAJO",
-            "ppu": full,      # ← tal cual (sin normalizar a "L. 68-2020")
-            "anio": anio,
-            "expedienteParte": (RX_EXP.search(name).group(1) if RX_EXP.search(name) else "").strip(),
-            "casoParte": (RX_CASO.search(name).group(1) if RX_CASO.search(name) else "").strip(),
-        }
+        # p.ej. "L. 68-2020" o "LEG-0068-2020" ← tal cual (sin normalizar a "L. 68-2020")
+        return {"tipo": "LEGAJO", "ppu": mL.group(1), "anio": mL.group(2), **partes}
 
-    return {
-        "tipo": "DESCONOCIDO",
-        "ppu": "",
-        "anio": "",
-        "expedienteParte": (RX_EXP.search(name).group(1) if RX_EXP.search(name) else "").strip(),
-        "casoParte": (RX_CASO.search(name).group(1) if RX_CASO.search(name) else "").strip(),
-    }
+    return {"tipo": "DESCONOCIDO", "ppu": "", "anio": "", **partes}
+
+def _iter_pdfs(src: Path, recursive: bool):
+    """
+    PDFs bajo `src` como os.DirEntry (os.scandir: el tamaño y la fecha vienen con el
+    listado, sin un stat por archivo en Windows/SMB). Mismo orden que os.walk.
+    """
+    pila = [str(src)]
+    while pila:
+        carpeta = pila.pop()
+        subcarpetas = []
+        try:
+            with os.scandir(carpeta) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subcarpetas.append(entry.path)
+                        elif entry.is_file() and entry.name.lower().endswith(".pdf"):
+                            yield entry
+                    except OSError:
+                        continue
+        except OSError:
+            logging.warning("No se pudo listar %s", carpeta)
+            continue
+        if recursive:
+            pila.extend(reversed(subcarpetas))
+
+def _load_manifest() -> dict:
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _save_manifest(manifest: dict) -> None:
+    tmp = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh, ensure_ascii=False)
+        os.replace(tmp, MANIFEST_PATH)
+    except OSError:
+        logging.warning("No se pudo guardar el manifiesto de escaneo en %s", MANIFEST_PATH)
+
+def _mover_grupo(items, dst: Path, move: bool = MOVE_FILES):
+    """
+    Mueve/copia a HALLADO los archivos de un mismo nombre destino, en orden (así
+    dos archivos homónimos nunca compiten por el mismo destino).
+    """
+    hechos = []
+    for path, firma, info in items:
+        try:
+            destino = _safe_move_or_copy(Path(path), dst / os.path.basename(path), move)
+            st = destino.stat()
+            hechos.append((path, firma, info, (str(destino), [st.st_size, st.st_mtime_ns])))
+        except Exception:
+            logging.exception("No se pudo mover %s", path)
+            hechos.append((path, firma, info, None))
+    return hechos
 
-def _fetch_backend_rows(ppu: str):
+def _fetch_backend_rows(ppus):
     """
-    Llama a /api/busqueda_rapida usando el PPU EXACTO y reenviando las cookies
-    del request actual (para @login_required).
+    Filas de la grilla para todos los PPU detectados (EXACTOS) en una sola pasada
+    por la base: {ppu: [filas]}. Si no hay conexión devuelve {} (todo placeholder).
     """
-    url = API_BASE_URL.rstrip("/") + "/busqueda_rapida"
+    conn = get_db_connection()
+    if conn is None:
+        logging.error("busqueda_rapida_scan: sin conexión a la base de datos")
+        return {}
     try:
-        r = requests.get(
-            url,
-            params={"q": ppu},
-            cookies=_flreq.cookies,  # reenvía sesión
-            timeout=TIMEOUT_SEC,
-            allow_redirects=False
-        )
-        if r.status_code in (401, 302):
-            logging.warning("busqueda_rapida requiere login (status=%s)", r.status_code)
-            return []
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, list):
-            return data
-        return [data] if data else []
+        return buscar_por_ppus(conn, ppus)
     except Exception:
-        logging.exception("fetch_backend_rows failed for %s", ppu)
-        return []
+        logging.exception("fetch_backend_rows failed for %d PPU", len(ppus))
+        return {}
+    finally:
+        conn.close()
 
-# ==================== ENDPOINT ====================
-@scan_bp.route("/busqueda_rapida_scan", methods=["POST"])  # ⬅ SIN /api aquí
-def busqueda_rapida_scan():
+def _placeholder_row(ppu: str, info: dict) -> dict:
+    """Fila placeholder para un PPU que no existe en BD."""
+    origen = []
+    if info["expedienteParte"]:
+        origen.append(f"Exp. {info['expedienteParte']}")
+    if info["casoParte"]:
+        c = info["casoParte"]
+        origen.append(f"CASO {c}" if not re.match(r"^caso", c, re.I) else c)
+    return {
+        "registro_ppu": ppu,
+        "abogado": "",
+        "denunciado": "",
+        "origen": ", ".join(origen),
+        "juzgado": "",
+        "departamento": "",
+        "nr_de_exp_completo": "",
+        "fiscaliaOrigen": "",
+        "delito": "",
+        "e_situacional": "",
+        "etiqueta": "",
+        "informeJuridico": "",
+        "item": "",
+        "fechaIngreso": None,
+        "fechaDeArchivo": None,
+        "razonArchivo": ""
+    }
+
+def _scan_eventos(src: Path, dst: Path, recursive: bool, solo_nuevos: bool = False,
+                  listo=None, ppus_vistos: set = None, move: bool = MOVE_FILES):
     """
-    Escanea la carpeta, detecta PPU por nombre de archivo, mueve PDFs a HALLADO,
-    consulta el backend y devuelve filas para la grilla.
+    Escaneo como secuencia de eventos (dicts con "event"):
+      - "detected":    archivo nuevo o modificado con PPU en el nombre.
+      - "row":         fila de la BD para un PPU detectado (una por fila).
+      - "placeholder": fila placeholder de un PPU sin registro en BD.
+      - "moved":       resultado del mover/copiar de un archivo (`ok`).
+      - "done":        contadores finales.
+    Las filas se consultan por lotes de SCAN_LOTE_PPU mientras el pool mueve (o
+    copia, con `move` en False).
+
+    Para el vigilante: `solo_nuevos` consulta solo los PPU de archivos nuevos o
+    modificados, `listo(ruta, firma)` difiere los que aún se están escribiendo y
+    `ppus_vistos` recibe todos los PPU presentes en la carpeta.
     """
-    global MOVE_FILES
+    with _scan_lock:
+        scanned, moved, skipped, deferred = 0, 0, 0, 0
+        detectados = {}  # ppu -> info del primer archivo, en orden de aparición
+        nuevos = {}      # lo mismo, solo de archivos nuevos o modificados
+        en_espera = set()  # PPU de archivos diferidos por `listo`
+        manifest = _load_manifest()
+        vistos = {}      # manifiesto nuevo: solo lo que sigue en la carpeta
+        por_destino = {}  # nombre destino -> [(ruta, firma, info)] a mover
 
+        # 1) Recorrer la carpeta: solo se analiza lo nuevo o modificado
+        for entry in _iter_pdfs(src, recursive):
+            scanned += 1
+            try:
+                st = entry.stat()
+                firma = [st.st_size, st.st_mtime_ns]
+                previo = manifest.get(entry.path)
+                # Un archivo solo copiado (move=False) sigue en la carpeta: un escaneo que
+                # mueve lo vuelve a procesar
+                ya_hecho = previo and previo.get("hecho") and (not move or not previo.get("copiado"))
+                if previo and previo.get("firma") == firma and ya_hecho:
+                    info = previo["info"]
+                    vistos[entry.path] = previo
+                    skipped += 1
+                elif listo is not None and not listo(entry.path, firma):
+                    deferred += 1  # se está escribiendo: en la próxima ronda
+                    en_espera.add(_extract_from_filename(entry.name)["ppu"])
+                    continue
+                else:
+                    info = _extract_from_filename(entry.name)
+                    # Ya está en HALLADO con su nombre: moverlo sería un no-op
+                    en_destino = os.path.normcase(os.path.dirname(entry.path)) == os.path.normcase(str(dst))
+                    if info["ppu"] and not en_destino:
+                        por_destino.setdefault(entry.name.lower(), []).append((entry.path, firma, info))
+                    else:
+                        vistos[entry.path] = {"firma": firma, "info": info, "hecho": True}
+                    if info["ppu"]:
+                        nuevos.setdefault(info["ppu"], info)
+                        yield {"event": "detected", "file": entry.name, "ppu": info["ppu"]}
+                if info["ppu"]:
+                    detectados.setdefault(info["ppu"], info)
+            except Exception:
+                traceback.print_exc()
+
+        # 2) Mover o copiar en paralelo (un hilo por nombre destino) mientras se consulta la BD
+        pool = ThreadPoolExecutor(max_workers=max(1, SCAN_WORKERS))
+        try:
+            futuros = [pool.submit(_mover_grupo, items, dst, move) for items in por_destino.values()]
+
+            # 3) Una consulta por lote de PPU detectados
+            ppus = list(nuevos if solo_nuevos else detectados)
+            for i in range(0, len(ppus), SCAN_LOTE_PPU):
+                lote = ppus[i:i + SCAN_LOTE_PPU]
+                encontrados = _fetch_backend_rows(lote)
+                for ppu in lote:
+                    filas = encontrados.get(ppu)
+                    if filas:
+                        for fila in filas:
+                            yield {"event": "row", "ppu": ppu, "row": fila}
+                    else:
+                        yield {"event": "placeholder", "ppu": ppu, "row": _placeholder_row(ppu, detectados[ppu])}
+
+            for futuro in as_completed(futuros):
+                for path, firma, info, destino in futuro.result():
+                    ok = destino is not None
+                    moved += ok
+                    # Si falló, se reintenta en el próximo escaneo
+                    vistos[path] = {"firma": firma, "info": info, "hecho": ok, "copiado": ok and not move}
+                    if ok:
+                        # El archivo en HALLADO ya está procesado: no se vuelve a analizar
+                        vistos[destino[0]] = {"firma": destino[1], "info": info, "hecho": True}
+                    yield {"event": "moved", "file": os.path.basename(path), "ppu": info["ppu"], "ok": ok}
+        finally:
+            pool.shutdown(wait=True)
+
+        _save_manifest(vistos)
+        if ppus_vistos is not None:
+            ppus_vistos.update(detectados, en_espera - {""})
+        yield {
+            "event": "done",
+            "scanned_count": scanned,
+            "moved_count": moved,
+            "ppus_count": len(detectados),
+            "skipped_count": skipped,
+            "deferred_count": deferred,
+        }
+
+def _scan_params():
+    """
+    (src, dst, recursive, move) del body, o respuesta de error si la carpeta no
+    existe. `move` vale solo para este escaneo (no cambia MOVE_FILES).
+    """
     body = request.get_json(silent=True) or {}
-    move_opt = body.get("move", MOVE_FILES)
+    move = bool(body.get("move", MOVE_FILES))
     recursive = body.get("recursive", True)
-    MOVE_FILES = bool(move_opt)
 
     src = Path(SOURCE_DIR)
     dst = Path(DEST_BASE)
     if not src.exists():
-        return jsonify({"error": f"No existe la ruta: {SOURCE_DIR}"}), 400
+        return None, (jsonify({"error": f"No existe la ruta: {SOURCE_DIR}"}), 400)
     dst.mkdir(parents=True, exist_ok=True)
+    return (src, dst, recursive, move), None
 
-    scanned, moved = 0, 0
-    seen_ppu = set()
-    rows_out = []
+# ==================== VIGILANTE ====================
+# Un hilo recorre SOURCE_DIR con el mismo escaneo incremental que el botón y deja
+# listas las filas de la grilla en _bandeja; /busqueda_rapida_scan las devuelve al
+# instante. En disco local y con watchdog instalado (inotify en Linux) un cambio en
+# la carpeta despierta al hilo; en shares de red (rutas UNC) solo se sondea cada
+# WATCH_INTERVAL segundos.
+_watch_wakeup = threading.Event()
+_watch_started = threading.Event()
+_estabilidad = {}  # ruta -> (firma, monotonic desde que no cambia)
+_bandeja_lock = threading.Lock()
+_bandeja = {"filas": OrderedDict(), "totales": None, "version": None}
 
-    def walker():
-        if recursive:
-            for root, _, files in os.walk(src):
-                for fn in files:
-                    if fn.lower().endswith(".pdf"):
-                        yield Path(root) / fn
-        else:
-            for p in src.iterdir():
-                if p.is_file() and p.suffix.lower() == ".pdf":
-                    yield p
-
-    for pdf in walker():
-        scanned += 1
-        info = _extract_from_filename(pdf.name)
-        ppu = info["ppu"]  # ← EXACTO como aparece en el nombre
+def _archivo_estable(path: str, firma) -> bool:
+    """True si `path` no cambió de tamaño ni fecha en los últimos WATCH_DEBOUNCE s."""
+    ahora = time.monotonic()
+    previo = _estabilidad.get(path)
+    if previo and previo[0] == firma:
+        if ahora - previo[1] >= WATCH_DEBOUNCE:
+            _estabilidad.pop(path, None)
+            return True
+        return False
+    if len(_estabilidad) > 10000:
+        _estabilidad.clear()
+    _estabilidad[path] = (firma, ahora)
+    return False
+
+def _version_datos():
+    conn = get_db_connection()
+    if conn is None:
+        return None
+    try:
+        return data_version(conn, ["datapenal"])
+    finally:
+        conn.close()
 
+def _ronda_vigilancia() -> int:
+    """
+    Una pasada del vigilante, con un único proceso a la vez entre workers
+    (GET_LOCK). Si otro proceso tiene el bloqueo se descarta la bandeja local para
+    que /busqueda_rapida_scan escanee en vivo. Devuelve los archivos diferidos.
+    """
+    cnx = get_db_connection()
+    if cnx is None:
+        return 0
+    cur = cnx.cursor()
+    try:
+        cur.execute("SELECT GET_LOCK('penal_scan_watch', 0)")
+        if cur.fetchone()[0] != 1:
+            with _bandeja_lock:
+                _bandeja.update(filas=OrderedDict(), totales=None, version=None)
+            return 0
         try:
-            if ppu:
-                # mover o copiar
-                dest = Path(dst) / pdf.name
-                try:
-                    _safe_move_or_copy(pdf, dest)
-                    moved += 1
-                except Exception:
-                    pass  # no detiene el flujo
-
-                if ppu not in seen_ppu:
-                    seen_ppu.add(ppu)
-                    filas = _fetch_backend_rows(ppu)
-                    if filas:
-                        rows_out.extend(filas)
-                    else:
-                        # fila placeholder si no existe en BD
-                        origen = []
-                        if info["expedienteParte"]:
-                            origen.append(f"Exp. {info['expedienteParte']}")
-                        if info["casoParte"]:
-                            c = info["casoParte"]
-                            origen.append(f"CASO {c}" if not re.match(r"^caso", c, re.I) else c)
-                        rows_out.append({
-                            "registro_ppu": ppu,
-                            "abogado": "",
-                            "denunciado": "",
-                            "origen": ", ".join(origen),
-                            "juzgado": "",
-                            "departamento": "",
-                            "nr_de_exp_completo": "",
-                            "fiscaliaOrigen": "",
-                            "delito": "",
-                            "e_situacional": "",
-                            "etiqueta": "",
-                            "informeJuridico": "",
-                            "item": "",
-                            "fechaIngreso": None,
-                            "fechaDeArchivo": None,
-                            "razonArchivo": ""
-                        })
+            return _ronda_bandeja()
+        finally:
+            cur.execute("SELECT RELEASE_LOCK('penal_scan_watch')")
+            cur.fetchall()
+    finally:
+        cur.close()
+        cnx.close()
+
+def _ronda_bandeja() -> int:
+    """
+    Solo consulta los PPU de archivos nuevos, salvo que datapenal haya cambiado (o
+    no haya sello de versión): entonces resuelve todos. Devuelve los archivos
+    diferidos por seguir escribiéndose.
+    """
+    src, dst = Path(SOURCE_DIR), Path(DEST_BASE)
+    if not src.exists():
+        return 0
+    dst.mkdir(parents=True, exist_ok=True)
+
+    version = _version_datos()
+    with _bandeja_lock:
+        refrescar = _bandeja["totales"] is None or version is None or version != _bandeja["version"]
+
+    ppus_vistos = set()
+    nuevas = OrderedDict()
+    totales = {}
+    for evento in _scan_eventos(src, dst, True, solo_nuevos=not refrescar,
+                                listo=_archivo_estable, ppus_vistos=ppus_vistos):
+        if evento["event"] in ("row", "placeholder"):
+            nuevas.setdefault(evento["ppu"], []).append((evento["event"], evento["row"]))
+        elif evento["event"] == "done":
+            totales = {k: v for k, v in evento.items() if k != "event"}
+
+    with _bandeja_lock:
+        filas = OrderedDict() if refrescar else _bandeja["filas"]
+        filas.update(nuevas)
+        # Solo PPU que siguen en la carpeta
+        for ppu in [p for p in filas if p not in ppus_vistos]:
+            del filas[ppu]
+        _bandeja.update(filas=filas, totales=totales, version=version)
+    if nuevas:
+        logging.info("Vigilante de 'A pasar': %d PPU resueltos", len(nuevas))
+    return totales.get("deferred_count", 0)
+
+def _bandeja_eventos():
+    """Eventos row/placeholder/done desde las filas ya resueltas, o None si no hay."""
+    with _bandeja_lock:
+        if _bandeja["totales"] is None:
+            return None
+        filas = [(ppu, list(rows)) for ppu, rows in _bandeja["filas"].items()]
+        totales = dict(_bandeja["totales"], ppus_count=len(filas), moved_count=0)
+
+    def generar():
+        for ppu, rows in filas:
+            for tipo, row in rows:
+                yield {"event": tipo, "ppu": ppu, "row": row}
+        yield {"event": "done", **totales, "watch": True}
+
+    return generar()
+
+def _bucle_vigilancia():
+    while True:
+        try:
+            diferidos = _ronda_vigilancia()
         except Exception:
-            traceback.print_exc()
-
-    return jsonify({
-        "scanned_count": scanned,
-        "moved_count": moved,
-        "ppus_count": len(seen_ppu),
-        "rows": rows_out
-    })
+            logging.exception("Error en el vigilante de 'A pasar'")
+            diferidos = 0
+        _watch_wakeup.wait(WATCH_DEBOUNCE if diferidos else WATCH_INTERVAL)
+        _watch_wakeup.clear()
+
+def iniciar_vigilancia() -> None:
+    """Arranca (una vez por proceso) el vigilante de SOURCE_DIR."""
+    if not WATCH_ENABLED or _watch_started.is_set():
+        return
+    _watch_started.set()
+    threading.Thread(target=_bucle_vigilancia, name="penal-scan-watch", daemon=True).start()
+
+    # Notificaciones del sistema de archivos: solo disco local (no UNC)
+    if Observer is None or SOURCE_DIR.startswith("\\\\") or not os.path.isdir(SOURCE_DIR):
+        return
+
+    class _Despertador(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if not event.is_directory:
+                _watch_wakeup.set()
+
+    try:
+        observer = Observer()
+        observer.schedule(_Despertador(), SOURCE_DIR, recursive=True)
+        observer.daemon = True
+        observer.start()
+    except Exception:
+        logging.warning("watchdog no disponible para %s; solo sondeo", SOURCE_DIR)
+
+def _eventos_solicitados():
+    """
+    Eventos para los endpoints: las filas del vigilante si ya están resueltas (y no
+    se pide {"force": true}, ni un move distinto de MOVE_FILES, ni recursive en false),
+    si no un escaneo completo.
+    Devuelve la respuesta de error si la carpeta no existe.
+    """
+    body = request.get_json(silent=True) or {}
+    mismo_modo = bool(body.get("move", MOVE_FILES)) == MOVE_FILES
+    if not body.get("force") and mismo_modo and body.get("recursive", True):
+        eventos = _bandeja_eventos()
+        if eventos is not None:
+            return eventos
+    params, error = _scan_params()
+    if error:
+        return error
+    src, dst, recursive, move = params
+    return _scan_eventos(src, dst, recursive, move=move)
+
+# ==================== ENDPOINT ====================
+@scan_bp.route("/busqueda_rapida_scan", methods=["POST"])  # ⬅ SIN /api aquí
+@login_required
+def busqueda_rapida_scan():
+    """
+    Escanea la carpeta, detecta PPU por nombre de archivo, mueve PDFs a HALLADO,
+    consulta el backend y devuelve filas para la grilla.
+
+    Incremental: los archivos ya procesados con el mismo tamaño y fecha (según el
+    manifiesto) no se vuelven a analizar ni mover; sus PPU salen del manifiesto.
+    """
+    eventos = _eventos_solicitados()
+    if isinstance(eventos, tuple):
+        return eventos
+
+    rows_out = []
+    totales = {}
+    for evento in eventos:
+        if evento["event"] in ("row", "placeholder"):
+            rows_out.append(evento["row"])
+        elif evento["event"] == "done":
+            totales = {k: v for k, v in evento.items() if k != "event"}
+
+    return jsonify({**totales, "rows": rows_out})
+
+@scan_bp.route("/busqueda_rapida_scan_stream", methods=["POST"])  # ⬅ SIN /api aquí
+@login_required
+def busqueda_rapida_scan_stream():
+    """
+    Igual que /busqueda_rapida_scan pero responde NDJSON (un evento JSON por línea,
+    ver _scan_eventos) a medida que avanza: la grilla pinta filas sin esperar al final.
+    """
+    eventos = _eventos_solicitados()
+    if isinstance(eventos, tuple):
+        return eventos
+
+    def generar():
+        try:
+            for evento in eventos:
+                yield json.dumps(evento, ensure_ascii=False, default=str) + "\n"
+        except Exception as e:
+            logging.exception("busqueda_rapida_scan_stream error")
+            yield json.dumps({"event": "error", "message": str(e)}, ensure_ascii=False) + "\n"
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"},
+    )
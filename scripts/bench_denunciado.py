@@ -0,0 +1,115 @@
+# scripts/bench_denunciado.py
+# -*- coding: utf-8 -*-
+"""
+Benchmark del índice de denunciados frente al camino anterior de new_search.
+
+    python -m scripts.bench_denunciado [filas] [consultas]   (desde la raíz del repo)
+
+No necesita base de datos: genera nombres sintéticos y compara
+  - "actual": prefiltro LIKE '%Q%' (LIMIT 100 por tabla) + Levenshtein en Python
+  - "exhaustivo": Levenshtein contra todas las filas (la respuesta correcta)
+  - "índice": DenunciadoIndex.search (todas las filas y el top 10 que usa new_search)
+midiendo latencia por consulta y cuántas filas correctas devuelve cada uno.
+"""
+
+import random
+import sys
+import time
+
+from backend.modules.data_penal.denunciado_index import (
+    MAX_DISTANCE, DenunciadoIndex, match_distance, normalize_name, split_names,
+)
+
+NOMBRES = [
+    "JUAN", "JOSE", "LUIS", "CARLOS", "MARIA", "ROSA", "VICTOR", "YOLANDA", "ZOILA",
+    "EDGAR", "WILBER", "ELVIS", "SILVIA", "GLADYS", "ALBERTO", "RAUL", "NANCY",
+]
+APELLIDOS = [
+    "QUISPE", "MAMANI", "HUAMAN", "FLORES", "VARGAS", "ZAPATA", "YUPANQUI", "CONDORI",
+    "GUTIERREZ", "RAMOS", "CHAVEZ", "VASQUEZ", "SANCHEZ", "TORRES", "ROJAS", "DIAZ",
+    "MENDOZA", "CASTILLO", "VILCA", "CCAHUANA", "TICONA", "APAZA", "CAYO", "PUMA",
+]
+
+
+def _persona(rng):
+    return f"{rng.choice(NOMBRES)} {rng.choice(APELLIDOS)} {rng.choice(APELLIDOS)}"
+
+
+def _typo(rng, text):
+    i = rng.randrange(len(text))
+    op = rng.choice("sdi")
+    letra = rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+    if op == "s":
+        return text[:i] + letra + text[i + 1:]
+    if op == "d":
+        return text[:i] + text[i + 1:]
+    return text[:i] + letra + text[i:]
+
+
+def _actual(rows, query):
+    like = query.upper()
+    cands = [r for r in rows if like in r[1].upper()][:100]
+    q = normalize_name(query)
+    out = []
+    for key, den in cands:
+        d = match_distance(q, split_names(den))
+        if d is not None and d <= MAX_DISTANCE:
+            out.append((key, d))
+    return out
+
+
+def _exhaustivo(rows, query):
+    q = normalize_name(query)
+    out = []
+    for key, den in rows:
+        d = match_distance(q, split_names(den))
+        if d is not None and d <= MAX_DISTANCE:
+            out.append((key, d))
+    return out
+
+
+def main(n_rows=30000, n_queries=200, seed=7):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        personas = ", ".join(_persona(rng) for _ in range(rng.randint(1, 3)))
+        rows.append((("datapenal", i), personas))
+
+    t0 = time.perf_counter()
+    idx = DenunciadoIndex()
+    for key, den in rows:
+        idx.add_row(key, den)
+    build = time.perf_counter() - t0
+
+    queries = []
+    for _ in range(n_queries):
+        base = rng.choice(rows)[1].split(",")[0].strip()
+        if rng.random() < 0.5:
+            base = base.split()[-1]  # consulta parcial (apellido)
+        queries.append(_typo(rng, base) if rng.random() < 0.6 else base)
+
+    tiempos = {"actual": 0.0, "exhaustivo": 0.0, "indice": 0.0, "indice_top10": 0.0}
+    encontrados = {"actual": 0, "indice": 0}
+    esperados = 0
+    for q in queries:
+        t = time.perf_counter(); ref = _exhaustivo(rows, q); tiempos["exhaustivo"] += time.perf_counter() - t
+        t = time.perf_counter(); act = _actual(rows, q); tiempos["actual"] += time.perf_counter() - t
+        t = time.perf_counter(); res = idx.search(q); tiempos["indice"] += time.perf_counter() - t
+        t = time.perf_counter(); idx.search(q, limit=10); tiempos["indice_top10"] += time.perf_counter() - t
+        ref_set = set(ref)
+        if set(res) != ref_set:
+            raise AssertionError(f"El índice difiere del recorrido exhaustivo para {q!r}")
+        esperados += len(ref_set)
+        encontrados["actual"] += len(ref_set & set(act))
+        encontrados["indice"] += len(ref_set & set(res))
+
+    print(f"filas={n_rows} consultas={n_queries} construcción índice={build * 1000:.0f} ms")
+    for nombre, total in tiempos.items():
+        print(f"  {nombre:<13} {total / n_queries * 1000:8.3f} ms/consulta")
+    print(f"  filas correctas: actual={encontrados['actual']}/{esperados} "
+          f"índice={encontrados['indice']}/{esperados}")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)